@@ -0,0 +1,113 @@
+/*
+ * SPDX-FileCopyrightText: Copyright (c) 2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+ * SPDX-License-Identifier: Apache-2.0
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ * http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+#ifndef MODEL_BUNDLE_H_
+#define MODEL_BUNDLE_H_
+
+#include <cstddef>
+#include <cstdint>
+#include <cstring>
+
+// Layout of the single-file model bundle written by tool/model_bundle.py.
+// Map the file and cast its first bytes to BundleHeader; every section is an
+// absolute (offset, size) pair into the mapping, all values little-endian.
+static const char BUNDLE_MAGIC[8] = {'P', 'P', 'B', 'U', 'N', 'D', 'L', 'E'};
+static const uint32_t BUNDLE_VERSION = 1;
+
+enum BundleSectionId
+{
+  BUNDLE_ANCHORS = 0,         // float [num_anchors * len_per_anchor]
+  BUNDLE_ANCHOR_HEIGHTS = 1,  // float [num_classes]
+  BUNDLE_CLASS_NAMES = 2,     // num_classes NUL-terminated strings
+  BUNDLE_WEIGHTS = 3,         // external initializers of the graph
+  BUNDLE_GRAPH = 4,           // onnx ModelProto
+  BUNDLE_NUM_SECTIONS = 5
+};
+
+struct BundleSection
+{
+  uint64_t offset;
+  uint64_t size;
+};
+
+// the scalars of class Params
+struct BundleParams
+{
+  int32_t max_voxels;
+  int32_t batch_size;
+  int32_t num_classes;
+  int32_t max_num_points_per_pillar;
+  int32_t num_point_values;
+  int32_t num_feature_scatter;
+  int32_t num_dir_bins;
+  int32_t num_anchors;
+  int32_t len_per_anchor;
+  int32_t num_box_values;
+  int32_t grid_x_size;
+  int32_t grid_y_size;
+  int32_t grid_z_size;
+  int32_t feature_x_size;
+  int32_t feature_y_size;
+  float min_x_range;
+  float max_x_range;
+  float min_y_range;
+  float max_y_range;
+  float min_z_range;
+  float max_z_range;
+  float pillar_x_size;
+  float pillar_y_size;
+  float pillar_z_size;
+  float dir_offset;
+  float dir_limit_offset;
+  float score_thresh;
+  float nms_thresh;
+};
+
+struct BundleHeader
+{
+  char magic[8];
+  uint32_t version;
+  uint32_t header_size;
+  uint32_t num_sections;
+  uint32_t reserved0;
+  BundleSection sections[BUNDLE_NUM_SECTIONS];
+  BundleParams params;
+  uint8_t reserved1[40];
+};
+
+static_assert(sizeof(BundleParams) == 112, "BundleParams must match PARAMS_STRUCT in tool/exporter_paramters.py");
+static_assert(sizeof(BundleHeader) == 256, "BundleHeader must match HEADER_SIZE in tool/model_bundle.py");
+
+inline bool bundleHeaderValid(const void *data, size_t length)
+{
+  if (length < sizeof(BundleHeader)) return false;
+  const BundleHeader *header = static_cast<const BundleHeader *>(data);
+  if (std::memcmp(header->magic, BUNDLE_MAGIC, sizeof(BUNDLE_MAGIC)) != 0) return false;
+  if (header->version != BUNDLE_VERSION || header->num_sections < BUNDLE_NUM_SECTIONS) return false;
+  for (int i = 0; i < BUNDLE_NUM_SECTIONS; i++) {
+    if (header->sections[i].offset + header->sections[i].size > length) return false;
+  }
+  return true;
+}
+
+template <typename T>
+inline const T *bundleSection(const void *data, BundleSectionId id)
+{
+  const BundleHeader *header = static_cast<const BundleHeader *>(data);
+  return reinterpret_cast<const T *>(static_cast<const char *>(data) + header->sections[id].offset);
+}
+
+#endif
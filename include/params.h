@@ -55,6 +55,8 @@ class Params
     // the score threshold for classification
     const float score_thresh = 0.1;
     const float nms_thresh = 0.01;
+    // the number of frames per inference, pillars of all frames share the voxels input
+    static const int batch_size = 1;
     const int max_num_pillars = MAX_VOXELS;
     const int pillarPoints_bev = max_num_points_per_pillar * max_num_pillars;
     // the detected boxes result decode by (x, y, z, w, l, h, yaw)
@@ -34,7 +34,7 @@ class PPScatterPlugin : public nvinfer1::IPluginV2DynamicExt
 public:
     PPScatterPlugin() = delete;
     PPScatterPlugin(const void* data, size_t length);
-    PPScatterPlugin(size_t h, size_t w);
+    PPScatterPlugin(size_t h, size_t w, size_t batch_size = 1);
     // IPluginV2DynamicExt Methods
     nvinfer1::IPluginV2DynamicExt* clone() const noexcept override;
     nvinfer1::DimsExprs getOutputDimensions(int outputIndex, 
@@ -72,6 +72,8 @@ private:
     size_t feature_y_size_;
     // the x -- output size of the 2D backbone network
     size_t feature_x_size_;
+    // the number of frames scattered into the output
+    size_t batch_size_;
 };
 
 class PPScatterPluginCreator : public nvinfer1::IPluginCreator
@@ -46,8 +46,8 @@ T readFromBuffer(const char*& buffer)
     return val;
 }
 
-PPScatterPlugin::PPScatterPlugin(size_t h, size_t w)
-  : feature_y_size_(h), feature_x_size_(w)
+PPScatterPlugin::PPScatterPlugin(size_t h, size_t w, size_t batch_size)
+  : feature_y_size_(h), feature_x_size_(w), batch_size_(batch_size)
 {
 }
 
@@ -56,11 +56,12 @@ PPScatterPlugin::PPScatterPlugin(const void* data, size_t length)
     const char* d = reinterpret_cast<const char*>(data);
     feature_y_size_ = readFromBuffer<size_t>(d);
     feature_x_size_ = readFromBuffer<size_t>(d);
+    batch_size_ = readFromBuffer<size_t>(d);
 }
 
 nvinfer1::IPluginV2DynamicExt* PPScatterPlugin::clone() const noexcept
 {
-    auto* plugin = new PPScatterPlugin(feature_y_size_, feature_x_size_);
+    auto* plugin = new PPScatterPlugin(feature_y_size_, feature_x_size_, batch_size_);
     plugin->setPluginNamespace(mNamespace.c_str());
     return plugin;
 }
@@ -71,7 +72,7 @@ nvinfer1::DimsExprs PPScatterPlugin::getOutputDimensions(
     assert(outputIndex == 0);
     nvinfer1::DimsExprs output;
     output.nbDims = 4;
-    output.d[0] = exprBuilder.constant(1);
+    output.d[0] = exprBuilder.constant(batch_size_);
     output.d[1] = inputs[0].d[1];
     output.d[2] = exprBuilder.constant(feature_y_size_);
     output.d[3] = exprBuilder.constant(feature_x_size_);
@@ -137,7 +138,7 @@ int PPScatterPlugin::enqueue(const nvinfer1::PluginTensorDesc* inputDesc,
         if(inputType == nvinfer1::DataType::kHALF){
             auto pillar_features_data = static_cast<const half *>(inputs[0]);
             auto spatial_feature_data = static_cast<half *>(outputs[0]);
-            cudaMemsetAsync(spatial_feature_data, 0, numFeatures*featureY*featureX * sizeof(half), stream);
+            cudaMemsetAsync(spatial_feature_data, 0, batch_size_*numFeatures*featureY*featureX * sizeof(half), stream);
             status = pillarScatterHalfKernelLaunch(
                 maxPillarNum,
                 numFeatures,
@@ -155,7 +156,7 @@ int PPScatterPlugin::enqueue(const nvinfer1::PluginTensorDesc* inputDesc,
         else if(inputType == nvinfer1::DataType::kFLOAT){
             auto pillar_features_data = static_cast<const float *>(inputs[0]);
             auto spatial_feature_data = static_cast<float *>(outputs[0]);
-            cudaMemsetAsync(spatial_feature_data, 0, numFeatures*featureY*featureX * sizeof(float), stream);
+            cudaMemsetAsync(spatial_feature_data, 0, batch_size_*numFeatures*featureY*featureX * sizeof(float), stream);
             status = pillarScatterFloatKernelLaunch(
                 maxPillarNum,
                 numFeatures,
@@ -222,6 +223,7 @@ void PPScatterPlugin::serialize(void* buffer) const noexcept
     char* d = reinterpret_cast<char*>(buffer);
     writeToBuffer<size_t>(d, feature_y_size_);
     writeToBuffer<size_t>(d, feature_x_size_);
+    writeToBuffer<size_t>(d, batch_size_);
 }
 
 void PPScatterPlugin::destroy() noexcept
@@ -243,6 +245,7 @@ PPScatterPluginCreator::PPScatterPluginCreator()
 {
     mPluginAttributes.clear();
     mPluginAttributes.emplace_back(PluginField("dense_shape", nullptr, PluginFieldType::kINT32, 1));
+    mPluginAttributes.emplace_back(PluginField("batch_size", nullptr, PluginFieldType::kINT32, 1));
     mFC.nbFields = mPluginAttributes.size();
     mFC.fields = mPluginAttributes.data();
 }
@@ -268,6 +271,7 @@ IPluginV2* PPScatterPluginCreator::createPlugin(const char* name, const PluginFi
     int nbFields = fc->nbFields;
     int target_h = 0;
     int target_w = 0;
+    int batch_size = 1;
     for (int i = 0; i < nbFields; ++i)
     {
         const char* attr_name = fields[i].name;
@@ -277,10 +281,15 @@ IPluginV2* PPScatterPluginCreator::createPlugin(const char* name, const PluginFi
             target_h = ts[0];
             target_w = ts[1];
         }
+        else if (!strcmp(attr_name, "batch_size"))
+        {
+            batch_size = *static_cast<const int*>(fields[i].data);
+        }
     }
     auto* plugin = new PPScatterPlugin(
         target_h,
-        target_w
+        target_w,
+        batch_size
     );
     return plugin;
 }
@@ -39,14 +39,16 @@ __global__ void pillarScatterHalfkernel(const half *pillar_features_data,
     __syncthreads();
     if(pillar_idx >= num_pillars) return;
     uint4 coord = ((const uint4 *)coords_data)[pillar_idx];
+    unsigned int b = coord.x;
     unsigned int x = coord.w;
     unsigned int y = coord.z;
 
     // Output tensor format : kHWC8, [N][H][W][(C+7)/8*8]
     int C_stride = (PILLAR_FEATURE_SIZE+7)/8*8;
+    size_t batch_offset = (size_t)b*featureY*featureX*C_stride;
     for (int i = 0; i < PILLAR_FEATURE_SIZE; i++)
     {
-        spatial_feature_data[y*featureX*C_stride + x*C_stride + i] = pillarSM[threadIdx.x][i];
+        spatial_feature_data[batch_offset + y*featureX*C_stride + x*C_stride + i] = pillarSM[threadIdx.x][i];
     }
 }
 
@@ -72,12 +74,15 @@ __global__ void pillarScatterFloatkernel(const float *pillar_features_data,
     __syncthreads();
     if(pillar_idx >= num_pillars) return;
     uint4 coord = ((const uint4 *)coords_data)[pillar_idx];
+    unsigned int b = coord.x;
     unsigned int x = coord.w;
     unsigned int y = coord.z;
 
+    // Output tensor format : kLINEAR, [N][C][H][W], N is the frame id in coords
+    size_t batch_offset = (size_t)b*PILLAR_FEATURE_SIZE*featureY*featureX;
     for (int i = 0; i < PILLAR_FEATURE_SIZE; i++)
     {
-        spatial_feature_data[i*featureY*featureX + y*featureX + x] = pillarSM[threadIdx.x][i];
+        spatial_feature_data[batch_offset + i*featureY*featureX + y*featureX + x] = pillarSM[threadIdx.x][i];
     }
 }
 
@@ -0,0 +1,202 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import time
+import argparse
+import multiprocessing
+
+from packed_frames import open_frames
+from postprocess import format_boxes
+
+JOURNAL_NAME = 'journal.jsonl'
+COMBINED_NAME = 'predictions.txt'
+
+# one CPURunner and one frame source per worker process
+_worker = dict()
+
+def _worker_init(model_path, params_path, source, ext, intra_op_threads, nms_pre_max_size):
+  from cpu_runner import CPURunner
+  from voxelizer import read_params_header
+  params = read_params_header(params_path)
+  _worker['frames'] = open_frames(source, ext, params.get('num_point_values', 4))
+  _worker['runner'] = CPURunner(model_path, params, intra_op_threads, 1, nms_pre_max_size)
+
+def _worker_run(indices):
+  # boxes of every frame of one chunk, read by the worker itself so no points cross processes
+  runner, frames = _worker['runner'], _worker['frames']
+  results = []
+  for start in range(0, len(indices), runner.batch_size):
+    batch = indices[start:start + runner.batch_size]
+    results += runner.run([frames[i] for i in batch])
+  return indices, results, os.getpid(), dict(runner.timings)
+
+class Journal(object):
+  """
+  Completion journal of an output directory, one JSON line per written
+  chunk with its frame names and, for the combined file, the byte offset
+  it ends at. A line is only appended once the chunk's predictions are on
+  disk, so a crash loses at most the chunks in flight.
+  """
+  def __init__(self, output_dir):
+    self.path = os.path.join(output_dir, JOURNAL_NAME)
+    self.done, self.end = set(), 0
+    valid = 0
+    if os.path.exists(self.path):
+      with open(self.path, 'rb') as f:
+        for line in f:
+          try:
+            entry = json.loads(line.decode('utf-8'))
+          except ValueError:
+            break
+          if not line.endswith(b'\n'):
+            break
+          self.done.update(entry['frames'])
+          self.end = entry.get('end', self.end)
+          valid += len(line)
+    self.file = open(self.path, 'a')
+    # the last line of a crashed run may be cut off, new lines must not be glued to it
+    self.file.truncate(valid)
+
+  def record(self, names, end=None):
+    entry = {'frames': names}
+    if end is not None:
+      entry['end'] = end
+    self.file.write(json.dumps(entry) + '\n')
+    self.file.flush()
+    os.fsync(self.file.fileno())
+
+  def close(self):
+    self.file.close()
+
+class PredictionWriter(object):
+  """
+  Writes predictions in frame order, a chunk at a time. Per frame files
+  (<name>.txt in the SaveBoxPred format) are written with one write each;
+  combined=True appends every frame to one predictions.txt as a
+  "# <name> <count>" line followed by its boxes, one write per chunk.
+  """
+  def __init__(self, output_dir, journal, combined=False):
+    self.output_dir = output_dir
+    self.journal = journal
+    self.combined = None
+    if combined:
+      path = os.path.join(output_dir, COMBINED_NAME)
+      self.combined = open(path, 'r+b' if os.path.exists(path) else 'wb')
+      # drop whatever a crashed run wrote after its last journaled chunk
+      self.combined.truncate(journal.end)
+      self.combined.seek(journal.end)
+
+  def write(self, names, results):
+    if self.combined is not None:
+      text = ''.join('# %s %d\n%s' % (name, len(boxes), format_boxes(boxes)) for name, boxes in zip(names, results))
+      self.combined.write(text.encode('utf-8'))
+      self.combined.flush()
+      os.fsync(self.combined.fileno())
+      self.journal.record(names, self.combined.tell())
+      return
+    for name, boxes in zip(names, results):
+      path = os.path.join(self.output_dir, name + '.txt')
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      with open(path, 'w') as f:
+        f.write(format_boxes(boxes))
+    self.journal.record(names)
+
+  def close(self):
+    if self.combined is not None:
+      self.combined.close()
+
+def run_directory(model_path, params_path, source, output_dir, workers, threads_per_worker=None, chunk_size=16, ext='.bin',
+                  combined=False, nms_pre_max_size=None):
+  """
+  Runs every frame of source (a directory or a pack) not yet in the
+  journal of output_dir through workers processes, each with its own ORT
+  session of threads_per_worker intra-op threads. Chunks of chunk_size
+  frames are handed out as workers free up, results come back and are
+  written in frame order. Returns a summary.
+  """
+  os.makedirs(output_dir, exist_ok=True)
+  frames = open_frames(source, ext)
+  names = list(frames.names)
+  frames.close()
+  journal = Journal(output_dir)
+  todo = [i for i, name in enumerate(names) if name not in journal.done]
+  threads_per_worker = threads_per_worker or max(1, multiprocessing.cpu_count() // workers)
+  chunks = [todo[i:i + chunk_size] for i in range(0, len(todo), chunk_size)]
+  print('%d frames, %d already done, %d chunks on %d workers x %d threads' % (
+      len(names), len(names) - len(todo), len(chunks), workers, threads_per_worker))
+
+  writer = PredictionWriter(output_dir, journal, combined)
+  per_worker = dict()
+  start = time.time()
+  # spawn, ORT sessions and their thread pools do not survive a fork
+  context = multiprocessing.get_context('spawn')
+  try:
+    with context.Pool(workers, _worker_init, (model_path, params_path, source, ext, threads_per_worker, nms_pre_max_size)) as pool:
+      done = 0
+      for indices, results, pid, timings in pool.imap(_worker_run, chunks):
+        writer.write([names[i] for i in indices], results)
+        per_worker[pid] = timings
+        done += len(indices)
+        elapsed = time.time() - start
+        print('%7d / %d frames  %8.1f fps' % (done, len(todo), done / max(elapsed, 1e-9)))
+  finally:
+    writer.close()
+    journal.close()
+
+  wall = time.time() - start
+  summary = {'frames': len(todo), 'skipped': len(names) - len(todo), 'workers': workers, 'threads_per_worker': threads_per_worker,
+             'wall_s': wall, 'fps': len(todo) / max(wall, 1e-9), 'per_worker': per_worker}
+  return summary
+
+def format_summary(summary):
+  lines = ['%d frames in %.1f s, %.2f fps on %d workers x %d threads (%d skipped from the journal)' % (
+      summary['frames'], summary['wall_s'], summary['fps'], summary['workers'], summary['threads_per_worker'], summary['skipped'])]
+  for pid, timings in sorted(summary['per_worker'].items()):
+    count = max(timings['frames'], 1)
+    lines.append('  worker %-8d %6d frames  voxelize %7.2f ms  inference %7.2f ms  postprocess %7.2f ms' % (
+        pid, timings['frames'], 1000.0 * timings['voxelize'] / count, 1000.0 * timings['inference'] / count,
+        1000.0 * timings['postprocess'] / count))
+  return '\n'.join(lines)
+
+def parse_config():
+  parser = argparse.ArgumentParser(description='run pointpillar.onnx over a whole directory or packed drive on several processes')
+  parser.add_argument('--model', type=str, default='../model/pointpillar.onnx', help='final graph written by the exporter')
+  parser.add_argument('--params', type=str, default='../include/params.h', help='params.h written with the graph')
+  parser.add_argument('--data_path', type=str, default='../data', help='directory of point clouds or a packed dataset')
+  parser.add_argument('--ext', type=str, default='.bin')
+  parser.add_argument('--output_dir', type=str, default='../eval/kitti/object/pred_velo', help='predictions and the journal')
+  parser.add_argument('--workers', type=int, default=max(1, multiprocessing.cpu_count() // 4))
+  parser.add_argument('--threads_per_worker', type=int, default=None, help='intra-op threads, defaults to cores / workers')
+  parser.add_argument('--chunk_size', type=int, default=16, help='frames per task, also the unit of writing and journaling')
+  parser.add_argument('--combined', action='store_true', default=False, help='one predictions.txt instead of a file per frame')
+  parser.add_argument('--nms_pre_max_size', type=int, default=None)
+  parser.add_argument('--summary', type=str, default=None, help='write the summary as json here')
+
+  args = parser.parse_args()
+  return args
+
+def main():
+  args = parse_config()
+  summary = run_directory(args.model, args.params, args.data_path, args.output_dir, args.workers, args.threads_per_worker,
+                          args.chunk_size, args.ext, args.combined, args.nms_pre_max_size)
+  print(format_summary(summary))
+  if args.summary is not None:
+    with open(args.summary, 'w') as f:
+      json.dump(summary, f, indent=2)
+
+if __name__ == '__main__':
+  main()
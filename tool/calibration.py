@@ -0,0 +1,202 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import argparse
+import numpy as np
+from pathlib import Path
+
+from voxelizer import FEATURES_SIZE, generate_features
+
+INDEX_FILE = 'calib_index.json'
+SHARD_INPUTS = ('voxels', 'voxel_idxs', 'voxel_num')
+
+def select_frames(num_frames, stride=1, max_frames=None, shuffle=False, seed=0):
+  # deterministic for a given (num_frames, stride, max_frames, shuffle, seed)
+  indices = np.arange(0, num_frames, stride)
+  if shuffle:
+    indices = np.random.RandomState(seed).permutation(indices)
+  if max_frames is not None:
+    indices = indices[:max_frames]
+  return [int(i) for i in indices]
+
+def encode_frame(data_dict, params, MAX_VOXELS):
+  """
+  Turns the voxelization output of DemoDataset into the final graph inputs:
+  voxels [V, P, 10], voxel_idxs [V, 4] as (frame_id, z, y, x), voxel_num [1].
+  """
+  MAX_POINTS_PER_VOXEL = params['max_num_points_per_pillar']
+  num = min(len(data_dict['voxels']), MAX_VOXELS)
+
+  voxels = np.zeros((MAX_VOXELS, MAX_POINTS_PER_VOXEL, FEATURES_SIZE), dtype=np.float32)
+  voxel_idxs = np.zeros((MAX_VOXELS, 4), dtype=np.int32)
+  voxel_num = np.array([num], dtype=np.int32)
+
+  coords = data_dict['voxel_coords'][:num]
+  voxels[:num] = generate_features(data_dict['voxels'][:num], data_dict['voxel_num_points'][:num], coords, params)
+  voxel_idxs[:num, 1:] = coords
+  return voxels, voxel_idxs, voxel_num
+
+def shard_path(output_dir, shard_id, name):
+  return os.path.join(output_dir, 'shard_%05d_%s.npy' % (shard_id, name))
+
+def load_index(output_dir, settings):
+  # a restart keeps the shards written under identical settings
+  path = os.path.join(output_dir, INDEX_FILE)
+  if not os.path.exists(path):
+    return None
+  with open(path) as f:
+    index = json.load(f)
+  if index.get('settings') != settings:
+    print('Calibration settings changed, rebuilding shards in %s' % output_dir)
+    return None
+  index['shards'] = [shard for shard in index['shards']
+                     if all(os.path.exists(os.path.join(output_dir, shard['files'][name])) for name in SHARD_INPUTS)]
+  return index
+
+def save_index(output_dir, index):
+  path = os.path.join(output_dir, INDEX_FILE)
+  with open(path + '.tmp', 'w') as f:
+    json.dump(index, f, indent=2)
+  os.replace(path + '.tmp', path)
+
+def source_names(dataset):
+  # names of a pack are kept whole, frames packed from several directories are paths under their common parent
+  if getattr(dataset, 'packed', None) is not None:
+    return list(dataset.packed.names)
+  return [os.path.basename(str(f)) for f in dataset.sample_file_list]
+
+def write_shard(output_dir, shard_id, frames, dataset, params, MAX_VOXELS, shard_size):
+  MAX_POINTS_PER_VOXEL = params['max_num_points_per_pillar']
+  shapes = {
+    'voxels': ((shard_size, MAX_VOXELS, MAX_POINTS_PER_VOXEL, FEATURES_SIZE), np.float32),
+    'voxel_idxs': ((shard_size, MAX_VOXELS, 4), np.int32),
+    'voxel_num': ((shard_size, 1), np.int32),
+  }
+
+  # fixed-shape shards, unused trailing slots stay zero and are not listed in the index
+  arrays = dict()
+  for name, (shape, dtype) in shapes.items():
+    arrays[name] = np.lib.format.open_memmap(shard_path(output_dir, shard_id, name) + '.tmp',
+                                             mode='w+', dtype=dtype, shape=shape)
+
+  names, sources = source_names(dataset), []
+  for slot, frame in enumerate(frames):
+    voxels, voxel_idxs, voxel_num = encode_frame(dataset[frame], params, MAX_VOXELS)
+    arrays['voxels'][slot] = voxels
+    arrays['voxel_idxs'][slot] = voxel_idxs
+    arrays['voxel_num'][slot] = voxel_num
+    sources.append(names[frame])
+
+  files = dict()
+  for name, array in arrays.items():
+    array.flush()
+    path = shard_path(output_dir, shard_id, name)
+    os.replace(path + '.tmp', path)
+    files[name] = os.path.basename(path)
+
+  return {'id': shard_id, 'num_frames': len(frames), 'frames': frames, 'sources': sources, 'files': files}
+
+def build_shards(dataset, params, output_dir, MAX_VOXELS, shard_size=64, stride=1, max_frames=None, shuffle=False, seed=0):
+  os.makedirs(output_dir, exist_ok=True)
+  settings = {
+    'max_voxels': MAX_VOXELS,
+    'max_points_per_voxel': params['max_num_points_per_pillar'],
+    'shard_size': shard_size,
+    'stride': stride,
+    'max_frames': max_frames,
+    'shuffle': shuffle,
+    'seed': seed,
+    'sources': source_names(dataset),
+    'params': params,
+  }
+
+  frames = select_frames(len(dataset), stride, max_frames, shuffle, seed)
+  index = load_index(output_dir, settings)
+  if index is None:
+    index = {'settings': settings, 'inputs': list(SHARD_INPUTS), 'shards': []}
+  done = set(shard['id'] for shard in index['shards'])
+
+  for shard_id, start in enumerate(range(0, len(frames), shard_size)):
+    if shard_id in done:
+      print('shard %05d: already built, skipping' % shard_id)
+      continue
+    shard = write_shard(output_dir, shard_id, frames[start:start + shard_size], dataset, params, MAX_VOXELS, shard_size)
+    index['shards'].append(shard)
+    index['shards'].sort(key=lambda shard: shard['id'])
+    save_index(output_dir, index)
+    print('shard %05d: %d frames' % (shard_id, shard['num_frames']))
+
+  return index
+
+class CalibrationShards(object):
+  """
+  Reads the shards back as memory-mapped arrays, one frame at a time and in index order.
+  """
+  def __init__(self, output_dir):
+    self.output_dir = output_dir
+    with open(os.path.join(output_dir, INDEX_FILE)) as f:
+      self.index = json.load(f)
+
+  def __len__(self):
+    return sum(shard['num_frames'] for shard in self.index['shards'])
+
+  def __iter__(self):
+    for shard in self.index['shards']:
+      arrays = {name: np.load(os.path.join(self.output_dir, shard['files'][name]), mmap_mode='r') for name in SHARD_INPUTS}
+      for slot in range(shard['num_frames']):
+        yield {name: arrays[name][slot] for name in SHARD_INPUTS}
+
+def parse_config():
+  parser = argparse.ArgumentParser(description='build INT8 calibration shards for pointpillar.onnx')
+  parser.add_argument('--cfg_file', type=str, default='cfgs/kitti_models/pointpillar.yaml',
+                      help='specify the config for demo')
+  parser.add_argument('--data_path', type=str, default='demo_data',
+                      help='specify the point cloud data file or directory')
+  parser.add_argument('--ext', type=str, default='.bin', help='specify the extension of your point cloud data file')
+  parser.add_argument('--output_dir', type=str, default='calib_shards', help='directory receiving the shards and the index')
+  parser.add_argument('--max_voxels', type=int, default=10000, help='V of the exported graph the shards are built for')
+  parser.add_argument('--shard_size', type=int, default=64, help='frames per shard')
+  parser.add_argument('--stride', type=int, default=1, help='use every n-th frame')
+  parser.add_argument('--max_frames', type=int, default=None, help='stop after this many frames')
+  parser.add_argument('--shuffle', action='store_true', default=False, help='seeded shuffle of the selected frames')
+  parser.add_argument('--seed', type=int, default=0, help='seed for --shuffle')
+
+  args = parser.parse_args()
+  return args
+
+def main():
+  from pcdet.config import cfg, cfg_from_yaml_file
+  from pcdet.utils import common_utils
+  from demo_dataset import DemoDataset
+  from exporter_paramters import collect_paramters
+
+  args = parse_config()
+  cfg_from_yaml_file(args.cfg_file, cfg)
+  logger = common_utils.create_logger()
+  logger.info('------ Build INT8 calibration shards ------')
+
+  dataset = DemoDataset(
+      dataset_cfg=cfg.DATA_CONFIG, class_names=cfg.CLASS_NAMES, training=False,
+      root_path=Path(args.data_path), ext=args.ext, logger=logger
+  )
+  params = collect_paramters(cfg, args.max_voxels)
+  index = build_shards(dataset, params, args.output_dir, args.max_voxels, args.shard_size,
+                       args.stride, args.max_frames, args.shuffle, args.seed)
+  logger.info('[PASS] %d calibration frames in %d shards.' % (sum(s['num_frames'] for s in index['shards']), len(index['shards'])))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,245 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import argparse
+import numpy as np
+import onnx
+from onnx import numpy_helper
+
+# ops costed as one FLOP per output element
+ELEMENTWISE_OPS = {"Add", "Sub", "Mul", "Div", "Relu", "Sigmoid", "Clip", "Max", "Min", "Where", "Less", "Greater", "Cast", "Neg", "Exp"}
+# ops costed as one FLOP per input element
+REDUCE_OPS = {"ReduceMax", "ReduceMin", "ReduceSum", "ReduceMean", "ArgMax", "TopK"}
+
+def _prod(shape):
+  return int(np.prod(shape, dtype=np.int64)) if shape is not None else 0
+
+def _itemsize(elem_type):
+  return np.dtype(onnx.helper.tensor_dtype_to_np_dtype(elem_type)).itemsize
+
+def _static_shape(type_proto):
+  dims = type_proto.tensor_type.shape.dim
+  if not type_proto.tensor_type.HasField('shape') or any(not d.HasField('dim_value') for d in dims):
+    return None
+  return [int(d.dim_value) for d in dims]
+
+def _attr(node, name, default=None):
+  for attr in node.attribute:
+    if attr.name == name:
+      return onnx.helper.get_attribute_value(attr)
+  return default
+
+def scatter_output_shape(node, consumers, weights):
+  """
+  [batch_size, C, NY, NX] of a PPScatterPlugin node, dense_shape is
+  [NX, NY] as written by simplifier_onnx.replace_with_clip. ONNX shape
+  inference stops at the plugin, so C comes from the first backbone Conv
+  after the canvas, like simplify_preprocess does.
+  """
+  NX, NY = [int(v) for v in _attr(node, 'dense_shape')]
+  batch_size = int(_attr(node, 'batch_size', 1))
+  pending, visited = [node.output[0]], set()
+  while pending:
+    for user in consumers.get(pending.pop(0), []):
+      if user.op_type == "Conv" and user.input[1] in weights:
+        return [batch_size, weights[user.input[1]].shape[1], NY, NX]
+      if user.name not in visited:
+        visited.add(user.name)
+        pending.extend(user.output)
+  raise ValueError('No Conv reads the output of %s' % node.name)
+
+def infer_tensors(model):
+  """
+  Static shape and dtype of every tensor in the graph. The PPScatterPlugin
+  output is filled in by hand and ONNX shape inference does the rest.
+  """
+  graph = model.graph
+  weights = {t.name: numpy_helper.to_array(t) for t in graph.initializer}
+  consumers = dict()
+  for node in graph.node:
+    for name in node.input:
+      consumers.setdefault(name, []).append(node)
+
+  model = onnx.ModelProto.FromString(model.SerializeToString())
+  known = set(v.name for v in list(model.graph.value_info) + list(model.graph.output))
+  for node in model.graph.node:
+    if node.op_type == "PPScatterPlugin" and node.output[0] not in known:
+      model.graph.value_info.append(onnx.helper.make_tensor_value_info(
+          node.output[0], onnx.TensorProto.FLOAT, scatter_output_shape(node, consumers, weights)))
+  model = onnx.shape_inference.infer_shapes(model)
+
+  tensors = dict()
+  for value in list(model.graph.input) + list(model.graph.value_info) + list(model.graph.output):
+    if value.type.tensor_type.elem_type:
+      tensors[value.name] = (_static_shape(value.type), _itemsize(value.type.tensor_type.elem_type))
+  for name, array in weights.items():
+    tensors[name] = (list(array.shape), array.dtype.itemsize)
+  for node in model.graph.node:
+    if node.op_type == "Constant":
+      array = numpy_helper.to_array(_attr(node, 'value'))
+      tensors[node.output[0]] = (list(array.shape), array.dtype.itemsize)
+  return tensors, weights
+
+def node_cost(node, tensors):
+  # (MACs, FLOPs) of one node, FLOPs count a MAC as two
+  shape = lambda name: tensors.get(name, (None, 0))[0]
+  out = shape(node.output[0]) if node.output else None
+  if node.op_type == "Conv":
+    weight = shape(node.input[1])
+    macs = _prod(out) * _prod(weight[1:]) if out and weight else 0
+    return macs, 2 * macs + (_prod(out) if len(node.input) > 2 else 0)
+  if node.op_type == "ConvTranspose":
+    # every input pixel meets C_out/group * kh * kw weights
+    weight, inp = shape(node.input[1]), shape(node.input[0])
+    macs = _prod(inp) * _prod(weight[1:]) if inp and weight else 0
+    return macs, 2 * macs + (_prod(out) if len(node.input) > 2 else 0)
+  if node.op_type in ("MatMul", "Gemm"):
+    a = shape(node.input[0])
+    macs = _prod(out) * a[-1] if out and a else 0
+    return macs, 2 * macs + (_prod(out) if node.op_type == "Gemm" and len(node.input) > 2 else 0)
+  if node.op_type == "BatchNormalization":
+    return 0, 2 * _prod(out)
+  if node.op_type in ELEMENTWISE_OPS:
+    return 0, _prod(out)
+  if node.op_type in REDUCE_OPS:
+    return 0, _prod(shape(node.input[0]))
+  # data movement: PPScatterPlugin, Transpose, Reshape, Concat, Slice, Gather, ScatterElements, ...
+  return 0, 0
+
+def cost_report(model_path):
+  """
+  Per-layer MACs, FLOPs, weight and activation bytes of an exported graph,
+  and the liveness-based peak of the activations: a tensor is held from the
+  node producing it (graph inputs from the start) to its last consumer
+  (graph outputs to the end), nodes run in graph order.
+  """
+  model = onnx.load(model_path)
+  graph = model.graph
+  tensors, weights = infer_tensors(model)
+  nbytes = lambda name: _prod(tensors[name][0]) * tensors[name][1] if name in tensors else 0
+  constants = set(weights) | set(n.output[0] for n in graph.node if n.op_type == "Constant")
+
+  layers, seen_weights, unknown = [], set(), []
+  for node in graph.node:
+    if node.op_type == "Constant":
+      continue
+    macs, flops = node_cost(node, tensors)
+    node_weights = [name for name in node.input if name in constants and name not in seen_weights]
+    seen_weights.update(node_weights)
+    outputs = [name for name in node.output if name]
+    unknown += [name for name in outputs if tensors.get(name, (None, 0))[0] is None]
+    layers.append({
+      'name': node.name, 'op': node.op_type,
+      'output_shape': tensors.get(outputs[0], (None, 0))[0] if outputs else None,
+      'macs': macs, 'flops': flops,
+      'weight_bytes': sum(nbytes(name) for name in node_weights),
+      'activation_bytes': sum(nbytes(name) for name in outputs),
+    })
+
+  # liveness over the graph order, constants are weights and never counted here
+  nodes = [node for node in graph.node if node.op_type != "Constant"]
+  first, last = dict(), dict()
+  for value in graph.input:
+    if value.name not in constants:
+      first[value.name] = 0
+  for step, node in enumerate(nodes):
+    for name in node.output:
+      if name:
+        first.setdefault(name, step)
+    for name in node.input:
+      if name and name not in constants:
+        last[name] = step
+  for value in graph.output:
+    last[value.name] = len(nodes) - 1
+  peak = {'bytes': 0, 'step': 0, 'node': None, 'live': []}
+  for step, node in enumerate(nodes):
+    live = [name for name, start in first.items() if start <= step <= last.get(name, start)]
+    total = sum(nbytes(name) for name in live)
+    if total > peak['bytes']:
+      peak = {'bytes': total, 'step': step, 'node': node.name,
+              'live': sorted(({'tensor': name, 'bytes': nbytes(name)} for name in live), key=lambda t: -t['bytes'])}
+
+  inputs = {value.name: tensors.get(value.name, (None, 0))[0] for value in graph.input if value.name not in constants}
+  return {
+    'model': os.path.basename(model_path),
+    'inputs': inputs,
+    'layers': layers,
+    'totals': {
+      'macs': sum(layer['macs'] for layer in layers),
+      'flops': sum(layer['flops'] for layer in layers),
+      'weight_bytes': sum(nbytes(name) for name in constants),
+      'activation_bytes': sum(layer['activation_bytes'] for layer in layers),
+      'peak_activation_bytes': peak['bytes'],
+    },
+    'peak': peak,
+    'unknown_shapes': unknown,
+  }
+
+def _mb(num_bytes):
+  return num_bytes / (1024.0 * 1024.0)
+
+def format_layers(report, top=None):
+  layers = report['layers']
+  if top is not None:
+    layers = sorted(layers, key=lambda layer: -layer['macs'])[:top]
+  lines = ['%-40s %-18s %-22s %12s %10s %10s' % ('layer', 'op', 'output', 'MMACs', 'weight MB', 'act MB')]
+  for layer in layers:
+    shape = 'x'.join(str(d) for d in layer['output_shape']) if layer['output_shape'] else '?'
+    lines.append('%-40s %-18s %-22s %12.2f %10.3f %10.3f' % (layer['name'][:40], layer['op'][:18], shape,
+                                                            layer['macs'] / 1e6, _mb(layer['weight_bytes']), _mb(layer['activation_bytes'])))
+  return '\n'.join(lines)
+
+def format_summary(reports):
+  lines = ['%-32s %10s %10s %10s %10s %10s' % ('model', 'GMACs', 'GFLOPs', 'weight MB', 'act MB', 'peak MB')]
+  for report in reports:
+    totals = report['totals']
+    lines.append('%-32s %10.3f %10.3f %10.3f %10.3f %10.3f' % (
+        report['model'][:32], totals['macs'] / 1e9, totals['flops'] / 1e9, _mb(totals['weight_bytes']),
+        _mb(totals['activation_bytes']), _mb(totals['peak_activation_bytes'])))
+  return '\n'.join(lines)
+
+def parse_config():
+  parser = argparse.ArgumentParser(description='static cost of exported pointpillar graphs')
+  parser.add_argument('models', type=str, nargs='+', help='exported graphs, e.g. one per ROI, bucket or class set')
+  parser.add_argument('--json', type=str, default=None, help='write the full reports to this file')
+  parser.add_argument('--top', type=int, default=None, help='only list the layers with the most MACs')
+  parser.add_argument('--no_layers', action='store_true', default=False, help='only print the summary')
+
+  args = parser.parse_args()
+  return args
+
+def main():
+  args = parse_config()
+  reports = [cost_report(path) for path in args.models]
+  for report in reports:
+    if not args.no_layers:
+      print('------ %s ------' % report['model'])
+      print(format_layers(report, args.top))
+    peak = report['peak']
+    print('peak activations %.3f MB at %s: %s' % (_mb(peak['bytes']), peak['node'],
+                                                        ', '.join(t['tensor'] for t in peak['live'][:4])))
+    if report['unknown_shapes']:
+      print('[WARN] no static shape for %s, their bytes count as 0' % report['unknown_shapes'])
+  print(format_summary(reports))
+
+  if args.json is not None:
+    with open(args.json, 'w') as f:
+      json.dump(reports if len(reports) > 1 else reports[0], f, indent=2)
+    print('Report written to %s' % args.json)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,217 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+import onnx
+
+from voxelizer import read_params_header, voxelize_frames
+from onnx_parity import HEAD_OUTPUTS, scatter_reference
+from packed_frames import open_frames
+from postprocess import decode_frame, decode_topk, nms_bev_grid, save_box_pred
+
+# python custom ops of onnxruntime-extensions live in this domain
+CUSTOM_DOMAIN = 'ai.onnx.contrib'
+
+def pp_scatter(pillar_features, voxel_idxs, voxel_num, dense_shape, batch_size='1'):
+  # PPScatterPlugin on the CPU, dense_shape = "NX,NY" as written by prepare_model
+  dense_shape = [int(v) for v in dense_shape.split(',')]
+  pillar_features = pillar_features.reshape(pillar_features.shape[0], -1)
+  return scatter_reference(pillar_features, voxel_idxs, voxel_num, dense_shape, int(batch_size))
+
+_registered = []
+
+def register_scatter_op():
+  # once per process, onnxruntime-extensions keeps python ops in a global table
+  if _registered:
+    return _registered[0]
+  from onnxruntime_extensions import onnx_op, PyCustomOpDef, get_library_path
+  onnx_op(op_type='PPScatterPlugin',
+          inputs=[PyCustomOpDef.dt_float, PyCustomOpDef.dt_int32, PyCustomOpDef.dt_int32],
+          outputs=[PyCustomOpDef.dt_float],
+          attrs=['dense_shape', 'batch_size'])(pp_scatter)
+  _registered.append(get_library_path())
+  return _registered[0]
+
+def scatter_attrs(node):
+  attrs = {attr.name: onnx.helper.get_attribute_value(attr) for attr in node.attribute}
+  return [int(v) for v in attrs['dense_shape']], int(attrs.get('batch_size', 1))
+
+def prepare_model(model):
+  """
+  Moves every PPScatterPlugin node of the final graph to the custom-op
+  domain, with dense_shape and batch_size as the string attributes the
+  python op reads. Graphs exported with --scatter onnx have no plugin node
+  and run as they are.
+  """
+  plugins = 0
+  for node in model.graph.node:
+    if node.op_type != 'PPScatterPlugin':
+      continue
+    dense_shape, batch_size = scatter_attrs(node)
+    node.domain = CUSTOM_DOMAIN
+    del node.attribute[:]
+    node.attribute.extend([onnx.helper.make_attribute('dense_shape', '%d,%d' % tuple(dense_shape)),
+                           onnx.helper.make_attribute('batch_size', str(batch_size))])
+    plugins += 1
+  if plugins and not any(opset.domain == CUSTOM_DOMAIN for opset in model.opset_import):
+    model.opset_import.append(onnx.helper.make_opsetid(CUSTOM_DOMAIN, 1))
+  return model
+
+def create_session(model_path, intra_op_threads=0, inter_op_threads=0):
+  """
+  ORT CPU session of a final graph with the python PPScatterPlugin, the
+  weights may sit in an external-data sidecar next to model_path.
+  """
+  import onnxruntime as ort
+  model = prepare_model(onnx.load(model_path))
+  opts = ort.SessionOptions()
+  opts.intra_op_num_threads = intra_op_threads
+  opts.inter_op_num_threads = inter_op_threads
+  if any(node.domain == CUSTOM_DOMAIN for node in model.graph.node):
+    opts.register_custom_ops_library(register_scatter_op())
+  session = ort.InferenceSession(model.SerializeToString(), opts, providers=['CPUExecutionProvider'])
+  return session
+
+class CPURunner(object):
+  """
+  pointpillar.onnx end to end on the CPU: NumPy voxelizer, the graph on ONNX
+  Runtime and the decode + NMS of postprocess.cpp. run() takes up to
+  batch_size point clouds and returns the kept boxes [n, 9] of each, in the
+  x y z w l h rt id score layout of SaveBoxPred. nms_pre_max_size keeps
+  only the highest scoring candidates before NMS.
+  """
+  def __init__(self, model_path, params, intra_op_threads=0, inter_op_threads=0, nms_pre_max_size=None):
+    self.params = params
+    self.nms_pre_max_size = nms_pre_max_size
+    self.session = create_session(model_path, intra_op_threads, inter_op_threads)
+    # drop_output_transpose leaves the dense heads NCHW, the fusion report says so
+    fusion = json.loads(self.session.get_modelmeta().custom_metadata_map.get('fusion_report', '{}'))
+    self.layout = fusion.get('layout', 'NHWC')
+    assert self.layout in ('NHWC', 'NCHW'), '%s: unknown head layout %s' % (model_path, self.layout)
+    # every head output, dense or top-K, starts with the batch dimension
+    self.batch_size = self.session.get_outputs()[0].shape[0]
+    voxels = [i for i in self.session.get_inputs() if i.name == 'voxels'][0]
+    self.max_voxels = voxels.shape[0] // self.batch_size
+    self.outputs = [o.name for o in self.session.get_outputs()]
+    self.timings = {'voxelize': 0.0, 'inference': 0.0, 'postprocess': 0.0, 'frames': 0}
+
+  def feeds(self, frames):
+    inputs = voxelize_frames(frames, self.params, self.max_voxels)
+    return {'voxels': inputs['features'], 'voxel_idxs': inputs['voxel_idxs'], 'voxel_num': inputs['voxel_num']}
+
+  def postprocess(self, outputs, frame):
+    if 'cls_preds' in outputs:
+      boxes = decode_frame(outputs['cls_preds'][frame], outputs['box_preds'][frame], outputs['dir_cls_preds'][frame], self.params)
+    else:
+      boxes = decode_topk(outputs, self.params, frame)
+    return boxes[nms_bev_grid(boxes, self.params['nms_thresh'], self.nms_pre_max_size)]
+
+  def run(self, frames):
+    assert len(frames) <= self.batch_size, 'the graph takes %d frames per run, got %d' % (self.batch_size, len(frames))
+    # missing frames of a batched graph run empty
+    padded = list(frames) + [np.zeros((0, 4), dtype=np.float32)] * (self.batch_size - len(frames))
+    start = time.time()
+    feeds = self.feeds(padded)
+    voxelized = time.time()
+    outputs = dict(zip(self.outputs, self.session.run(self.outputs, feeds)))
+    if self.layout == 'NCHW':
+      outputs.update({name: outputs[name].transpose(0, 2, 3, 1) for name in HEAD_OUTPUTS if name in outputs})
+    inferred = time.time()
+    results = [self.postprocess(outputs, frame) for frame in range(len(frames))]
+    end = time.time()
+
+    self.timings['voxelize'] += voxelized - start
+    self.timings['inference'] += inferred - voxelized
+    self.timings['postprocess'] += end - inferred
+    self.timings['frames'] += len(frames)
+    return results
+
+def load_frames(data_path, num_point_values=4):
+  # a directory of .bin files or a pack of packed_frames.py
+  frames = open_frames(data_path, '.bin', num_point_values)
+  return frames.names, [frames[i] for i in range(len(frames))]
+
+def benchmark(model_path, params, frames, threads, inter_op_threads=0, repeat=1, save_dir=None, names=None, nms_pre_max_size=None):
+  """
+  Runs every frame repeat times per intra-op thread count after one warmup
+  batch. Returns one row per thread count with the mean ms per frame of
+  each step and the frames per second.
+  """
+  rows = []
+  for intra in threads:
+    runner = CPURunner(model_path, params, intra, inter_op_threads, nms_pre_max_size)
+    B = runner.batch_size
+    batches = [frames[i:i + B] for i in range(0, len(frames), B)]
+    runner.run(batches[0])
+    runner.timings = {'voxelize': 0.0, 'inference': 0.0, 'postprocess': 0.0, 'frames': 0}
+    start = time.time()
+    for _ in range(repeat):
+      results = [boxes for batch in batches for boxes in runner.run(batch)]
+    wall = time.time() - start
+    if save_dir is not None:
+      for name, boxes in zip(names, results):
+        # frames packed from several directories are named by their relative path
+        path = os.path.join(save_dir, name + '.txt')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        save_box_pred(boxes, path)
+    count = runner.timings['frames']
+    rows.append({'intra_op_threads': intra, 'inter_op_threads': inter_op_threads, 'frames': count,
+                 'voxelize_ms': 1000.0 * runner.timings['voxelize'] / count,
+                 'inference_ms': 1000.0 * runner.timings['inference'] / count,
+                 'postprocess_ms': 1000.0 * runner.timings['postprocess'] / count,
+                 'fps': count / wall, 'boxes': sum(len(boxes) for boxes in results)})
+  return rows
+
+def format_benchmark(rows):
+  lines = ['%7s %7s %7s %12s %12s %14s %8s %7s' % ('intra', 'inter', 'frames', 'voxelize ms', 'inference ms', 'postprocess ms', 'fps', 'boxes')]
+  for row in rows:
+    lines.append('%7d %7d %7d %12.2f %12.2f %14.2f %8.2f %7d' % (
+        row['intra_op_threads'], row['inter_op_threads'], row['frames'], row['voxelize_ms'], row['inference_ms'],
+        row['postprocess_ms'], row['fps'], row['boxes']))
+  return '\n'.join(lines)
+
+def parse_config():
+  parser = argparse.ArgumentParser(description='run pointpillar.onnx on the CPU over a directory of point clouds')
+  parser.add_argument('--model', type=str, default='../model/pointpillar.onnx', help='final graph written by the exporter')
+  parser.add_argument('--params', type=str, default='../include/params.h', help='params.h written with the graph')
+  parser.add_argument('--data_path', type=str, default='../data', help='directory of .bin point clouds or a packed dataset')
+  parser.add_argument('--save_dir', type=str, default=None, help='write one SaveBoxPred .txt per frame here')
+  parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4], help='intra-op thread counts to benchmark')
+  parser.add_argument('--inter_op_threads', type=int, default=0)
+  parser.add_argument('--repeat', type=int, default=1, help='timed passes over the frames per thread count')
+  parser.add_argument('--nms_pre_max_size', type=int, default=None, help='pre-NMS top-K, all candidates by default like nms_cpu')
+
+  args = parser.parse_args()
+  return args
+
+def main():
+  args = parse_config()
+  params = read_params_header(args.params)
+  names, frames = load_frames(args.data_path, params.get('num_point_values', 4))
+  assert frames, 'no .bin point clouds in %s' % args.data_path
+  if args.save_dir is not None:
+    os.makedirs(args.save_dir, exist_ok=True)
+  rows = benchmark(args.model, params, frames, args.threads, args.inter_op_threads, args.repeat, args.save_dir, names,
+                   args.nms_pre_max_size)
+  print(format_benchmark(rows))
+  if args.save_dir is not None:
+    print('Saved predictions of %d frames in %s' % (len(frames), args.save_dir))
+
+if __name__ == '__main__':
+  main()
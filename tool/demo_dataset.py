@@ -0,0 +1,81 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import glob
+import numpy as np
+from pcdet.datasets import DatasetTemplate
+from packed_frames import PackedFrames, is_packed
+
+class DemoDataset(DatasetTemplate):
+    def __init__(self, dataset_cfg, class_names, training=True, root_path=None, logger=None, ext='.bin'):
+        """
+        Args:
+            root_path:
+            dataset_cfg:
+            class_names:
+            training:
+            logger:
+
+        root_path may also be a packed dataset written by packed_frames.py (its
+        stem, .points or .index.npz), frames are then read from its mmap.
+        """
+        super().__init__(
+            dataset_cfg=dataset_cfg, class_names=class_names, training=training, root_path=root_path, logger=logger
+        )
+        self.root_path = root_path
+        self.ext = ext
+        self._sample_file_list = None
+        self._packed = None
+
+    @property
+    def packed(self):
+        # checked once, False marks a plain directory or file
+        if self._packed is None:
+            self._packed = PackedFrames(self.root_path) if is_packed(self.root_path) else False
+        return self._packed if self._packed is not False else None
+
+    @property
+    def sample_file_list(self):
+        # the directory is only scanned once a frame is needed, building the network does not need any
+        if self._sample_file_list is None and self.packed is not None:
+            self._sample_file_list = self.packed.names
+        if self._sample_file_list is None:
+            data_file_list = glob.glob(str(self.root_path / f'*{self.ext}')) if self.root_path.is_dir() else [self.root_path]
+
+            data_file_list.sort()
+            self._sample_file_list = data_file_list
+        return self._sample_file_list
+
+    def __len__(self):
+        return len(self.sample_file_list)
+
+    def __getitem__(self, index):
+        if self.packed is not None:
+            # zero-copy view, prepare_data filters the points into new arrays
+            points = self.packed[index]
+        elif self.ext == '.bin':
+            points = np.fromfile(self.sample_file_list[index], dtype=np.float32).reshape(-1, 4)
+        elif self.ext == '.npy':
+            points = np.load(self.sample_file_list[index])
+        else:
+            raise NotImplementedError
+
+        input_dict = {
+            'points': points,
+            'frame_id': index,
+        }
+
+        data_dict = self.prepare_data(data_dict=input_dict)
+        return data_dict
@@ -0,0 +1,155 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import time
+import asyncio
+import argparse
+import numpy as np
+
+from packed_frames import open_frames
+from detection_service import DEFAULT_SOCKET, encode_request, read_response
+
+class DetectionClient(object):
+  """
+  One connection to detection_service.py. detect() may be awaited by many
+  tasks at once, the requests are pipelined and matched by request_id.
+  """
+  def __init__(self, reader, writer):
+    self.reader, self.writer = reader, writer
+    self.pending = dict()
+    self.next_id = 0
+    self.receiving = asyncio.get_running_loop().create_task(self.receive())
+
+  @classmethod
+  async def connect(cls, socket_path=DEFAULT_SOCKET, port=None):
+    if port is not None:
+      reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    else:
+      reader, writer = await asyncio.open_unix_connection(socket_path)
+    return cls(reader, writer)
+
+  async def receive(self):
+    try:
+      while True:
+        request_id, result = await read_response(self.reader)
+        future = self.pending.pop(request_id, None)
+        if future is None or future.done():
+          continue
+        if isinstance(result, Exception):
+          future.set_exception(result)
+        else:
+          future.set_result(result)
+    except (asyncio.IncompleteReadError, ConnectionError) as e:
+      for future in self.pending.values():
+        if not future.done():
+          future.set_exception(ConnectionError('detection service closed the connection: %s' % e))
+      self.pending.clear()
+
+  async def detect(self, points):
+    # boxes [n, 9] in the SaveBoxPred layout
+    request_id = self.next_id
+    self.next_id = (self.next_id + 1) % (1 << 32)
+    future = asyncio.get_running_loop().create_future()
+    self.pending[request_id] = future
+    self.writer.write(encode_request(request_id, points))
+    await self.writer.drain()
+    return await future
+
+  async def close(self):
+    self.receiving.cancel()
+    self.writer.close()
+
+def percentile_ms(latencies, q):
+  return 1000.0 * float(np.percentile(latencies, q)) if latencies else float('nan')
+
+async def load_test(frames, concurrency, requests, socket_path=DEFAULT_SOCKET, port=None, connections=None):
+  """
+  Closed-loop load: concurrency tasks each send a frame, wait for its boxes
+  and send the next, until requests answers came back. The tasks share
+  connections connections (one per task by default). Returns latencies
+  and throughput.
+  """
+  connections = connections or concurrency
+  clients = [await DetectionClient.connect(socket_path, port) for _ in range(connections)]
+  latencies, errors, issued = [], [], [0]
+
+  async def worker(client):
+    while issued[0] < requests:
+      index = issued[0] % len(frames)
+      issued[0] += 1
+      start = time.perf_counter()
+      try:
+        await client.detect(frames[index])
+        latencies.append(time.perf_counter() - start)
+      except Exception as e:
+        errors.append(str(e))
+
+  start = time.perf_counter()
+  await asyncio.gather(*[worker(clients[i % connections]) for i in range(concurrency)])
+  wall = time.perf_counter() - start
+  for client in clients:
+    await client.close()
+  return {
+    'concurrency': concurrency, 'connections': connections, 'requests': len(latencies), 'errors': len(errors),
+    'rps': len(latencies) / max(wall, 1e-9),
+    'p50_ms': percentile_ms(latencies, 50), 'p90_ms': percentile_ms(latencies, 90), 'p99_ms': percentile_ms(latencies, 99),
+    'max_ms': 1000.0 * max(latencies) if latencies else float('nan'),
+    'first_error': errors[0] if errors else None,
+  }
+
+def format_results(rows):
+  lines = ['%11s %11s %8s %6s %8s %8s %8s %8s %8s' % ('concurrency', 'connections', 'requests', 'errors', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms')]
+  for row in rows:
+    lines.append('%11d %11d %8d %6d %8.2f %8.2f %8.2f %8.2f %8.2f' % (
+        row['concurrency'], row['connections'], row['requests'], row['errors'], row['rps'], row['p50_ms'], row['p90_ms'],
+        row['p99_ms'], row['max_ms']))
+  return '\n'.join(lines)
+
+def parse_config():
+  parser = argparse.ArgumentParser(description='load generator for detection_service.py')
+  parser.add_argument('--socket', type=str, default=DEFAULT_SOCKET, help='unix socket of the service')
+  parser.add_argument('--port', type=int, default=None, help='localhost TCP port of the service instead')
+  parser.add_argument('--data_path', type=str, default='../data', help='directory of point clouds or a packed dataset, sent round robin')
+  parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16], help='requests in flight, one run per value')
+  parser.add_argument('--connections', type=int, default=None, help='connections shared by the in-flight requests, one each by default')
+  parser.add_argument('--requests', type=int, default=200, help='answered requests per run')
+  parser.add_argument('--json', type=str, default=None, help='write the results here')
+
+  args = parser.parse_args()
+  return args
+
+async def run(args):
+  source = open_frames(args.data_path)
+  # copies, the views of a pack would keep its mmap busy during the run
+  frames = [np.array(source[i]) for i in range(len(source))]
+  assert frames, 'no point clouds in %s' % args.data_path
+  rows = []
+  for concurrency in args.concurrency:
+    rows.append(await load_test(frames, concurrency, args.requests, args.socket, args.port, args.connections))
+    if rows[-1]['first_error']:
+      print('[WARN] %d errors at concurrency %d, first: %s' % (rows[-1]['errors'], concurrency, rows[-1]['first_error']))
+  return rows
+
+def main():
+  args = parse_config()
+  rows = asyncio.run(run(args))
+  print(format_results(rows))
+  if args.json is not None:
+    with open(args.json, 'w') as f:
+      json.dump(rows, f, indent=2)
+
+if __name__ == '__main__':
+  main()
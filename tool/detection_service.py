@@ -0,0 +1,243 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+import struct
+import asyncio
+import argparse
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from postprocess import BOX_FIELDS
+
+# Wire format, little endian, several requests may be in flight per connection:
+#   request:  magic, request_id, payload bytes, then the float32 points in the .bin layout
+#   response: magic, request_id, status, payload bytes, then float32 boxes [n, 9]
+#             (x y z w l h rt id score) or a utf-8 error message
+MAGIC = b'PPDS'
+REQUEST_HEADER = struct.Struct('<4sII')
+RESPONSE_HEADER = struct.Struct('<4sIII')
+STATUS_OK, STATUS_ERROR = 0, 1
+MAX_PAYLOAD = 64 * 1024 * 1024
+DEFAULT_SOCKET = '/tmp/pointpillar.sock'
+
+def encode_request(request_id, points):
+  payload = np.ascontiguousarray(points, dtype=np.float32).tobytes()
+  return REQUEST_HEADER.pack(MAGIC, request_id, len(payload)) + payload
+
+def encode_response(request_id, boxes=None, error=None):
+  if error is not None:
+    payload, status = error.encode('utf-8'), STATUS_ERROR
+  else:
+    payload, status = np.ascontiguousarray(boxes, dtype=np.float32).tobytes(), STATUS_OK
+  return RESPONSE_HEADER.pack(MAGIC, request_id, status, len(payload)) + payload
+
+async def read_response(reader):
+  # (request_id, boxes [n, 9]) or (request_id, RuntimeError)
+  magic, request_id, status, size = RESPONSE_HEADER.unpack(await reader.readexactly(RESPONSE_HEADER.size))
+  assert magic == MAGIC, 'not a detection service response'
+  payload = await reader.readexactly(size)
+  if status != STATUS_OK:
+    return request_id, RuntimeError(payload.decode('utf-8'))
+  return request_id, np.frombuffer(payload, dtype=np.float32).reshape(-1, len(BOX_FIELDS))
+
+class MicroBatcher(object):
+  """
+  Coalesces concurrent requests into micro-batches: a batch closes when it
+  holds max_batch frames or max_wait_ms after its first frame arrived.
+  Each batch runs on one of the runners in a thread pool, so the event loop
+  keeps accepting while the sessions work. The request queue is bounded,
+  a full queue makes submit() wait and the connections stop being read.
+  """
+  def __init__(self, runners, max_batch, max_wait_ms, queue_size):
+    self.runners = runners
+    self.max_batch = max_batch
+    self.max_wait = max_wait_ms / 1000.0
+    self.queue = asyncio.Queue(maxsize=queue_size)
+    self.idle = asyncio.Queue()
+    for runner in runners:
+      self.idle.put_nowait(runner)
+    # ORT releases the GIL while a session runs, one thread per runner is enough
+    self.executor = ThreadPoolExecutor(max_workers=len(runners))
+    self.stats = {'requests': 0, 'batches': 0, 'batch_frames': 0}
+    self.tasks = set()
+
+  async def submit(self, points):
+    future = asyncio.get_running_loop().create_future()
+    await self.queue.put((points, future))
+    return await future
+
+  async def next_batch(self):
+    loop = asyncio.get_running_loop()
+    batch = [await self.queue.get()]
+    deadline = loop.time() + self.max_wait
+    while len(batch) < self.max_batch:
+      timeout = deadline - loop.time()
+      if timeout <= 0:
+        break
+      try:
+        batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+      except asyncio.TimeoutError:
+        break
+    return batch
+
+  def infer(self, runner, frames):
+    # in the executor, a batched graph takes batch_size frames per run
+    results = []
+    for start in range(0, len(frames), runner.batch_size):
+      results += runner.run(frames[start:start + runner.batch_size])
+    return results
+
+  async def run_batch(self, runner, batch):
+    loop = asyncio.get_running_loop()
+    try:
+      results = await loop.run_in_executor(self.executor, self.infer, runner, [points for points, _ in batch])
+      for (_, future), boxes in zip(batch, results):
+        if not future.done():
+          future.set_result(boxes)
+    except Exception as e:
+      for _, future in batch:
+        if not future.done():
+          future.set_exception(e)
+    finally:
+      self.idle.put_nowait(runner)
+
+  async def run(self):
+    while True:
+      # a batch only starts forming once a runner is free, waiting requests pile into it meanwhile
+      runner = await self.idle.get()
+      batch = await self.next_batch()
+      self.stats['requests'] += len(batch)
+      self.stats['batches'] += 1
+      self.stats['batch_frames'] += len(batch)
+      task = asyncio.get_running_loop().create_task(self.run_batch(runner, batch))
+      self.tasks.add(task)
+      task.add_done_callback(self.tasks.discard)
+
+class DetectionService(object):
+  """
+  Serves CPURunner detections on a unix socket (or localhost TCP port).
+  Every connection may pipeline requests, each is answered as soon as its
+  batch is done and carries its request_id. At most max_inflight requests
+  per connection are read ahead of their answers.
+  """
+  def __init__(self, batcher, num_point_values=4, max_inflight=8):
+    self.batcher = batcher
+    self.num_point_values = num_point_values
+    self.max_inflight = max_inflight
+
+  async def answer(self, writer, lock, request_id, points, slots):
+    try:
+      boxes = await self.batcher.submit(points)
+      response = encode_response(request_id, boxes)
+    except Exception as e:
+      response = encode_response(request_id, error='%s: %s' % (type(e).__name__, e))
+    finally:
+      slots.release()
+    async with lock:
+      writer.write(response)
+      await writer.drain()
+
+  async def handle(self, reader, writer):
+    lock, slots, tasks = asyncio.Lock(), asyncio.Semaphore(self.max_inflight), set()
+    try:
+      while True:
+        try:
+          magic, request_id, size = REQUEST_HEADER.unpack(await reader.readexactly(REQUEST_HEADER.size))
+        except asyncio.IncompleteReadError:
+          break
+        if magic != MAGIC or size > MAX_PAYLOAD:
+          # the stream cannot be resynchronized after a bad header
+          writer.write(encode_response(request_id, error='bad request header'))
+          break
+        payload = await reader.readexactly(size)
+        if size % (4 * self.num_point_values):
+          async with lock:
+            writer.write(encode_response(request_id, error='payload of %d bytes is not float32 x %d points' % (size, self.num_point_values)))
+            await writer.drain()
+          continue
+        await slots.acquire()
+        points = np.frombuffer(payload, dtype=np.float32).reshape(-1, self.num_point_values)
+        task = asyncio.get_running_loop().create_task(self.answer(writer, lock, request_id, points, slots))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+      if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+    except (ConnectionError, asyncio.IncompleteReadError):
+      pass
+    finally:
+      for task in tasks:
+        task.cancel()
+      writer.close()
+
+async def serve(args):
+  from cpu_runner import CPURunner
+  from voxelizer import read_params_header
+  params = read_params_header(args.params)
+  runners = [CPURunner(args.model, params, args.intra_op_threads, 1, args.nms_pre_max_size) for _ in range(args.sessions)]
+  max_batch = args.max_batch or runners[0].batch_size
+  batcher = MicroBatcher(runners, max_batch, args.max_wait_ms, args.queue_size)
+  service = DetectionService(batcher, params.get('num_point_values', 4), args.max_inflight)
+
+  if args.port is not None:
+    server = await asyncio.start_server(service.handle, '127.0.0.1', args.port)
+    where = '127.0.0.1:%d' % args.port
+  else:
+    if os.path.exists(args.socket):
+      os.remove(args.socket)
+    server = await asyncio.start_unix_server(service.handle, args.socket)
+    where = args.socket
+  print('Serving %s on %s: %d sessions x %d threads, batches of up to %d frames within %.1f ms, queue %d' % (
+      os.path.basename(args.model), where, args.sessions, args.intra_op_threads, max_batch, args.max_wait_ms, args.queue_size))
+
+  batching = asyncio.get_running_loop().create_task(batcher.run())
+  start = time.time()
+  try:
+    async with server:
+      await server.serve_forever()
+  finally:
+    batching.cancel()
+    batcher.executor.shutdown(wait=False)
+    stats = batcher.stats
+    print('%d requests in %d batches (%.2f frames per batch) over %.1f s' % (
+        stats['requests'], stats['batches'], stats['batch_frames'] / max(stats['batches'], 1), time.time() - start))
+
+def parse_config():
+  parser = argparse.ArgumentParser(description='serve pointpillar.onnx detections on a local socket with micro-batching')
+  parser.add_argument('--model', type=str, default='../model/pointpillar.onnx', help='final graph written by the exporter')
+  parser.add_argument('--params', type=str, default='../include/params.h', help='params.h written with the graph')
+  parser.add_argument('--socket', type=str, default=DEFAULT_SOCKET, help='unix socket to listen on')
+  parser.add_argument('--port', type=int, default=None, help='listen on this localhost TCP port instead')
+  parser.add_argument('--sessions', type=int, default=2, help='ORT sessions, i.e. batches that run at the same time')
+  parser.add_argument('--intra_op_threads', type=int, default=2, help='threads per session')
+  parser.add_argument('--max_batch', type=int, default=None, help='frames per micro-batch, defaults to the graph batch size')
+  parser.add_argument('--max_wait_ms', type=float, default=5.0, help='longest a batch waits for more frames after its first')
+  parser.add_argument('--queue_size', type=int, default=64, help='queued requests before connections stop being read')
+  parser.add_argument('--max_inflight', type=int, default=8, help='unanswered requests read per connection')
+  parser.add_argument('--nms_pre_max_size', type=int, default=None)
+
+  args = parser.parse_args()
+  return args
+
+def main():
+  args = parse_config()
+  try:
+    asyncio.run(serve(args))
+  except KeyboardInterrupt:
+    pass
+
+if __name__ == '__main__':
+  main()
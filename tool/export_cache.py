@@ -0,0 +1,156 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import shutil
+import hashlib
+import importlib
+import importlib.metadata
+
+# sources whose content changes the produced graphs or params.h
+TOOL_SOURCES = ['exporter.py', 'exporter_paramters.py', 'simplifier_onnx.py', 'graph_rewriter.py', 'model_bundle.py',
+                'precision.py', 'weight_swap.py']
+
+# weights of a graph saved with external data, see exporter.save_graph
+EXTERNAL_DATA_SUFFIX = '.data'
+
+# packages whose version changes the produced graphs, with their distribution names
+TOOL_PACKAGES = {
+  'torch': ['torch'],
+  'onnx': ['onnx'],
+  'onnxsim': ['onnxsim', 'onnx-simplifier'],
+  'onnx_graphsurgeon': ['onnx_graphsurgeon', 'onnx-graphsurgeon'],
+  'pcdet': ['pcdet'],
+}
+
+def file_digest(path, chunk_size=1 << 20):
+  sha = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+      sha.update(chunk)
+  return sha.hexdigest()
+
+def cfg_digest(cfg):
+  # only the parts of the resolved config that reach the exported model,
+  # ROOT_DIR / LOCAL_RANK differ between machines but not between graphs
+  resolved = {k: cfg[k] for k in ('CLASS_NAMES', 'DATA_CONFIG', 'MODEL') if k in cfg}
+  blob = json.dumps(resolved, sort_keys=True, default=str)
+  return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+def package_version(name, distributions):
+  # read the installed metadata first, importing torch/pcdet only for a version costs seconds
+  for distribution in distributions:
+    try:
+      return importlib.metadata.version(distribution)
+    except importlib.metadata.PackageNotFoundError:
+      pass
+  try:
+    return str(getattr(importlib.import_module(name), '__version__', 'unknown'))
+  except ImportError:
+    return 'missing'
+
+def tool_versions():
+  versions = dict()
+  for name, distributions in TOOL_PACKAGES.items():
+    versions[name] = package_version(name, distributions)
+
+  tool_dir = os.path.dirname(os.path.abspath(__file__))
+  for name in TOOL_SOURCES:
+    path = os.path.join(tool_dir, name)
+    if os.path.exists(path):
+      versions[name] = file_digest(path)
+  return versions
+
+class ExportCache(object):
+  """
+  Content-addressed store for the intermediate artifacts of the export pipeline.
+
+  Every artifact lives in <cache_dir>/<stage>/<key>/<filename>, where key is a
+  digest of everything the stage depends on (usually the key of the previous
+  stage plus the stage's own arguments). A stage whose key is already present
+  is skipped; entries are committed atomically so an interrupted export never
+  leaves a half-written artifact behind.
+  """
+  def __init__(self, cache_dir, enabled=True):
+    self.cache_dir = cache_dir
+    self.enabled = enabled and cache_dir is not None
+    self.hits = []
+    self.misses = []
+
+  @staticmethod
+  def key(*parts):
+    blob = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+  def entry(self, stage, key, filename):
+    return os.path.join(self.cache_dir, stage, key, filename)
+
+  def has(self, stage, key, filename):
+    # like lookup, without counting a hit or a miss
+    return self.enabled and os.path.exists(self.entry(stage, key, filename))
+
+  def lookup(self, stage, key, filename):
+    if not self.enabled:
+      return None
+    path = self.entry(stage, key, filename)
+    if os.path.exists(path):
+      self.hits.append(stage)
+      return path
+    self.misses.append(stage)
+    return None
+
+  def store(self, stage, key, src_path):
+    if not self.enabled:
+      return src_path
+    dst_path = self.entry(stage, key, os.path.basename(src_path))
+    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+    # the external-data sidecar goes first, an entry is complete once its graph exists
+    for src, dst in ((src_path + EXTERNAL_DATA_SUFFIX, dst_path + EXTERNAL_DATA_SUFFIX), (src_path, dst_path)):
+      if os.path.exists(src):
+        tmp_path = dst + '.tmp.%d' % os.getpid()
+        shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, dst)
+    return dst_path
+
+  @staticmethod
+  def remove_sidecar(path):
+    # a sidecar left by an earlier run would otherwise be taken for this artifact's
+    if os.path.exists(path + EXTERNAL_DATA_SUFFIX):
+      os.remove(path + EXTERNAL_DATA_SUFFIX)
+
+  def run(self, stage, key, filename, output_dir, producer):
+    """
+    Materialize <output_dir>/<filename> for the given stage.
+
+    producer(path) is only called on a cache miss and must write the
+    artifact to path. Returns the path inside output_dir.
+    """
+    out_path = os.path.join(output_dir, filename)
+    cached = self.lookup(stage, key, filename)
+    if cached is not None:
+      print('[cache] %s: hit %s' % (stage, key[:12]))
+      if os.path.abspath(cached) != os.path.abspath(out_path):
+        self.remove_sidecar(out_path)
+        if os.path.exists(cached + EXTERNAL_DATA_SUFFIX):
+          shutil.copyfile(cached + EXTERNAL_DATA_SUFFIX, out_path + EXTERNAL_DATA_SUFFIX)
+        shutil.copyfile(cached, out_path)
+      return out_path
+
+    print('[cache] %s: miss %s' % (stage, key[:12]) if self.enabled else '[cache] %s: disabled' % stage)
+    self.remove_sidecar(out_path)
+    producer(out_path)
+    self.store(stage, key, out_path)
+    return out_path
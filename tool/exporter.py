@@ -13,61 +13,168 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import glob
-import onnx
-import torch
+import time
+_START = time.time()
+
+import json
+import logging
 import argparse
+import contextlib
 import numpy as np
 import os
 from pathlib import Path
-from onnxsim import simplify
-from pcdet.utils import common_utils
-from pcdet.models import build_network
-from pcdet.datasets import DatasetTemplate
 from pcdet.config import cfg, cfg_from_yaml_file
 
 from exporter_paramters import export_paramters as export_paramters
-from simplifier_onnx import simplify_preprocess, simplify_postprocess
-from pcdet.models import build_network, load_data_to_gpu
-
-class DemoDataset(DatasetTemplate):
-    def __init__(self, dataset_cfg, class_names, training=True, root_path=None, logger=None, ext='.bin'):
-        """
-        Args:
-            root_path:
-            dataset_cfg:
-            class_names:
-            training:
-            logger:
-        """
-        super().__init__(
-            dataset_cfg=dataset_cfg, class_names=class_names, training=training, root_path=root_path, logger=logger
-        )
-        self.root_path = root_path
-        self.ext = ext
-        data_file_list = glob.glob(str(root_path / f'*{self.ext}')) if self.root_path.is_dir() else [self.root_path]
-
-        data_file_list.sort()
-        self.sample_file_list = data_file_list
-
-    def __len__(self):
-        return len(self.sample_file_list)
-
-    def __getitem__(self, index):
-        if self.ext == '.bin':
-            points = np.fromfile(self.sample_file_list[index], dtype=np.float32).reshape(-1, 4)
-        elif self.ext == '.npy':
-            points = np.load(self.sample_file_list[index])
-        else:
-            raise NotImplementedError
-
-        input_dict = {
-            'points': points,
-            'frame_id': index,
-        }
-
-        data_dict = self.prepare_data(data_dict=input_dict)
-        return data_dict
+from exporter_paramters import collect_paramters
+from export_cache import ExportCache, EXTERNAL_DATA_SUFFIX, cfg_digest, file_digest, tool_versions
+from memory_usage import StageMemory
+from precision import VARIANTS
+from graph_rewriter import FUSION_PASS_NAMES
+
+# torch, onnx, onnxsim, onnx_graphsurgeon and the pcdet models/datasets are
+# imported by the stages that need them, a fully cached export never loads torch
+
+def create_logger():
+    # same format as pcdet.utils.common_utils.create_logger, which would import torch
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.INFO)
+    if not logger.handlers:
+      console = logging.StreamHandler()
+      console.setFormatter(logging.Formatter('%(asctime)s  %(levelname)5s  %(message)s'))
+      logger.addHandler(console)
+    logger.propagate = False
+    return logger
+
+class PhaseTimer(object):
+    """
+    Wall time per startup/export phase, measured from module import.
+    """
+    def __init__(self, logger):
+        self.logger = logger
+        self.phases = [('imports', time.time() - _START)]
+        self.first_stage = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        yield
+        self.phases.append((name, time.time() - start))
+        self.logger.info('[time] %-24s %8.3f s' % (name, self.phases[-1][1]))
+
+    def stage_started(self):
+        if self.first_stage is None:
+          self.first_stage = time.time() - _START
+
+    def report(self):
+        for name, seconds in self.phases:
+          self.logger.info('[time] %-24s %8.3f s' % (name, seconds))
+        if self.first_stage is not None:
+          self.logger.info('[time] %-24s %8.3f s' % ('start -> first stage', self.first_stage))
+        self.logger.info('[time] %-24s %8.3f s' % ('total', time.time() - _START))
+
+@contextlib.contextmanager
+def cuda_as_cpu():
+    """
+    pcdet's AnchorHeadTemplate moves its anchors with .cuda() while the network
+    is built, which fails without CUDA. Keep them on the CPU instead.
+    """
+    import torch
+    cuda = torch.Tensor.cuda
+    torch.Tensor.cuda = lambda self, *args, **kwargs: self
+    try:
+      yield
+    finally:
+      torch.Tensor.cuda = cuda
+
+def resolve_device(device):
+    if device == 'auto':
+      import torch
+      return 'cuda' if torch.cuda.is_available() else 'cpu'
+    return device
+
+class Lazy(object):
+    """
+    Builds each named object on first use, e.g. lazy.model().
+    """
+    def __init__(self, **factories):
+        self._factories = factories
+        self._objects = dict()
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self._factories:
+            raise AttributeError(name)
+        def get():
+            if name not in self._objects:
+                self._objects[name] = self._factories[name]()
+            return self._objects[name]
+        return get
+
+    def release(self, name):
+        # the next get() builds the object again
+        self._objects.pop(name, None)
+
+def save_graph(model, path, external_data=False):
+    import onnx
+    if external_data:
+      # weights go to <path>.data tensor by tensor instead of through one serialized copy of the model
+      onnx.save(model, path, save_as_external_data=True, all_tensors_to_one_file=True,
+                location=os.path.basename(path) + EXTERNAL_DATA_SUFFIX, size_threshold=1024)
+    else:
+      onnx.save(model, path)
+
+def load_graph(source):
+    # a stage is handed the previous model itself or the file it was written to
+    import onnx
+    return onnx.load(source) if isinstance(source, str) else source
+
+class StageChain(object):
+    """
+    The graph stages of one bucket, each produced from the one before it by
+    produce(source, path), which writes the stage to path and returns the
+    model. Only the stages after the newest cached one run. The next stage
+    gets the model in memory (handoff='memory') or reloads it from its file
+    (handoff='file'), and nothing holds on to older models, so at most the
+    input and the output of one stage are alive at a time.
+    """
+    def __init__(self, cache, output_dir, memory, handoff='file', external_data=False):
+        self.cache = cache
+        self.output_dir = output_dir
+        self.memory = memory
+        # a graph saved with external data lost its weights in memory, the next stage reloads it
+        self.in_memory = handoff == 'memory' and not external_data
+        self.stages = []
+        self.paths = dict()
+
+    def add(self, name, key, filename, produce):
+        self.stages.append((name, key, filename, produce))
+
+    def path(self, name):
+        if name in self.paths:
+          return self.paths[name]
+        end = [stage[0] for stage in self.stages].index(name)
+        start = 0
+        for i in range(end, -1, -1):
+          stage, key, filename, _ = self.stages[i]
+          if stage in self.paths or self.cache.has(stage, key, filename):
+            start = i
+            break
+
+        source = None
+        for stage, key, filename, produce in self.stages[start:end + 1]:
+          if stage in self.paths:
+            source = self.paths[stage]
+            continue
+          produced = []
+          def producer(path, produce=produce, source=source):
+            model = produce(source, path)
+            if self.in_memory and model is not None:
+              produced.append(model)
+          with self.memory.stage(stage):
+            self.paths[stage] = self.cache.run(stage, key, filename, self.output_dir, producer)
+          del producer
+          source = produced.pop() if produced else self.paths[stage]
+        return self.paths[name]
 
 def parse_config():
     parser = argparse.ArgumentParser(description='arg parser')
@@ -77,69 +184,162 @@ def parse_config():
                         help='specify the point cloud data file or directory')
     parser.add_argument('--ckpt', type=str, default=None, help='specify the pretrained model')
     parser.add_argument('--ext', type=str, default='.bin', help='specify the extension of your point cloud data file')
+    parser.add_argument('--output_dir', type=str, default=os.path.join(os.getcwd(), 'CUDA-PointPillars', 'model_custom'),
+                        help='directory receiving the onnx models and params.h')
+    parser.add_argument('--cache_dir', type=str, default=os.path.join(os.path.expanduser('~'), '.cache', 'cuda-pointpillars', 'export'),
+                        help='content-addressed cache for the intermediate export artifacts')
+    parser.add_argument('--no_cache', action='store_true', default=False, help='rerun every export stage from scratch')
+    parser.add_argument('--max_voxels', type=int, nargs='+', default=None,
+                        help='export one graph + params.h per MAX_VOXELS bucket, e.g. 5000 10000 20000 40000')
+    parser.add_argument('--batch_size', type=int, default=1,
+                        help='number of frames per inference, the graph takes BATCH_SIZE*MAX_VOXELS pillars')
+    parser.add_argument('--topk', type=int, default=None,
+                        help='threshold scores in the graph and only output the TOPK best candidates instead of the dense heads')
+    parser.add_argument('--roi', type=float, nargs=4, default=None, metavar=('X_MIN', 'Y_MIN', 'X_MAX', 'Y_MAX'),
+                        help='export for a reduced point cloud range, the BEV grid shrinks and the trained weights are reused')
+    parser.add_argument('--classes', type=str, nargs='+', default=None,
+                        help='only export the head channels, anchors and params of these classes, e.g. Car')
+    parser.add_argument('--scatter', type=str, default='plugin', choices=['plugin', 'onnx'],
+                        help='pillar scatter as the TensorRT PPScatterPlugin or as standard onnx ops runnable by any runtime')
+    parser.add_argument('--fusion_passes', type=str, nargs='*', default=None, choices=FUSION_PASS_NAMES,
+                        help='fusion passes run on the final graph, default: all but drop_output_transpose; pass no names to disable fusion')
+    parser.add_argument('--variants', type=str, nargs='+', default=[], choices=VARIANTS,
+                        help='also write lower precision variants of pointpillar.onnx, each gated against fp32 on --variant_data')
+    parser.add_argument('--variant_data', type=str, default='../data', help='point clouds the precision variants are gated on')
+    parser.add_argument('--variant_frames', type=int, default=None, help='gate on at most this many frames')
+    parser.add_argument('--score_tol', type=float, default=0.05, help='max sigmoid score deviation of an accepted variant')
+    parser.add_argument('--box_tol', type=float, default=0.1, help='max box regression deviation of an accepted variant')
+    parser.add_argument('--swap_ckpts', type=str, nargs='+', default=[],
+                        help='checkpoints (or directories of *.pth) of the same architecture, exported by swapping the weights of the --ckpt graph')
+    parser.add_argument('--swap_tol', type=float, default=None,
+                        help='accept swap recipes that are not bit-exact up to this absolute weight error, recorded in the manifest')
+    parser.add_argument('--split_stages', action='store_true', default=False,
+                        help='also write the final graph as chained pfn / backbone / head sub-graphs for pipelined execution')
+    parser.add_argument('--session_artifacts', action='store_true', default=False,
+                        help='save pre-optimized ONNX Runtime sessions of every bucket and warm them up (needs --scatter onnx)')
+    parser.add_argument('--ort_threads', type=int, nargs='+', default=[0],
+                        help='intra-op thread counts to build --session_artifacts for, 0 lets ORT decide')
+    parser.add_argument('--handoff', type=str, default='file', choices=['file', 'memory'],
+                        help='stages reload the previous graph from its file (lower peak memory) or get it in memory')
+    parser.add_argument('--external_data', action='store_true', default=False,
+                        help='save the intermediate graphs with their weights in a .data file next to them')
+    parser.add_argument('--device', type=str, default='auto', choices=['auto', 'cuda', 'cpu'],
+                        help='device the network is built and traced on, auto picks cuda when available')
+    parser.add_argument('--check_parity', action='store_true', default=False,
+                        help='compare the trimmed onnx graphs against the PyTorch heads on ONNX Runtime CPU and profile them')
+    parser.add_argument('--profile_iters', type=int, default=10, help='ORT profiling iterations for --check_parity, 0 to skip')
 
     args = parser.parse_args()
+    if args.session_artifacts and args.scatter != 'onnx':
+      # warm_buckets skips every PPScatterPlugin bucket, nothing would be written
+      parser.error('--session_artifacts needs --scatter onnx, PPScatterPlugin graphs only run in TensorRT')
 
     cfg_from_yaml_file(args.cfg_file, cfg)
+    unknown = [name for name in args.classes or [] if name not in cfg.CLASS_NAMES]
+    duplicates = sorted(set(name for name in args.classes or [] if args.classes.count(name) > 1))
+    if unknown or duplicates:
+      parser.error('--classes: unknown %s, duplicated %s, the config has %s' % (unknown, duplicates, list(cfg.CLASS_NAMES)))
 
     return args, cfg
 
-def main():
-    args, cfg = parse_config()
-    export_paramters(cfg)
-    logger = common_utils.create_logger()
-    logger.info('------ Convert OpenPCDet model for TensorRT ------')
-    demo_dataset = DemoDataset(
-        dataset_cfg=cfg.DATA_CONFIG, class_names=cfg.CLASS_NAMES, training=False,
-        root_path=Path(args.data_path), ext=args.ext, logger=logger
-    )
+def specialize_range(cfg, roi):
+    """
+    Replaces the x/y extent of POINT_CLOUD_RANGE with the roi, snapped outwards
+    to the training voxel lattice and to a multiple of the backbone's total
+    stride so the upsampled feature maps still line up. z is kept, it is a
+    single pillar. The convolutions are translation invariant and the anchors
+    are generated from the range, so the trained weights apply unchanged.
+    """
+    for item in cfg.DATA_CONFIG.DATA_PROCESSOR:
+      if item.NAME == "transform_points_to_voxels":
+        VOXEL_SIZE = item.VOXEL_SIZE
+    STRIDE = int(np.prod(cfg.MODEL.BACKBONE_2D.LAYER_STRIDES))
 
-    model = build_network(model_cfg=cfg.MODEL, num_class=len(cfg.CLASS_NAMES), dataset=demo_dataset)
-    model.load_params_from_file(filename=args.ckpt, logger=logger, to_cpu=True)
-    model.cuda()
-    model.eval()
-    np.set_printoptions(threshold=np.inf)
-    with torch.no_grad():
+    POINT_CLOUD_RANGE = list(cfg.DATA_CONFIG.POINT_CLOUD_RANGE)
+    for axis, (lo, hi) in enumerate(((roi[0], roi[2]), (roi[1], roi[3]))):
+      assert hi > lo, 'empty roi along axis %d' % axis
+      size = VOXEL_SIZE[axis]
+      origin = POINT_CLOUD_RANGE[axis]
+      range_min = round(origin + np.floor((lo - origin) / size + 1e-6) * size, 6)
+      cells = int(np.ceil((hi - range_min) / size / STRIDE - 1e-6)) * STRIDE
+      range_max = round(range_min + cells * size, 6)
+      # params.h and the plugin derive the grid in float32 with truncation, nudge
+      # the upper bound until that agrees with the intended number of cells
+      while int((np.float32(range_max) - np.float32(range_min)) / np.float32(size)) < cells:
+        range_max = float(np.nextafter(np.float32(range_max), np.float32(np.inf)))
+      POINT_CLOUD_RANGE[axis], POINT_CLOUD_RANGE[axis + 3] = float(range_min), float(range_max)
 
-      MAX_VOXELS = 10000
-      NUMBER_OF_CLASSES = len(cfg.CLASS_NAMES)
+    cfg.DATA_CONFIG.POINT_CLOUD_RANGE = POINT_CLOUD_RANGE
+    return POINT_CLOUD_RANGE
 
-      MAX_POINTS_PER_VOXEL = None
+def parse_model_dims(cfg):
+    MAX_POINTS_PER_VOXEL = None
 
-      DATA_PROCESSOR = cfg.DATA_CONFIG.DATA_PROCESSOR
-      POINT_CLOUD_RANGE = cfg.DATA_CONFIG.POINT_CLOUD_RANGE
-      for i in DATA_PROCESSOR:
-        if i['NAME'] == "transform_points_to_voxels":
-            MAX_POINTS_PER_VOXEL = i['MAX_POINTS_PER_VOXEL']
-            VOXEL_SIZES = i['VOXEL_SIZE']
-            break
+    DATA_PROCESSOR = cfg.DATA_CONFIG.DATA_PROCESSOR
+    POINT_CLOUD_RANGE = cfg.DATA_CONFIG.POINT_CLOUD_RANGE
+    for i in DATA_PROCESSOR:
+      if i['NAME'] == "transform_points_to_voxels":
+          MAX_POINTS_PER_VOXEL = i['MAX_POINTS_PER_VOXEL']
+          VOXEL_SIZES = i['VOXEL_SIZE']
+          break
+
+    if MAX_POINTS_PER_VOXEL == None:
+      return None
 
+    VOXEL_SIZE_X = round(abs(POINT_CLOUD_RANGE[0] - POINT_CLOUD_RANGE[3]) / VOXEL_SIZES[0])
+    VOXEL_SIZE_Y = round(abs(POINT_CLOUD_RANGE[1] - POINT_CLOUD_RANGE[4]) / VOXEL_SIZES[1])
 
-      if MAX_POINTS_PER_VOXEL == None:
-        logger.info('Could Not Parse Config... Exiting')
-        import sys
-        sys.exit()
+    FEATURE_SIZE_X = VOXEL_SIZE_X / 2 #Is this number of bins? 
+    FEATURE_SIZE_Y = VOXEL_SIZE_Y / 2
 
-      VOXEL_SIZE_X = abs(POINT_CLOUD_RANGE[0] - POINT_CLOUD_RANGE[3]) / VOXEL_SIZES[0]
-      VOXEL_SIZE_Y = abs(POINT_CLOUD_RANGE[1] - POINT_CLOUD_RANGE[4]) / VOXEL_SIZES[1]
-    
-      FEATURE_SIZE_X = VOXEL_SIZE_X / 2 #Is this number of bins? 
-      FEATURE_SIZE_Y = VOXEL_SIZE_Y / 2
+    return dict(
+        NUMBER_OF_CLASSES=len(cfg.CLASS_NAMES),
+        MAX_POINTS_PER_VOXEL=MAX_POINTS_PER_VOXEL,
+        VOXEL_SIZE_X=VOXEL_SIZE_X,
+        VOXEL_SIZE_Y=VOXEL_SIZE_Y,
+        FEATURE_SIZE_X=FEATURE_SIZE_X,
+        FEATURE_SIZE_Y=FEATURE_SIZE_Y,
+    )
 
+def build_dataset(args, cfg, logger, data_path=None):
+    from demo_dataset import DemoDataset
+    return DemoDataset(
+        dataset_cfg=cfg.DATA_CONFIG, class_names=cfg.CLASS_NAMES, training=False,
+        root_path=Path(data_path or args.data_path), ext=args.ext, logger=logger
+    )
+
+def build_model(args, cfg, logger, demo_dataset):
+    from pcdet.models import build_network
+    args.device = resolve_device(args.device)
+    logger.info('Building the network on %s' % args.device)
+    with cuda_as_cpu() if args.device == 'cpu' else contextlib.nullcontext():
+      model = build_network(model_cfg=cfg.MODEL, num_class=len(cfg.CLASS_NAMES), dataset=demo_dataset)
+    model.load_params_from_file(filename=args.ckpt, logger=logger, to_cpu=True)
+    if args.device == 'cuda':
+      model.cuda()
+    model.eval()
+    return model
+
+def export_raw_onnx(model, output_path, MAX_VOXELS, MAX_POINTS_PER_VOXEL, BATCH_SIZE=1):
+    import torch
+    device = next(model.parameters()).device
+    with torch.no_grad():
       dummy_voxels = torch.zeros(
-          (MAX_VOXELS, MAX_POINTS_PER_VOXEL, 4),
+          (BATCH_SIZE*MAX_VOXELS, MAX_POINTS_PER_VOXEL, 4),
           dtype=torch.float32,
-          device='cuda:0')
+          device=device)
 
       dummy_voxel_idxs = torch.zeros(
-          (MAX_VOXELS, 4),
+          (BATCH_SIZE*MAX_VOXELS, 4),
           dtype=torch.int32,
-          device='cuda:0')
+          device=device)
+      # column 0 is the frame id, the scatter derives the batch size from it
+      dummy_voxel_idxs[:, 0] = torch.arange(BATCH_SIZE*MAX_VOXELS, device=device) // MAX_VOXELS
 
       dummy_voxel_num = torch.zeros(
           (1),
           dtype=torch.int32,
-          device='cuda:0')
+          device=device)
 
       #dummy_input = dict()
       #dummy_input['voxels'] = dummy_voxels
@@ -152,14 +352,12 @@ def main():
           'voxels': dummy_voxels,
           'voxel_num_points': dummy_voxel_num,
           'voxel_coords': dummy_voxel_idxs,
-          'batch_size': torch.tensor(1)
+          'batch_size': torch.tensor(BATCH_SIZE)
       }
 
-      base_dir = os.getcwd()
-
       torch.onnx.export(model,       # model being run
           dummy_input,               # model input (or a tuple for multiple inputs)
-          os.path.join(base_dir, 'CUDA-PointPillars', 'model_custom', 'pointpillar_raw.onnx'),  # where to save the model (can be a file or file-like object)
+          output_path,               # where to save the model (can be a file or file-like object)
           export_params=True,        # store the trained parameter weights inside the model file
           opset_version=11,          # the ONNX version to export the model to
           do_constant_folding=True,  # whether to execute constant folding for optimization
@@ -168,16 +366,397 @@ def main():
           output_names = ['cls_preds', 'box_preds', 'dir_cls_preds'], # the model's output names
           )
 
-      onnx_raw = onnx.load(os.path.join(base_dir, 'CUDA-PointPillars', 'model_custom', 'pointpillar_raw.onnx'))  # load onnx model
-      onnx_trim_post = simplify_postprocess(onnx_raw, FEATURE_SIZE_X, FEATURE_SIZE_Y, NUMBER_OF_CLASSES)
-      
+def bucket_manifest(params, dims, MAX_VOXELS, model_file, params_file, bundle_file, BATCH_SIZE=1, TOPK=None, fusion=None, SCATTER='plugin',
+                    variants=None):
+    # classes of the exported head, fewer than the config's for --classes
+    NUMBER_OF_CLASSES = params['num_classes']
+    FEATURE_SIZE_X, FEATURE_SIZE_Y = int(dims['FEATURE_SIZE_X']), int(dims['FEATURE_SIZE_Y'])
+    if TOPK is None:
+      outputs = {
+          'cls_preds': [BATCH_SIZE, FEATURE_SIZE_Y, FEATURE_SIZE_X, 2*NUMBER_OF_CLASSES*NUMBER_OF_CLASSES],
+          'box_preds': [BATCH_SIZE, FEATURE_SIZE_Y, FEATURE_SIZE_X, 14*NUMBER_OF_CLASSES],
+          'dir_cls_preds': [BATCH_SIZE, FEATURE_SIZE_Y, FEATURE_SIZE_X, 4*NUMBER_OF_CLASSES],
+      }
+      if fusion is not None and fusion['layout'] == 'NCHW':
+        outputs = {name: [shape[0], shape[3], shape[1], shape[2]] for name, shape in outputs.items()}
+    else:
+      # anchor_idxs index the (y, x, anchor) flattened head, see simplifier_onnx.append_topk
+      outputs = {
+          'scores': [BATCH_SIZE, TOPK],
+          'labels': [BATCH_SIZE, TOPK],
+          'anchor_idxs': [BATCH_SIZE, TOPK],
+          'box_deltas': [BATCH_SIZE, TOPK, 7],
+          'dir_bins': [BATCH_SIZE, TOPK],
+          'num_candidates': [BATCH_SIZE],
+      }
+    return {
+        'max_voxels': MAX_VOXELS,
+        'batch_size': BATCH_SIZE,
+        'model': model_file,
+        'params': params_file,
+        'bundle': bundle_file,
+        'scatter': SCATTER,
+        'variants': variants or dict(),
+        'inputs': {
+            'voxels': [BATCH_SIZE*MAX_VOXELS, dims['MAX_POINTS_PER_VOXEL'], 10],
+            'voxel_idxs': [BATCH_SIZE*MAX_VOXELS, 4],
+            'voxel_num': [1],
+        },
+        'outputs': outputs,
+        'layout': fusion['layout'] if fusion is not None else 'NHWC',
+        'fusion': fusion,
+        'params_constants': {
+            'MAX_VOXELS': params['MAX_VOXELS'],
+            'batch_size': params['batch_size'],
+            'max_num_pillars': params['MAX_VOXELS'],
+            'pillarPoints_bev': params['max_num_points_per_pillar'] * params['MAX_VOXELS'],
+            'grid_x_size': params['grid_x_size'],
+            'grid_y_size': params['grid_y_size'],
+            'feature_x_size': params['feature_x_size'],
+            'feature_y_size': params['feature_y_size'],
+        },
+    }
+
+def export_variants(args, cache, lazy, params, MAX_VOXELS, suffix, model_path, versions, final_key, get_simp=None):
+    """
+    Writes the --variants of the final graph and gates them on ORT CPU against
+    fp32. A final graph with the PPScatterPlugin runs there through the python
+    op of cpu_runner, which needs onnxruntime-extensions. Without it get_simp
+    provides the simplified graph, which gets the same conversion and is gated
+    as a proxy; the report and the manifest then say so. Rejected variants
+    are removed again. Returns the accepted variant files by name and how
+    they were gated.
+    """
+    import onnx
+    from onnx_parity import pack_frames, create_session
+    from precision import convert_variant, gate_variants, write_report, format_report
+
+    def produce(source, name):
+      return lambda path: onnx.save(convert_variant(onnx.load(source), name), path)
+
+    files, gate_files = dict(), dict()
+    for name in args.variants:
+      key = cache.key('variant', final_key, name, versions['precision.py'])
+      files[name] = cache.run('variant', key, 'pointpillar%s_%s.onnx' % (suffix, name), args.output_dir, produce(model_path, name))
+    proxy = False
+    if get_simp is not None:
+      try:
+        import onnxruntime_extensions
+        from cpu_runner import create_session
+        get_simp = None
+      except ImportError:
+        print('[WARN] onnxruntime-extensions is missing, the variants are gated on pointpillar_simp conversions as a proxy')
+    if get_simp is None:
+      gate_reference, gate_files = model_path, files
+    else:
+      proxy = True
+      simp_key, gate_reference = get_simp()
+      for name in args.variants:
+        key = cache.key('variant', simp_key, name, versions['precision.py'])
+        gate_files[name] = cache.run('variant', key, 'pointpillar_simp%s_%s.onnx' % (suffix, name), args.output_dir,
+                                     produce(gate_reference, name))
+
+    dataset = lazy.gate_dataset()
+    count = len(dataset) if args.variant_frames is None else min(len(dataset), args.variant_frames)
+    BATCH_SIZE = params['batch_size']
+    frames_inputs = (pack_frames([dataset[j] for j in range(i, min(i + BATCH_SIZE, count))], MAX_VOXELS, params)
+                     for i in range(0, count, BATCH_SIZE))
+    results = gate_variants(gate_reference, gate_files, frames_inputs, args.score_tol, args.box_tol, create_session)
+
+    gate = {'gated_on': os.path.basename(gate_reference), 'proxy': proxy}
+    reference_bytes = os.path.getsize(model_path)
+    report = dict(gate, reference=os.path.basename(model_path), score_tol=args.score_tol, box_tol=args.box_tol, variants=dict())
+    accepted = dict()
+    for name, path in files.items():
+      size = os.path.getsize(path)
+      report['variants'][name] = dict(results[name], file=os.path.basename(path), size_bytes=size,
+                                      size_ratio=reference_bytes / float(size))
+      if proxy:
+        report['variants'][name]['gated_file'] = os.path.basename(gate_files[name])
+      if results[name]['accepted']:
+        accepted[name] = os.path.basename(path)
+      else:
+        os.remove(path)
+    for name, path in gate_files.items():
+      if path != files[name] and os.path.exists(path):
+        os.remove(path)
+
+    write_report(args.output_dir, 'precision_report%s.json' % suffix, report)
+    print(format_report(report))
+    return accepted, gate
+
+def export_swaps(args, cache, lazy, params, MAX_VOXELS, suffix, model_path, params_path, versions, final_key):
+    # graph surgery ran once for --ckpt, every other checkpoint only gets its initializers replaced
+    from weight_swap import expand_checkpoints, module_pairs, state_dict_arrays, derive_recipes, save_recipes, load_recipes, \
+        load_checkpoint, apply_recipes
+    from model_bundle import write_bundle
+    import shutil
+
+    def produce_recipes(path):
+      model = lazy.model()
+      save_recipes(derive_recipes(model_path, state_dict_arrays(model.state_dict()), module_pairs(model)), path)
+
+    recipes_key = cache.key('recipes', final_key, versions['weight_swap.py'])
+    swap = load_recipes(cache.run('recipes', recipes_key, 'pointpillar%s.swap.json' % suffix, args.output_dir, produce_recipes))
+    if swap['exact']:
+      print('weight swap: %d initializers, every recipe reproduces the template bit for bit' % len(swap['recipes']))
+    else:
+      inexact = [recipe['initializer'] for recipe in swap['recipes'] if not recipe['exact']]
+      message = 'weight swap: %d of %d recipes deviate from the template by up to %g: %s' % (
+          len(inexact), len(swap['recipes']), swap['max_error'], inexact)
+      # swapped graphs must equal a full export unless a tolerance was asked for
+      if args.swap_tol is None or swap['max_error'] > args.swap_tol:
+        raise ValueError('%s, --swap_tol %s does not allow it' % (message, args.swap_tol))
+      print('%s, within --swap_tol %g' % (message, args.swap_tol))
+    accuracy = {'exact': swap['exact'], 'max_error': swap['max_error'], 'tolerance': None if swap['exact'] else args.swap_tol}
+
+    swaps = dict()
+    for stem, ckpt in expand_checkpoints(args.swap_ckpts):
+      swap_dir = os.path.join(args.output_dir, stem)
+      os.makedirs(swap_dir, exist_ok=True)
+      swap_key = cache.key('swap', recipes_key, file_digest(ckpt))
+      swap_path = cache.run('swap', swap_key, os.path.basename(model_path), swap_dir,
+                            lambda path: apply_recipes(model_path, swap, load_checkpoint(ckpt), path))
+      shutil.copyfile(params_path, os.path.join(swap_dir, os.path.basename(params_path)))
+      bundle_file = 'pointpillar%s.ppb' % suffix
+      cache.run('bundle', cache.key('bundle', swap_key, MAX_VOXELS, versions['model_bundle.py']), bundle_file, swap_dir,
+                lambda path: write_bundle(swap_path, dict(params, MAX_VOXELS=MAX_VOXELS), path))
+      swaps[stem] = dict(accuracy, checkpoint=os.path.abspath(ckpt), model=os.path.join(stem, os.path.basename(swap_path)),
+                         bundle=os.path.join(stem, bundle_file))
+      print('weight swap: %s -> %s' % (ckpt, swap_dir))
+    return swaps
+
+def export_stages(args, cache, dims, suffix, model_path, final_key):
+    # pfn / backbone / head sub-graphs of the final graph and the manifest chaining them
+    import onnx
+    from collections import OrderedDict
+    from simplifier_onnx import STAGES, split_stages, describe_stages
+
+    split = dict()
+    def produce(name):
+      def write(path):
+        if not split:
+          split.update(split_stages(onnx.load(model_path), dims['FEATURE_SIZE_X'], dims['FEATURE_SIZE_Y'], args.batch_size))
+        onnx.save(split[name], path)
+      return write
+
+    stage_models = OrderedDict()
+    for name in STAGES:
+      path = cache.run('split', cache.key('split', final_key, name), 'pointpillar%s_%s.onnx' % (suffix, name), args.output_dir, produce(name))
+      stage_models[name] = (os.path.basename(path), onnx.load(path, load_external_data=False))
+    manifest = describe_stages(stage_models)
+    with open(os.path.join(args.output_dir, 'pointpillar%s_stages.json' % suffix), 'w') as f:
+      json.dump(manifest, f, indent=2)
+    return manifest
+
+def export_bucket(args, cfg, cache, base, lazy, memory, dims, MAX_VOXELS, suffix='', params_voxels=None, release_model=False):
+    NUMBER_OF_CLASSES = dims['NUMBER_OF_CLASSES']
+    MAX_POINTS_PER_VOXEL = dims['MAX_POINTS_PER_VOXEL']
+    VOXEL_SIZE_X, VOXEL_SIZE_Y = dims['VOXEL_SIZE_X'], dims['VOXEL_SIZE_Y']
+    FEATURE_SIZE_X, FEATURE_SIZE_Y = dims['FEATURE_SIZE_X'], dims['FEATURE_SIZE_Y']
+    import onnx
+    BATCH_SIZE = args.batch_size
+    TOPK = args.topk
+    SCATTER = args.scatter
+    versions = base['versions']
+    CLASS_IDXS = [list(cfg.CLASS_NAMES).index(name) for name in args.classes] if args.classes else None
+    params = collect_paramters(cfg, params_voxels, BATCH_SIZE, args.classes)
+    SCORE_THRESH = params['score_thresh']
+
+    # every stage key chains the key of the stage feeding it, so a change
+    # only reruns the stages downstream of it
+    params_key = cache.key('params', base['cfg'], params_voxels, BATCH_SIZE, args.classes, versions['exporter_paramters.py'])
+    raw_key = cache.key('raw', base['ckpt'], base['cfg'], MAX_VOXELS, BATCH_SIZE,
+                        [versions[k] for k in ('torch', 'pcdet', 'exporter.py')])
+    trim_post_key = cache.key('trim_post', raw_key, FEATURE_SIZE_X, FEATURE_SIZE_Y, NUMBER_OF_CLASSES, BATCH_SIZE, TOPK, SCORE_THRESH, CLASS_IDXS,
+                              [versions[k] for k in ('onnx', 'onnx_graphsurgeon', 'simplifier_onnx.py', 'graph_rewriter.py')])
+    simp_key = cache.key('simp', trim_post_key, [versions[k] for k in ('onnx', 'onnxsim')])
+    final_key = cache.key('final', simp_key, VOXEL_SIZE_X, VOXEL_SIZE_Y, MAX_POINTS_PER_VOXEL, BATCH_SIZE, SCATTER, args.fusion_passes,
+                          [versions[k] for k in ('onnx', 'onnx_graphsurgeon', 'simplifier_onnx.py', 'graph_rewriter.py')])
+    bundle_key = cache.key('bundle', final_key, params_key, MAX_VOXELS, versions['model_bundle.py'])
+
+    params_file = 'params%s.h' % suffix
+    with memory.stage('params'):
+      params_path = cache.run('params', params_key, params_file, args.output_dir,
+                              lambda path: export_paramters(cfg, path, params_voxels, BATCH_SIZE, args.classes))
+
+    # each producer drops its input before saving, the chain hands the result to the next stage
+    def produce_raw(source, path):
+      export_raw_onnx(lazy.model(), path, MAX_VOXELS, MAX_POINTS_PER_VOXEL, BATCH_SIZE)
+      if release_model:
+        # no later stage of this run needs the network
+        lazy.release('model')
+
+    def produce_trim_post(source, path):
+      from simplifier_onnx import simplify_postprocess
+      onnx_raw = load_graph(source)  # load onnx model
+      onnx_trim_post = simplify_postprocess(onnx_raw, FEATURE_SIZE_X, FEATURE_SIZE_Y, NUMBER_OF_CLASSES, BATCH_SIZE, SCORE_THRESH, TOPK, CLASS_IDXS)
+      del onnx_raw
+      save_graph(onnx_trim_post, path, args.external_data)
+      return onnx_trim_post
+
+    def produce_simp(source, path):
+      from onnxsim import simplify
+      onnx_trim_post = load_graph(source)
       onnx_simp, check = simplify(onnx_trim_post)
       assert check, "Simplified ONNX model could not be validated"
+      del onnx_trim_post
+      save_graph(onnx_simp, path, args.external_data)
+      return onnx_simp
+
+    def produce_final(source, path):
+      from simplifier_onnx import simplify_preprocess, fuse_onnx
+      onnx_simp = load_graph(source)
+      onnx_final = simplify_preprocess(onnx_simp, VOXEL_SIZE_X, VOXEL_SIZE_Y, MAX_POINTS_PER_VOXEL, BATCH_SIZE, SCATTER)
+      del onnx_simp
+      onnx_final, _ = fuse_onnx(onnx_final, args.fusion_passes)
+      # the deliverable stays a single file
+      save_graph(onnx_final, path)
+      return onnx_final
+
+    model_file = 'pointpillar%s.onnx' % suffix
+    chain = StageChain(cache, args.output_dir, memory, args.handoff, args.external_data)
+    chain.add('raw', raw_key, 'pointpillar_raw%s.onnx' % suffix, produce_raw)
+    chain.add('trim_post', trim_post_key, 'pointpillar_trim_post%s.onnx' % suffix, produce_trim_post)
+    chain.add('simp', simp_key, 'pointpillar_simp%s.onnx' % suffix, produce_simp)
+    chain.add('final', final_key, model_file, produce_final)
+    model_path = chain.path('final')
+    # read back from the model so cache hits report the same numbers
+    from simplifier_onnx import fusion_report
+    fusion = fusion_report(onnx.load(model_path, load_external_data=False))
+
+    if SCATTER == 'onnx':
+      from onnx_parity import check_scatter
+      error = check_scatter([int(VOXEL_SIZE_X), int(VOXEL_SIZE_Y)], MAX_VOXELS, batch_size=BATCH_SIZE)
+      assert error == 0, 'standard-op scatter differs from PPScatterPlugin by %g' % error
+      print('standard-op scatter matches the PPScatterPlugin semantics')
+
+    # the bundle describes its own graph, so it carries the graph's MAX_VOXELS even where params.h does not
+    bundle_file = 'pointpillar%s.ppb' % suffix
+    def produce_bundle(path):
+      from model_bundle import write_bundle
+      write_bundle(model_path, dict(params, MAX_VOXELS=MAX_VOXELS), path)
+
+    with memory.stage('bundle'):
+      cache.run('bundle', bundle_key, bundle_file, args.output_dir, produce_bundle)
+
+    stages = None
+    if args.split_stages:
+      with memory.stage('split'):
+        stages = export_stages(args, cache, dims, suffix, model_path, final_key)
+
+    def get_simp():
+      return simp_key, chain.path('simp')
+
+    variants, variant_gate = dict(), None
+    if args.variants:
+      with memory.stage('variants'):
+        variants, variant_gate = export_variants(args, cache, lazy, params, MAX_VOXELS, suffix, model_path, versions, final_key,
+                                   None if SCATTER == 'onnx' else get_simp)
+
+    swaps = dict()
+    if args.swap_ckpts:
+      with memory.stage('weight swap'):
+        swaps = export_swaps(args, cache, lazy, params, MAX_VOXELS, suffix, model_path, params_path, versions, final_key)
+
+    if args.check_parity:
+      # a final graph with the PPScatterPlugin only runs in TensorRT, then the ORT check stops at the trimmed graphs
+      from onnx_parity import check_parity
+      graphs = {
+          'trim_post': chain.path('trim_post'),
+          'simp': chain.path('simp'),
+      }
+      if SCATTER == 'onnx':
+        graphs['final'] = model_path
+      dataset = lazy.dataset()
+      frames = [dataset[i % len(dataset)] for i in range(BATCH_SIZE)]
+      with memory.stage('parity'):
+        check_parity(lazy.model(), graphs, frames, MAX_VOXELS, args.output_dir, args.profile_iters,
+                     report_name='parity_report%s.json' % suffix, params=params if 'final' in graphs else None,
+                     class_idxs=CLASS_IDXS, score_thresh=SCORE_THRESH, topk=TOPK)
+
+    manifest = bucket_manifest(params, dims, MAX_VOXELS, model_file, params_file, bundle_file, BATCH_SIZE, TOPK, fusion, SCATTER,
+                               variants)
+    if variant_gate is not None:
+      manifest['variant_gate'] = variant_gate
+    if stages is not None:
+      manifest['stages'] = stages
+    if swaps:
+      manifest['swaps'] = swaps
+    return manifest
+
+def main():
+    logger = create_logger()
+    timer = PhaseTimer(logger)
+    with timer.phase('config'):
+      args, cfg = parse_config()
+    logger.info('------ Convert OpenPCDet model for TensorRT ------')
+    np.set_printoptions(threshold=np.inf)
+
+    if args.roi is not None:
+      logger.info('ROI export, POINT_CLOUD_RANGE -> %s' % specialize_range(cfg, args.roi))
+
+    dims = parse_model_dims(cfg)
+    if dims is None:
+      logger.info('Could Not Parse Config... Exiting')
+      import sys
+      sys.exit()
+    logger.info('BEV grid %d x %d, feature map %d x %d' % (dims['VOXEL_SIZE_X'], dims['VOXEL_SIZE_Y'],
+                                                         dims['FEATURE_SIZE_X'], dims['FEATURE_SIZE_Y']))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    cache = ExportCache(args.cache_dir, enabled=not args.no_cache)
+    with timer.phase('cache keys'):
+      base = dict(versions=tool_versions(), cfg=cfg_digest(cfg), ckpt=file_digest(args.ckpt))
+
+    def timed(name, factory):
+      def build():
+        with timer.phase(name):
+          return factory()
+      return build
+
+    # the dataset and the network are only built when a stage needs them
+    lazy = Lazy(
+        dataset=timed('dataset', lambda: build_dataset(args, cfg, logger)),
+        gate_dataset=timed('gate dataset', lambda: build_dataset(args, cfg, logger, args.variant_data)),
+        model=timed('network', lambda: build_model(args, cfg, logger, lazy.dataset())))
+
+    memory = StageMemory(logger)
+    # once the last raw graph is traced the network is only needed for parity and weight swap
+    keep_model = args.check_parity or bool(args.swap_ckpts)
+    timer.stage_started()
+
+    if args.max_voxels is None:
+      # legacy single export: 10k voxel graph, params.h sized from the config
+      buckets = [export_bucket(args, cfg, cache, base, lazy, memory, dims, 10000, release_model=not keep_model)]
+    else:
+      buckets = []
+      sizes = sorted(set(args.max_voxels))
+      for MAX_VOXELS in sizes:
+        logger.info('------ Export bucket MAX_VOXELS=%d ------' % MAX_VOXELS)
+        buckets.append(export_bucket(args, cfg, cache, base, lazy, memory, dims, MAX_VOXELS,
+                                     suffix='_v%d' % MAX_VOXELS, params_voxels=MAX_VOXELS,
+                                     release_model=not keep_model and MAX_VOXELS == sizes[-1]))
+
+    # runtime picks the first (smallest) bucket whose max_voxels covers the frame's pillar count
+    manifest_path = os.path.join(args.output_dir, 'pointpillar_buckets.json')
+    with open(manifest_path, 'w') as f:
+      json.dump({'selection': 'smallest max_voxels >= pillar count', 'buckets': buckets}, f, indent=2)
+    logger.info('Manifest written to %s' % manifest_path)
+
+    if args.session_artifacts:
+      from session_artifacts import warm_buckets
+      with memory.stage('session artifacts'):
+        for threads in args.ort_threads:
+          logger.info('------ Session artifacts, intra_op_threads=%d ------' % threads)
+          warm_buckets(manifest_path, intra_op_threads=threads)
 
-      onnx_final = simplify_preprocess(onnx_simp, VOXEL_SIZE_X, VOXEL_SIZE_Y, MAX_POINTS_PER_VOXEL)
-      onnx.save(onnx_final, os.path.join(base_dir, 'CUDA-PointPillars', 'model_custom', 'pointpillar.onnx'))
-      print('finished exporting onnx')
+    print('finished exporting onnx')
+    if cache.enabled:
+      logger.info('Export cache: hits %s, misses %s' % (cache.hits, cache.misses))
 
+    timer.report()
+    memory.report()
     logger.info('[PASS] ONNX EXPORTED.')
 
 if __name__ == '__main__':
@@ -1,6 +1,7 @@
 import numpy as np
 from pcdet.config import cfg
 import os
+import struct
 
 License = '''/*
  * SPDX-FileCopyrightText: Copyright (c) 2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
@@ -19,7 +20,7 @@ License = '''/*
  * limitations under the License.
  */'''
 
-def export_paramters(cfg):
+def collect_paramters(cfg, max_voxels=None, batch_size=1, class_names=None):
   CLASS_NAMES = []
   CLASS_NUM = 0
   rangMinX = 0
@@ -79,45 +80,118 @@ def export_paramters(cfg):
   SCORE_THRESH = cfg.MODEL.POST_PROCESSING.SCORE_THRESH
   NMS_THRESH = cfg.MODEL.POST_PROCESSING.NMS_CONFIG.NMS_THRESH
 
+  if max_voxels is not None:
+    MAX_NUMBER_OF_VOXELS = int(max_voxels)
+
+  if class_names is not None:
+    # class-pruned head, every class owns 2 anchors (8 values) and one bottom height
+    keep = [list(CLASS_NAMES).index(name) for name in class_names]
+    anchor_sizes = [value for k in keep for value in anchor_sizes[8*k:8*k + 8]]
+    anchor_bottom_heights = [anchor_bottom_heights[k] for k in keep]
+    CLASS_NAMES = [CLASS_NAMES[k] for k in keep]
+    CLASS_NUM = len(CLASS_NAMES)
+
+  # derived sizes are evaluated in float32 like the initializers in params.h
+  grid_x_size = int((np.float32(rangMaxX) - np.float32(rangMinX)) / np.float32(VOXEL_SIZE[0]))
+  grid_y_size = int((np.float32(rangMaxY) - np.float32(rangMinY)) / np.float32(VOXEL_SIZE[1]))
+  grid_z_size = int((np.float32(rangMaxZ) - np.float32(rangMinZ)) / np.float32(VOXEL_SIZE[2]))
+
+  return dict(
+    MAX_VOXELS=MAX_NUMBER_OF_VOXELS,
+    batch_size=int(batch_size),
+    num_classes=CLASS_NUM,
+    class_name=list(CLASS_NAMES),
+    min_x_range=float(rangMinX),
+    max_x_range=float(rangMaxX),
+    min_y_range=float(rangMinY),
+    max_y_range=float(rangMaxY),
+    min_z_range=float(rangMinZ),
+    max_z_range=float(rangMaxZ),
+    pillar_x_size=float(VOXEL_SIZE[0]),
+    pillar_y_size=float(VOXEL_SIZE[1]),
+    pillar_z_size=float(VOXEL_SIZE[2]),
+    max_num_points_per_pillar=int(MAX_POINTS_PER_VOXEL),
+    num_point_values=int(NUM_POINT_FEATURES),
+    num_feature_scatter=int(NUM_BEV_FEATURES),
+    dir_offset=float(DIR_OFFSET),
+    dir_limit_offset=float(DIR_LIMIT_OFFSET),
+    num_dir_bins=int(NUM_DIR_BINS),
+    num_anchors=CLASS_NUM * 2,
+    len_per_anchor=4,
+    anchors=[float(item) for item in anchor_sizes],
+    anchor_bottom_heights=[float(item) for item in anchor_bottom_heights],
+    score_thresh=float(SCORE_THRESH),
+    nms_thresh=float(NMS_THRESH),
+    num_box_values=7,
+    grid_x_size=grid_x_size,
+    grid_y_size=grid_y_size,
+    grid_z_size=grid_z_size,
+    feature_x_size=grid_x_size // 2,
+    feature_y_size=grid_y_size // 2,
+  )
+
+# binary layout of the Params scalars, mirrored by struct BundleParams in include/model_bundle.h
+PARAMS_INT_FIELDS = ['MAX_VOXELS', 'batch_size', 'num_classes', 'max_num_points_per_pillar', 'num_point_values',
+                     'num_feature_scatter', 'num_dir_bins', 'num_anchors', 'len_per_anchor', 'num_box_values',
+                     'grid_x_size', 'grid_y_size', 'grid_z_size', 'feature_x_size', 'feature_y_size']
+PARAMS_FLOAT_FIELDS = ['min_x_range', 'max_x_range', 'min_y_range', 'max_y_range', 'min_z_range', 'max_z_range',
+                       'pillar_x_size', 'pillar_y_size', 'pillar_z_size', 'dir_offset', 'dir_limit_offset',
+                       'score_thresh', 'nms_thresh']
+PARAMS_STRUCT = struct.Struct('<%di%df' % (len(PARAMS_INT_FIELDS), len(PARAMS_FLOAT_FIELDS)))
+
+def pack_paramters(params):
+  return PARAMS_STRUCT.pack(*([int(params[k]) for k in PARAMS_INT_FIELDS] + [float(params[k]) for k in PARAMS_FLOAT_FIELDS]))
+
+def unpack_paramters(data):
+  values = PARAMS_STRUCT.unpack(bytes(data[:PARAMS_STRUCT.size]))
+  return dict(zip(PARAMS_INT_FIELDS + PARAMS_FLOAT_FIELDS, values))
+
+def export_paramters(cfg, output_path=None, max_voxels=None, batch_size=1, class_names=None):
+  params = collect_paramters(cfg, max_voxels, batch_size, class_names)
+  write_paramters(params, output_path)
+  return params
+
+def write_paramters(params, output_path=None):
   # dump paramters to params.h
-  base_dir = os.getcwd()
-  fo = open(os.path.join(base_dir, 'CUDA-PointPillars', 'model_custom', 'params.h'),"w")
+  if output_path is None:
+    output_path = os.path.join(os.getcwd(), 'CUDA-PointPillars', 'model_custom', 'params.h')
+  fo = open(output_path,"w")
   fo.write(License+"\n")
   fo.write("#ifndef PARAMS_H_\n#define PARAMS_H_\n")
-  fo.write("const int MAX_VOXELS = "+str(MAX_NUMBER_OF_VOXELS)+";\n")
+  fo.write("const int MAX_VOXELS = "+str(params["MAX_VOXELS"])+";\n")
 
   fo.write("class Params\n{\n  public:\n")
 
-  fo.write("    static const int num_classes = "+str(CLASS_NUM)+";\n")
+  fo.write("    static const int num_classes = "+str(params["num_classes"])+";\n")
   class_names_list = "    const char *class_name [num_classes] = { "
-  for CLASS_NAME in CLASS_NAMES :
+  for CLASS_NAME in params["class_name"] :
     class_names_list = class_names_list + "\""+CLASS_NAME+"\","
   class_names_list = class_names_list + "};\n"
   fo.write(class_names_list)
 
-  fo.write("    const float min_x_range = "+str(float(rangMinX))+";\n")
-  fo.write("    const float max_x_range = "+str(float(rangMaxX))+";\n")
-  fo.write("    const float min_y_range = "+str(float(rangMinY))+";\n")
-  fo.write("    const float max_y_range = "+str(float(rangMaxY))+";\n")
-  fo.write("    const float min_z_range = "+str(float(rangMinZ))+";\n")
-  fo.write("    const float max_z_range = "+str(float(rangMaxZ))+";\n")
+  fo.write("    const float min_x_range = "+str(params["min_x_range"])+";\n")
+  fo.write("    const float max_x_range = "+str(params["max_x_range"])+";\n")
+  fo.write("    const float min_y_range = "+str(params["min_y_range"])+";\n")
+  fo.write("    const float max_y_range = "+str(params["max_y_range"])+";\n")
+  fo.write("    const float min_z_range = "+str(params["min_z_range"])+";\n")
+  fo.write("    const float max_z_range = "+str(params["max_z_range"])+";\n")
 
   fo.write("    // the size of a pillar\n")
-  fo.write("    const float pillar_x_size = "+str(float(VOXEL_SIZE[0]))+";\n")
-  fo.write("    const float pillar_y_size = "+str(float(VOXEL_SIZE[1]))+";\n")
-  fo.write("    const float pillar_z_size = "+str(float(VOXEL_SIZE[2]))+";\n")
+  fo.write("    const float pillar_x_size = "+str(params["pillar_x_size"])+";\n")
+  fo.write("    const float pillar_y_size = "+str(params["pillar_y_size"])+";\n")
+  fo.write("    const float pillar_z_size = "+str(params["pillar_z_size"])+";\n")
 
-  fo.write("    const int max_num_points_per_pillar = "+str(MAX_POINTS_PER_VOXEL)+";\n")
+  fo.write("    const int max_num_points_per_pillar = "+str(params["max_num_points_per_pillar"])+";\n")
 
-  fo.write("    const int num_point_values = "+str(NUM_POINT_FEATURES)+";\n")
+  fo.write("    const int num_point_values = "+str(params["num_point_values"])+";\n")
   fo.write("    // the number of feature maps for pillar scatter\n")
-  fo.write("    const int num_feature_scatter = "+str(NUM_BEV_FEATURES)+";\n")
+  fo.write("    const int num_feature_scatter = "+str(params["num_feature_scatter"])+";\n")
 
-  fo.write("    const float dir_offset = "+str(float(DIR_OFFSET))+";\n")
-  fo.write("    const float dir_limit_offset = "+str(float(DIR_LIMIT_OFFSET))+";\n")
+  fo.write("    const float dir_offset = "+str(params["dir_offset"])+";\n")
+  fo.write("    const float dir_limit_offset = "+str(params["dir_limit_offset"])+";\n")
 
   fo.write("    // the num of direction classes(bins)\n")
-  fo.write("    const int num_dir_bins = "+str(NUM_DIR_BINS)+";\n")
+  fo.write("    const int num_dir_bins = "+str(params["num_dir_bins"])+";\n")
 
   fo.write("    // anchors decode by (x, y, z, dir)\n")
   fo.write("    static const int num_anchors = num_classes * 2;\n")
@@ -126,7 +200,7 @@ def export_paramters(cfg):
   anchor_str = "    const float anchors[num_anchors * len_per_anchor] = {\n"
   anchor_str += "      "
   count = 0
-  for item in anchor_sizes :
+  for item in params["anchors"] :
     anchor_str = anchor_str + str(float(item)) +","
     count +=1
     if((count%4)==0) : anchor_str += "\n      "
@@ -134,13 +208,15 @@ def export_paramters(cfg):
   fo.write(anchor_str)
 
   anchor_heights = "    const float anchor_bottom_heights[num_classes] = {"
-  for item in anchor_bottom_heights :
+  for item in params["anchor_bottom_heights"] :
     anchor_heights = anchor_heights + str(float(item)) +","
   anchor_heights = anchor_heights + "};\n"
   fo.write(anchor_heights)
   fo.write("    // the score threshold for classification\n")
-  fo.write("    const float score_thresh = "+str(float(SCORE_THRESH))+";\n")
-  fo.write("    const float nms_thresh = "+str(float(NMS_THRESH))+";\n")
+  fo.write("    const float score_thresh = "+str(params["score_thresh"])+";\n")
+  fo.write("    const float nms_thresh = "+str(params["nms_thresh"])+";\n")
+  fo.write("    // the number of frames per inference, pillars of all frames share the voxels input\n")
+  fo.write("    static const int batch_size = "+str(params["batch_size"])+";\n")
 
   fo.write(
 '''    const int max_num_pillars = MAX_VOXELS;
@@ -0,0 +1,200 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+from collections import defaultdict
+
+# pattern steps, see compile_pattern()
+GAP = 'gap'
+OP = 'op'
+
+DEFAULT_MAX_GAP = 64
+
+# fusion passes registered by simplifier_onnx, in run order. Kept here, free
+# of onnx imports, so the exporter can check --fusion_passes up front.
+FUSION_PASS_NAMES = ('fold_bn_matmul', 'fold_bn_conv', 'fold_bn_convtranspose', 'drop_output_transpose')
+
+_STEP_RE = re.compile(r'^(\*|[\w|]+)\s*(?:[*×]\s*(\d+))?$')
+
+def compile_pattern(pattern):
+  """
+  Chain patterns are written as steps joined by "->" (or the arrow sign):
+    "MatMul -> ... -> ReduceMax"         "..." skips any number of nodes
+    "ConvTranspose -> * -> * -> Concat"  "*" is exactly one node of any op
+    "Conv|ConvTranspose -> Relu"         "|" lists alternative ops
+    "Conv*3" or "Conv×3"                     repeats a step
+  Lists/tuples of step strings are accepted as well.
+  """
+  if isinstance(pattern, str):
+    pattern = re.split(r'->|→', pattern)
+
+  steps = []
+  for step in pattern:
+    step = step.strip()
+    if step in ('...', '…'):
+      steps.append((GAP, None))
+      continue
+    m = _STEP_RE.match(step)
+    if m is None:
+      raise ValueError('Invalid pattern step: %r' % step)
+    ops = None if m.group(1) == '*' else frozenset(m.group(1).split('|'))
+    steps.extend([(OP, ops)] * int(m.group(2) or 1))
+
+  if not steps or steps[0][0] == GAP or steps[-1][0] == GAP:
+    raise ValueError('Pattern must start and end with a node step: %r' % (pattern,))
+  return steps
+
+class GraphIndex(object):
+  """
+  Op and node-order indices over an onnx_graphsurgeon graph.
+
+  Producer/consumer lookups go through the tensors' own inputs/outputs lists,
+  which onnx_graphsurgeon keeps in sync on every rewrite, restricted to the
+  nodes of this graph and returned in graph order. That makes every lookup
+  O(degree) instead of a scan over graph.nodes. Nodes added through the
+  index are indexed on the fly; cleanup() re-indexes once after nodes are
+  removed.
+  """
+  def __init__(self, graph, max_gap=DEFAULT_MAX_GAP):
+    self.graph = graph
+    self.max_gap = max_gap
+    self.reindex()
+
+  def reindex(self):
+    self._order = dict()
+    self._by_op = defaultdict(list)
+    for node in self.graph.nodes:
+      self._track(node)
+
+  def _track(self, node):
+    self._order[id(node)] = len(self._order)
+    self._by_op[node.op].append(node)
+
+  def sync(self):
+    # index nodes appended to graph.nodes behind our back, e.g. by graph.layer()
+    for node in self.graph.nodes[len(self._order):]:
+      self._track(node)
+
+  def cleanup(self):
+    self.graph.cleanup().toposort()
+    self.reindex()
+    return self
+
+  # ---- lookups ----
+
+  def nodes(self, op):
+    return [node for node in self._by_op.get(op, []) if id(node) in self._order]
+
+  def first(self, op):
+    nodes = self.nodes(op)
+    return nodes[0] if nodes else None
+
+  def producer(self, tensor):
+    nodes = [node for node in tensor.inputs if id(node) in self._order]
+    return nodes[0] if nodes else None
+
+  def consumers(self, tensor, slot=None):
+    nodes = [node for node in tensor.outputs if id(node) in self._order
+             and (slot is None or (len(node.inputs) > slot and node.inputs[slot] is tensor))]
+    return sorted(nodes, key=lambda node: self._order[id(node)])
+
+  def next_nodes(self, node):
+    # nodes taking this node's first output as their first input
+    if len(node.outputs) == 0:
+      return []
+    return self.consumers(node.outputs[0], slot=0)
+
+  def walk(self, node, hops):
+    for i in range(hops):
+      next_nodes = self.next_nodes(node)
+      if not next_nodes:
+        raise LookupError('%s (%s) has no consumer after %d hops' % (node.name, node.op, i))
+      node = next_nodes[0]
+    return node
+
+  # ---- pattern matching ----
+
+  def match(self, pattern, start=None):
+    """
+    Returns every chain matching the pattern as a list of nodes (skipped
+    "..." nodes included), or only the chain starting at start.
+    """
+    steps = compile_pattern(pattern)
+    if start is not None:
+      candidates = [start]
+    elif steps[0][1] is None:
+      candidates = list(self.graph.nodes)
+    else:
+      candidates = sorted([node for op in steps[0][1] for node in self.nodes(op)],
+                          key=lambda node: self._order[id(node)])
+
+    matches = []
+    for node in candidates:
+      chain = self._match_from(node, steps, 0, self.max_gap)
+      if chain is not None:
+        matches.append(chain)
+    return matches
+
+  def match_first(self, pattern, start=None):
+    matches = self.match(pattern, start)
+    if not matches:
+      raise LookupError('No match for pattern %r' % (pattern,))
+    return matches[0]
+
+  def _match_from(self, node, steps, k, budget):
+    kind, ops = steps[k]
+    if kind == GAP:
+      chain = self._match_from(node, steps, k + 1, self.max_gap)
+      if chain is not None or budget == 0:
+        return chain
+      for next_node in self.next_nodes(node):
+        chain = self._match_from(next_node, steps, k, budget - 1)
+        if chain is not None:
+          return [node] + chain
+      return None
+
+    if ops is not None and node.op not in ops:
+      return None
+    if k + 1 == len(steps):
+      return [node]
+    for next_node in self.next_nodes(node):
+      chain = self._match_from(next_node, steps, k + 1, budget)
+      if chain is not None:
+        return [node] + chain
+    return None
+
+  # ---- rewrites ----
+
+  def add_node(self, node):
+    self.graph.nodes.append(node)
+    self._track(node)
+    return node
+
+  # node.inputs/outputs are synchronized lists: their clear/extend/__setitem__
+  # also update the tensors' producer/consumer lists the lookups above read.
+  # Assigning a plain list to node.outputs would leave those stale.
+
+  def set_outputs(self, node, outputs):
+    outputs = list(outputs)
+    node.outputs.clear()
+    node.outputs.extend(outputs)
+    return node
+
+  def set_input(self, node, slot, tensor):
+    if slot == len(node.inputs):
+      node.inputs.append(tensor)
+    else:
+      node.inputs[slot] = tensor
+    return node
@@ -0,0 +1,96 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gc
+import sys
+import resource
+import contextlib
+
+MB = 1024.0 * 1024.0
+
+def _proc_status(field):
+  # VmRSS / VmHWM of /proc/self/status in bytes, None off Linux
+  try:
+    with open('/proc/self/status') as f:
+      for line in f:
+        if line.startswith(field + ':'):
+          return int(line.split()[1]) * 1024
+  except (IOError, OSError):
+    pass
+  return None
+
+def current_rss():
+  return _proc_status('VmRSS') or 0
+
+def peak_rss():
+  peak = _proc_status('VmHWM')
+  if peak is None:
+    # ru_maxrss is in bytes on macOS and in kB elsewhere
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak *= 1 if sys.platform == 'darwin' else 1024
+  return peak
+
+def reset_peak_rss():
+  # Linux >= 4.0 resets VmHWM to the current RSS on "5" > /proc/self/clear_refs
+  try:
+    with open('/proc/self/clear_refs', 'w') as f:
+      f.write('5')
+    return True
+  except (IOError, OSError):
+    return False
+
+class StageMemory(object):
+  """
+  Peak RSS per export stage. Without a resettable high-water mark the peak
+  is the process peak so far, flagged as such in the report.
+  """
+  def __init__(self, logger=None):
+    self.logger = logger
+    self.stages = []
+    # peaks of the stages nested in each running stage, a nested reset would hide them
+    self.nested = []
+
+  def log(self, message):
+    if self.logger is not None:
+      self.logger.info(message)
+    else:
+      print(message)
+
+  @contextlib.contextmanager
+  def stage(self, name):
+    if self.nested:
+      # the reset below drops the outer stage's high-water mark so far, keep it first
+      self.nested[-1] = max(self.nested[-1], peak_rss())
+    # whatever the previous stage dropped is returned before measuring this one
+    gc.collect()
+    resettable = reset_peak_rss()
+    start = current_rss()
+    self.nested.append(0)
+    try:
+      yield
+    finally:
+      peak = max(peak_rss(), self.nested.pop())
+      if self.nested:
+        self.nested[-1] = max(self.nested[-1], peak)
+    record = {'stage': name, 'start_mb': start / MB, 'peak_mb': peak / MB, 'end_mb': current_rss() / MB,
+              'process_peak': not resettable}
+    self.stages.append(record)
+    self.log('[memory] %-24s peak %9.1f MB%s' % (name, record['peak_mb'], ' (process peak)' if record['process_peak'] else ''))
+
+  def report(self):
+    for record in self.stages:
+      self.log('[memory] %-24s start %9.1f MB  peak %9.1f MB  end %9.1f MB%s' % (
+          record['stage'], record['start_mb'], record['peak_mb'], record['end_mb'],
+          ' (process peak)' if record['process_peak'] else ''))
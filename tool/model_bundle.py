@@ -0,0 +1,172 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import mmap
+import struct
+import numpy as np
+import onnx
+from onnx import numpy_helper
+
+from exporter_paramters import PARAMS_STRUCT, pack_paramters, unpack_paramters
+
+# File layout, all little-endian and mirrored by include/model_bundle.h:
+#   BundleHeader      fixed HEADER_SIZE bytes: magic, version, section table, Params scalars
+#   anchors           float32 [num_anchors * len_per_anchor]
+#   anchor_heights    float32 [num_classes]
+#   class_names       NUL-terminated utf-8 strings, num_classes of them
+#   weights           page aligned, one WEIGHT_ALIGNMENT aligned blob per external initializer
+#   graph             onnx ModelProto, its large initializers point into the weights section
+BUNDLE_MAGIC = b'PPBUNDLE'
+BUNDLE_VERSION = 1
+HEADER_SIZE = 256
+SECTIONS = ['anchors', 'anchor_heights', 'class_names', 'weights', 'graph']
+SECTION_ALIGNMENT = 4096
+WEIGHT_ALIGNMENT = 64
+# initializers below this many bytes stay inside the graph
+EXTERNAL_THRESHOLD = 1024
+
+PREFIX_STRUCT = struct.Struct('<8sIII4x' + 'QQ' * len(SECTIONS))
+assert PREFIX_STRUCT.size + PARAMS_STRUCT.size <= HEADER_SIZE
+
+def align(offset, alignment):
+  return (offset + alignment - 1) // alignment * alignment
+
+def externalize_weights(model, location, base_offset, threshold=EXTERNAL_THRESHOLD):
+  """
+  Moves the initializers of at least threshold bytes out of the graph. Each
+  one becomes an external tensor of location, at its absolute offset in the
+  bundle, so ONNX Runtime or the TensorRT parser read it straight from the
+  bundle file. Returns the weights section as a list of (offset, bytes).
+  """
+  blobs = []
+  cursor = base_offset
+  for tensor in model.graph.initializer:
+    if tensor.data_location == onnx.TensorProto.EXTERNAL:
+      continue
+    if not tensor.HasField('raw_data'):
+      tensor.CopyFrom(numpy_helper.from_array(numpy_helper.to_array(tensor), tensor.name))
+    if len(tensor.raw_data) < threshold:
+      continue
+
+    cursor = align(cursor, WEIGHT_ALIGNMENT)
+    blobs.append((cursor, tensor.raw_data))
+    del tensor.external_data[:]
+    for key, value in (('location', location), ('offset', str(cursor)), ('length', str(len(tensor.raw_data)))):
+      entry = tensor.external_data.add()
+      entry.key = key
+      entry.value = value
+    tensor.data_location = onnx.TensorProto.EXTERNAL
+    tensor.ClearField('raw_data')
+    cursor += len(blobs[-1][1])
+  return blobs
+
+def write_bundle(model, params, output_path):
+  """
+  Writes model (an onnx ModelProto or path) and params (from
+  exporter_paramters.collect_paramters) into one memory-mappable file.
+  The graph references its weights by the bundle's file name, so keep the
+  name when moving the bundle around.
+  """
+  if isinstance(model, str):
+    model = onnx.load(model)
+  else:
+    model = onnx.ModelProto.FromString(model.SerializeToString())
+
+  meta = {
+    'anchors': np.asarray(params['anchors'], dtype='<f4').tobytes(),
+    'anchor_heights': np.asarray(params['anchor_bottom_heights'], dtype='<f4').tobytes(),
+    'class_names': b''.join(name.encode('utf-8') + b'\0' for name in params['class_name']),
+  }
+  sections = dict()
+  cursor = HEADER_SIZE
+  for name in ('anchors', 'anchor_heights', 'class_names'):
+    sections[name] = (cursor, len(meta[name]))
+    cursor = align(cursor + len(meta[name]), WEIGHT_ALIGNMENT)
+
+  # the weights go first so their offsets are known before the graph is serialized
+  weights_offset = align(cursor, SECTION_ALIGNMENT)
+  blobs = externalize_weights(model, os.path.basename(output_path), weights_offset)
+  weights_end = blobs[-1][0] + len(blobs[-1][1]) if blobs else weights_offset
+  sections['weights'] = (weights_offset, weights_end - weights_offset)
+
+  graph = model.SerializeToString()
+  sections['graph'] = (align(weights_end, SECTION_ALIGNMENT), len(graph))
+
+  table = []
+  for name in SECTIONS:
+    table.extend(sections[name])
+  header = PREFIX_STRUCT.pack(BUNDLE_MAGIC, BUNDLE_VERSION, HEADER_SIZE, len(SECTIONS), *table) + pack_paramters(params)
+  header += b'\0' * (HEADER_SIZE - len(header))
+
+  tmp_path = output_path + '.tmp'
+  with open(tmp_path, 'wb') as f:
+    f.write(header)
+    for name in ('anchors', 'anchor_heights', 'class_names'):
+      f.seek(sections[name][0])
+      f.write(meta[name])
+    for offset, data in blobs:
+      f.seek(offset)
+      f.write(data)
+    f.seek(sections['graph'][0])
+    f.write(graph)
+  os.replace(tmp_path, output_path)
+  return sections
+
+class ModelBundle(object):
+  """
+  Read-only view of a bundle. Nothing is copied: params are decoded from the
+  header, anchors/weights are numpy views on the mapping and graph is a
+  memoryview of the serialized ModelProto.
+  """
+  def __init__(self, path):
+    self.path = path
+    with open(path, 'rb') as f:
+      self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    self.buffer = memoryview(self.mmap)
+
+    prefix = PREFIX_STRUCT.unpack_from(self.buffer, 0)
+    magic, version, header_size, num_sections = prefix[:4]
+    if magic != BUNDLE_MAGIC:
+      raise ValueError('%s is not a model bundle' % path)
+    if version != BUNDLE_VERSION:
+      raise ValueError('%s has bundle version %d, expected %d' % (path, version, BUNDLE_VERSION))
+    self.sections = {name: (prefix[4 + 2 * i], prefix[5 + 2 * i]) for i, name in enumerate(SECTIONS[:num_sections])}
+    self.params = unpack_paramters(self.buffer[PREFIX_STRUCT.size:header_size])
+
+    self.params['anchors'] = np.frombuffer(self.section('anchors'), dtype='<f4')
+    self.params['anchor_bottom_heights'] = np.frombuffer(self.section('anchor_heights'), dtype='<f4')
+    self.params['class_name'] = [name.decode('utf-8') for name in bytes(self.section('class_names')).split(b'\0')[:-1]]
+
+  def section(self, name):
+    offset, size = self.sections[name]
+    return self.buffer[offset:offset + size]
+
+  @property
+  def graph(self):
+    return self.section('graph')
+
+  def weight(self, tensor):
+    # numpy view of an external initializer of the graph
+    info = {entry.key: entry.value for entry in tensor.external_data}
+    offset, length = int(info['offset']), int(info['length'])
+    dtype = onnx.helper.tensor_dtype_to_np_dtype(tensor.data_type)
+    return np.frombuffer(self.buffer[offset:offset + length], dtype=dtype).reshape(tuple(tensor.dims))
+
+  def load_onnx(self, load_external_data=False):
+    model = onnx.ModelProto.FromString(bytes(self.graph))
+    if load_external_data:
+      onnx.external_data_helper.load_external_data_for_model(model, os.path.dirname(os.path.abspath(self.path)))
+    return model
@@ -0,0 +1,297 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import numpy as np
+import onnxruntime as ort
+
+from voxelizer import FEATURES_SIZE, generate_features
+
+HEAD_OUTPUTS = ('cls_preds', 'box_preds', 'dir_cls_preds')
+
+def pack_frames(data_dicts, MAX_VOXELS, params=None):
+  """
+  Packs the voxelization of one or more frames into the 4-channel inputs of the
+  raw/trimmed graphs: voxels [N*V, P, 4], voxel_idxs [N*V, 4] as (frame_id, z, y, x)
+  and voxel_num [1] with the number of valid pillars. voxel_num_points keeps
+  the per-pillar point counts. With params, features holds the 10-channel
+  voxels input of the final graph.
+  """
+  BATCH_SIZE = len(data_dicts)
+  MAX_POINTS_PER_VOXEL = data_dicts[0]['voxels'].shape[1]
+  voxels = np.zeros((BATCH_SIZE*MAX_VOXELS, MAX_POINTS_PER_VOXEL, 4), dtype=np.float32)
+  voxel_idxs = np.zeros((BATCH_SIZE*MAX_VOXELS, 4), dtype=np.int32)
+  voxel_num_points = np.zeros((BATCH_SIZE*MAX_VOXELS,), dtype=np.int32)
+
+  count = 0
+  for frame_id, data_dict in enumerate(data_dicts):
+    num = min(len(data_dict['voxels']), MAX_VOXELS)
+    voxels[count:count + num] = data_dict['voxels'][:num, :, :4]
+    voxel_idxs[count:count + num, 0] = frame_id
+    voxel_idxs[count:count + num, 1:] = data_dict['voxel_coords'][:num]
+    voxel_num_points[count:count + num] = data_dict['voxel_num_points'][:num]
+    count += num
+
+  inputs = {'voxels': voxels, 'voxel_idxs': voxel_idxs, 'voxel_num': np.array([count], dtype=np.int32),
+            'voxel_num_points': voxel_num_points}
+  if params is not None:
+    inputs['features'] = np.zeros((BATCH_SIZE*MAX_VOXELS, MAX_POINTS_PER_VOXEL, FEATURES_SIZE), dtype=np.float32)
+    inputs['features'][:count] = generate_features(voxels[:count], voxel_num_points[:count], voxel_idxs[:count, 1:], params)
+  return inputs
+
+def run_torch(model, inputs, BATCH_SIZE=1, traced=True):
+  """
+  traced=True feeds voxel_num as voxel_num_points like the exported raw graph
+  does; traced=False uses the true per-pillar counts, which is what the
+  features of the final graph encode.
+  """
+  import torch
+  device = next(model.parameters()).device
+  num_points = inputs['voxel_num'] if traced else inputs['voxel_num_points']
+  batch_dict = {
+      'voxels': torch.from_numpy(inputs['voxels']).to(device),
+      'voxel_num_points': torch.from_numpy(num_points).to(device),
+      'voxel_coords': torch.from_numpy(inputs['voxel_idxs']).to(device),
+      'batch_size': BATCH_SIZE,
+  }
+  # run the modules like PointPillar.forward but stop before post_processing
+  with torch.no_grad():
+    for cur_module in model.module_list:
+      batch_dict = cur_module(batch_dict)
+  ret = model.dense_head.forward_ret_dict
+  return {name: ret[name].detach().cpu().numpy() for name in HEAD_OUTPUTS if name in ret}
+
+def create_session(model_path, intra_op_threads=0, inter_op_threads=0, profile_prefix=None):
+  opts = ort.SessionOptions()
+  opts.intra_op_num_threads = intra_op_threads
+  opts.inter_op_num_threads = inter_op_threads
+  if profile_prefix is not None:
+    opts.enable_profiling = True
+    opts.profile_file_prefix = profile_prefix
+  return ort.InferenceSession(model_path, opts, providers=['CPUExecutionProvider'])
+
+def feeds_for(session, inputs):
+  feeds = {i.name: inputs[i.name] for i in session.get_inputs()}
+  # the final graph takes the 10-channel features as its voxels input
+  shape = [i.shape for i in session.get_inputs() if i.name == 'voxels']
+  if shape and shape[0][-1] == FEATURES_SIZE:
+    feeds['voxels'] = inputs['features']
+  return feeds
+
+def is_final_graph(model_path):
+  session = create_session(model_path)
+  return any(i.name == 'voxels' and i.shape[-1] == FEATURES_SIZE for i in session.get_inputs())
+
+def run_onnx(model_path, inputs):
+  session = create_session(model_path)
+  names = [o.name for o in session.get_outputs()]
+  return dict(zip(names, session.run(names, feeds_for(session, inputs))))
+
+def reference_topk(reference, score_thresh, topk):
+  """
+  NumPy model of simplifier_onnx.append_topk over the dense NHWC reference
+  heads: the best class per anchor, anchors below their class' threshold
+  get score -1, then the topk highest scores (ties in anchor order).
+  """
+  cls, box, dirs = [reference[name] for name in HEAD_OUTPUTS]
+  B, num_classes = cls.shape[0], len(np.atleast_1d(score_thresh))
+  cls = cls.reshape(B, -1, num_classes).astype(np.float32)
+  box = box.reshape(B, -1, 7)
+  dirs = dirs.reshape(B, -1, 2)
+
+  label = cls.argmax(axis=2)
+  score = (1.0 / (1.0 + np.exp(-cls.max(axis=2).astype(np.float64)))).astype(np.float32)
+  thresh = np.broadcast_to(np.asarray(score_thresh, dtype=np.float32), (num_classes,))
+  keep = ~(score < thresh[label])
+  masked = np.where(keep, score, np.float32(-1))
+  idxs = np.argsort(-masked, axis=1, kind='stable')[:, :topk]
+  take = lambda values: np.take_along_axis(values, idxs, axis=1)
+  return {
+    'scores': take(masked),
+    'labels': take(label).astype(np.int32),
+    'anchor_idxs': idxs.astype(np.int32),
+    'box_deltas': np.take_along_axis(box, idxs[..., None], axis=1),
+    'dir_bins': take(~(dirs[..., 0] > dirs[..., 1])).astype(np.int32),
+    'num_candidates': np.minimum(keep.sum(axis=1), topk).astype(np.int32),
+  }
+
+def compare(reference, outputs):
+  report = dict()
+  for name, ref in reference.items():
+    if name not in outputs:
+      continue
+    out = outputs[name]
+    if out.shape != ref.shape and out.ndim == 4 and out.transpose(0, 2, 3, 1).shape == ref.shape:
+      # heads exported without the NHWC transpose
+      out = out.transpose(0, 2, 3, 1)
+    diff = np.abs(ref.astype(np.float64) - out.astype(np.float64))
+    report[name] = {'shape': list(ref.shape), 'max_abs': float(diff.max()), 'mean_abs': float(diff.mean())}
+    if np.issubdtype(ref.dtype, np.integer):
+      # labels and indices either match or not, near-tied scores may swap a few
+      report[name]['mismatches'] = int((diff != 0).sum())
+  return report
+
+def profile_onnx(model_path, inputs, iterations, profile_prefix):
+  """
+  Runs the graph iterations times with ORT's profiler on and aggregates the
+  per-node kernel times, slowest node first.
+  """
+  session = create_session(model_path, profile_prefix=profile_prefix)
+  feeds = feeds_for(session, inputs)
+  for _ in range(iterations + 1):
+    session.run(None, feeds)
+  with open(session.end_profiling()) as f:
+    events = json.load(f)
+
+  nodes = dict()
+  for event in events:
+    if event.get('cat') != 'Node' or not event['name'].endswith('_kernel_time'):
+      continue
+    name = event['name'][:-len('_kernel_time')]
+    if name not in nodes:
+      # the first run is the warmup and is left out of the numbers
+      nodes[name] = {'node': name, 'op': event.get('args', {}).get('op_name', ''), 'calls': 0, 'total_ms': 0.0}
+      continue
+    node = nodes[name]
+    node['calls'] += 1
+    node['total_ms'] += event['dur'] / 1000.0
+
+  nodes = {name: node for name, node in nodes.items() if node['calls'] > 0}
+  total = sum(node['total_ms'] for node in nodes.values()) or 1.0
+  rows = sorted(nodes.values(), key=lambda node: node['total_ms'], reverse=True)
+  for rank, row in enumerate(rows):
+    row['rank'] = rank + 1
+    row['mean_ms'] = row['total_ms'] / row['calls']
+    row['share'] = row['total_ms'] / total
+  return rows
+
+def format_parity(parity):
+  lines = ['%-28s %-14s %14s %14s' % ('graph', 'output', 'max_abs', 'mean_abs')]
+  for graph, outputs in parity.items():
+    if not outputs:
+      lines.append('%-28s %-14s' % (graph, 'not compared'))
+    for name, stats in outputs.items():
+      lines.append('%-28s %-14s %14.6e %14.6e' % (graph, name, stats['max_abs'], stats['mean_abs']))
+  return '\n'.join(lines)
+
+def format_profile(rows, limit=30):
+  lines = ['%4s  %-48s %-18s %6s %10s %10s %7s' % ('rank', 'node', 'op', 'calls', 'mean_ms', 'total_ms', 'share')]
+  for row in rows[:limit]:
+    lines.append('%4d  %-48s %-18s %6d %10.3f %10.3f %6.1f%%' % (
+        row['rank'], row['node'][:48], row['op'], row['calls'], row['mean_ms'], row['total_ms'], 100 * row['share']))
+  return '\n'.join(lines)
+
+def prune_reference(reference, class_idxs):
+  # slice the full PyTorch heads like a --classes export slices its head convs
+  from simplifier_onnx import head_channels
+  num_classes = reference['box_preds'].shape[-1] // 14
+  channels = head_channels(num_classes, class_idxs)
+  return {name: reference[name][..., channels[i]] for i, name in enumerate(HEAD_OUTPUTS) if name in reference}
+
+def check_parity(model, graphs, data_dicts, MAX_VOXELS, output_dir, profile_iters=10, report_name='parity_report.json', params=None,
+                 class_idxs=None, score_thresh=None, topk=None):
+  """
+  graphs maps a label to an ORT-runnable onnx file: the trimmed graphs, or the
+  final graph when it was exported with the standard-op scatter (this needs
+  params to encode its features). Graphs exported with topk are compared
+  against reference_topk of the PyTorch heads. A graph none of whose outputs
+  has a reference is listed under not_compared instead of passing empty.
+  Writes report_name into output_dir and returns the report.
+  """
+  inputs = pack_frames(data_dicts, MAX_VOXELS, params)
+  reference = run_torch(model, inputs, len(data_dicts), traced=True)
+  if params is not None:
+    reference_final = run_torch(model, inputs, len(data_dicts), traced=False)
+  if class_idxs is not None:
+    reference = prune_reference(reference, class_idxs)
+    if params is not None:
+      reference_final = prune_reference(reference_final, class_idxs)
+
+  if topk is not None:
+    reference = reference_topk(reference, score_thresh, topk)
+    if params is not None:
+      reference_final = reference_topk(reference_final, score_thresh, topk)
+
+  report = {'max_voxels': MAX_VOXELS, 'frames': len(data_dicts), 'topk': topk, 'parity': dict(), 'not_compared': [], 'profile': dict()}
+  for label, path in graphs.items():
+    expected = reference_final if params is not None and is_final_graph(path) else reference
+    report['parity'][label] = compare(expected, run_onnx(path, inputs))
+    if not report['parity'][label]:
+      report['not_compared'].append(label)
+  print(format_parity(report['parity']))
+  if report['not_compared']:
+    print('[WARN] No output of %s has a reference, they were not compared' % ', '.join(report['not_compared']))
+
+  if profile_iters > 0:
+    for label, path in graphs.items():
+      rows = profile_onnx(path, inputs, profile_iters, os.path.join(output_dir, 'ort_profile_%s' % label))
+      report['profile'][label] = {'iterations': profile_iters, 'nodes': rows}
+      print('ORT CPU profile of %s over %d iterations:' % (label, profile_iters))
+      print(format_profile(rows))
+
+  with open(os.path.join(output_dir, report_name), 'w') as f:
+    json.dump(report, f, indent=2)
+  return report
+
+def scatter_reference(pillar_features, voxel_idxs, voxel_num, dense_shape, batch_size=1):
+  """
+  PPScatterPlugin semantics: the first voxel_num pillars are written to
+  [frame_id, :, y, x] of a zeroed [batch_size, C, NY, NX] map, dense_shape = [NX, NY].
+  """
+  NX, NY = int(dense_shape[0]), int(dense_shape[1])
+  num = int(np.asarray(voxel_num).reshape(-1)[0])
+  spatial = np.zeros((batch_size, pillar_features.shape[1], NY, NX), dtype=np.float32)
+  idxs = voxel_idxs[:num]
+  spatial[idxs[:, 0], :, idxs[:, 2], idxs[:, 3]] = pillar_features[:num]
+  return spatial
+
+def check_scatter(dense_shape, MAX_VOXELS, num_features=64, batch_size=1, fill=0.6, seed=0):
+  """
+  Runs simplifier_onnx.build_pillar_scatter alone on ORT with random pillars
+  and compares it with scatter_reference. Padded rows point at cell (0, 0) of
+  frame 0 like zero-initialized voxel_idxs do, so a leak shows up as a
+  mismatch there. Returns the max abs difference, which must be 0.
+  """
+  import onnx_graphsurgeon as gs
+  from simplifier_onnx import build_pillar_scatter
+
+  NX, NY = int(dense_shape[0]), int(dense_shape[1])
+  V = batch_size * MAX_VOXELS
+  rng = np.random.RandomState(seed)
+  # unique cells per frame, like the voxelizer produces, so a small grid caps the pillars
+  num = min(int(V * fill), batch_size * NY * NX)
+  per_frame = min(num // batch_size + 1, NY * NX)
+  cells = np.concatenate([b * NY * NX + rng.choice(NY * NX, per_frame, replace=False) for b in range(batch_size)])[:num]
+  voxel_idxs = np.zeros((V, 4), dtype=np.int32)
+  voxel_idxs[:num, 0] = cells // (NY * NX)
+  voxel_idxs[:num, 2] = cells % (NY * NX) // NX
+  voxel_idxs[:num, 3] = cells % NX
+  pillar_features = rng.randn(V, num_features).astype(np.float32)
+  voxel_num = np.array([num], dtype=np.int32)
+
+  graph = gs.Graph(opset=11)
+  inputs = [gs.Variable("pillar_features", np.float32, (V, num_features)),
+            gs.Variable("voxel_idxs", np.int32, (V, 4)),
+            gs.Variable("voxel_num", np.int32, (1,))]
+  spatial = gs.Variable("spatial_features")
+  build_pillar_scatter(graph, inputs[0], inputs[1], inputs[2], spatial, dense_shape, V, num_features, batch_size)
+  graph.inputs, graph.outputs = inputs, [spatial]
+
+  session = ort.InferenceSession(gs.export_onnx(graph).SerializeToString(), providers=['CPUExecutionProvider'])
+  output = session.run(None, {'pillar_features': pillar_features, 'voxel_idxs': voxel_idxs, 'voxel_num': voxel_num})[0]
+  expected = scatter_reference(pillar_features, voxel_idxs, voxel_num, dense_shape, batch_size)
+  assert output.shape == expected.shape, 'scatter shape %s, expected %s' % (output.shape, expected.shape)
+  return float(np.abs(output - expected).max())
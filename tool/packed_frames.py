@@ -0,0 +1,254 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import glob
+import mmap
+import time
+import argparse
+import collections
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# <stem>.points holds the float32 points of every frame back to back,
+# <stem>.index.npz their offsets and counts in points and the source names
+POINTS_SUFFIX = '.points'
+INDEX_SUFFIX = '.index.npz'
+PACK_VERSION = 1
+PAGE_SIZE = mmap.PAGESIZE
+
+def pack_stem(path):
+  path = str(path)
+  for suffix in (INDEX_SUFFIX, POINTS_SUFFIX):
+    if path.endswith(suffix):
+      return path[:-len(suffix)]
+  return path
+
+def is_packed(path):
+  # a stem, its .points or its .index.npz
+  return os.path.isfile(pack_stem(path) + INDEX_SUFFIX)
+
+def list_frames(src_dirs, ext='.bin'):
+  files = []
+  for src_dir in src_dirs:
+    files += sorted(glob.glob(os.path.join(str(src_dir), '*' + ext)))
+  return files
+
+def read_frame_file(path, num_point_values=4):
+  if path.endswith('.npy'):
+    return np.load(path).astype(np.float32, copy=False).reshape(-1, num_point_values)
+  return np.fromfile(path, dtype=np.float32).reshape(-1, num_point_values)
+
+def pack_directory(src_dirs, output_stem, ext='.bin', num_point_values=4):
+  """
+  Writes every ext file of src_dirs (sorted per directory) into one packed
+  dataset. Frames are streamed one at a time and the index is written last,
+  so a crashed run never leaves a readable but partial pack. Frames of
+  several directories are named by their path relative to the common
+  parent of src_dirs, without ext. Raises ValueError if names repeat.
+  """
+  files = list_frames(src_dirs, ext)
+  names = [os.path.splitext(os.path.basename(path))[0] for path in files]
+  if len(src_dirs) > 1:
+    parent = os.path.commonpath([os.path.abspath(str(src_dir)) for src_dir in src_dirs])
+    names = [os.path.splitext(os.path.relpath(os.path.abspath(path), parent))[0] for path in files]
+  duplicates = sorted(set(name for name, count in collections.Counter(names).items() if count > 1))
+  if duplicates:
+    raise ValueError('Frames %s share a name, the sources would collide in the pack' % duplicates)
+  counts = []
+  points_path, index_path = output_stem + POINTS_SUFFIX, output_stem + INDEX_SUFFIX
+  os.makedirs(os.path.dirname(os.path.abspath(output_stem)), exist_ok=True)
+  with open(points_path + '.tmp', 'wb') as f:
+    for path in files:
+      points = read_frame_file(path, num_point_values)
+      f.write(np.ascontiguousarray(points, dtype=np.float32).tobytes())
+      counts.append(len(points))
+  os.replace(points_path + '.tmp', points_path)
+
+  counts = np.array(counts, dtype=np.int64)
+  offsets = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64) if len(counts) else counts
+  with open(index_path + '.tmp', 'wb') as f:
+    np.savez(f, version=np.array(PACK_VERSION), num_point_values=np.array(num_point_values),
+             offsets=offsets, counts=counts, names=np.array(names, dtype=str))
+  os.replace(index_path + '.tmp', index_path)
+  return {'frames': len(files), 'points': int(counts.sum()), 'bytes': os.path.getsize(points_path)}
+
+class PackedFrames(object):
+  """
+  Read-only view of a packed dataset. frames[i] is a zero-copy
+  [count, num_point_values] float32 view into the mmap of the points file,
+  the pages are read when the view is first touched.
+  """
+  def __init__(self, path):
+    stem = pack_stem(path)
+    with np.load(stem + INDEX_SUFFIX) as index:
+      assert int(index['version']) == PACK_VERSION, '%s: pack version %d, expected %d' % (stem, int(index['version']), PACK_VERSION)
+      self.num_point_values = int(index['num_point_values'])
+      self.offsets, self.counts = index['offsets'], index['counts']
+      self.names = [str(name) for name in index['names']]
+    self.stem = stem
+    self._positions = {name: i for i, name in enumerate(self.names)}
+    self._file = open(stem + POINTS_SUFFIX, 'rb')
+    size = os.fstat(self._file.fileno()).st_size
+    # mmap refuses an empty file, a pack of empty frames has nothing to map
+    self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+    self.points = np.frombuffer(self._mmap, dtype=np.float32) if size else np.zeros((0,), dtype=np.float32)
+
+  def __len__(self):
+    return len(self.names)
+
+  def __getitem__(self, index):
+    start = int(self.offsets[index]) * self.num_point_values
+    return self.points[start:start + int(self.counts[index]) * self.num_point_values].reshape(-1, self.num_point_values)
+
+  def index_of(self, name):
+    return self._positions[name]
+
+  def prefetch(self, index):
+    """
+    Pulls the pages of frame index into the page cache and returns its view.
+    madvise starts the readahead, touching one value per page waits for it.
+    """
+    start = int(self.offsets[index]) * self.num_point_values * 4
+    length = int(self.counts[index]) * self.num_point_values * 4
+    if length and hasattr(self._mmap, 'madvise') and hasattr(mmap, 'MADV_WILLNEED'):
+      aligned = start - start % PAGE_SIZE
+      self._mmap.madvise(mmap.MADV_WILLNEED, aligned, start + length - aligned)
+    frame = self[index]
+    frame.reshape(-1)[::PAGE_SIZE // 4].sum()
+    return frame
+
+  def close(self):
+    # views handed out keep the mapping alive, it is only dropped with them
+    self.points = None
+    if self._mmap is not None:
+      try:
+        self._mmap.close()
+      except BufferError:
+        pass
+    self._file.close()
+
+class DirectoryFrames(object):
+  # the same interface over one file per frame
+  def __init__(self, path, ext='.bin', num_point_values=4):
+    self.files = list_frames([path], ext)
+    self.names = [os.path.splitext(os.path.basename(f))[0] for f in self.files]
+    self.num_point_values = num_point_values
+    self._positions = {name: i for i, name in enumerate(self.names)}
+
+  def __len__(self):
+    return len(self.files)
+
+  def __getitem__(self, index):
+    return read_frame_file(self.files[index], self.num_point_values)
+
+  def index_of(self, name):
+    return self._positions[name]
+
+  def prefetch(self, index):
+    return self[index]
+
+  def close(self):
+    pass
+
+def open_frames(path, ext='.bin', num_point_values=4):
+  if is_packed(path):
+    return PackedFrames(path)
+  return DirectoryFrames(path, ext, num_point_values)
+
+class PrefetchLoader(object):
+  """
+  Iterates (index, points) over frames in order while a thread pool reads
+  up to depth frames ahead. transform(index, points), e.g. voxelization,
+  runs in the pool too and its result is yielded instead of the points.
+  """
+  def __init__(self, frames, indices=None, workers=4, depth=8, transform=None):
+    self.frames = frames
+    self.indices = list(range(len(frames))) if indices is None else list(indices)
+    self.workers = workers
+    self.depth = max(depth, 1)
+    self.transform = transform
+
+  def _load(self, index):
+    points = self.frames.prefetch(index)
+    return points if self.transform is None else self.transform(index, points)
+
+  def __len__(self):
+    return len(self.indices)
+
+  def __iter__(self):
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=self.workers) as pool:
+      todo = collections.deque(self.indices)
+      try:
+        while todo and len(pending) < self.depth:
+          index = todo.popleft()
+          pending.append((index, pool.submit(self._load, index)))
+        while pending:
+          index, future = pending.popleft()
+          result = future.result()
+          if todo:
+            next_index = todo.popleft()
+            pending.append((next_index, pool.submit(self._load, next_index)))
+          yield index, result
+      finally:
+        # an abandoned iteration does not wait for reads nobody will use
+        for _, future in pending:
+          future.cancel()
+
+def benchmark(frames, workers, depth, repeat=1):
+  # frames per second of a plain loop and of the prefetching loader, each page touched once per frame
+  touch = lambda points: float(points.reshape(-1)[::PAGE_SIZE // 4].sum())
+  start = time.time()
+  for _ in range(repeat):
+    for index in range(len(frames)):
+      touch(frames[index])
+  serial = time.time() - start
+  start = time.time()
+  for _ in range(repeat):
+    for _, points in PrefetchLoader(frames, workers=workers, depth=depth):
+      touch(points)
+  prefetched = time.time() - start
+  count = len(frames) * repeat
+  return {'frames': count, 'serial_fps': count / max(serial, 1e-9), 'prefetch_fps': count / max(prefetched, 1e-9)}
+
+def parse_config():
+  parser = argparse.ArgumentParser(description='pack point cloud directories into one memory-mapped file and time reading it')
+  parser.add_argument('sources', type=str, nargs='+', help='directories of point clouds, or one pack to time')
+  parser.add_argument('--output', type=str, default=None, help='stem of the pack to write, e.g. ../data_packed')
+  parser.add_argument('--ext', type=str, default='.bin', help='.bin or .npy')
+  parser.add_argument('--num_point_values', type=int, default=4)
+  parser.add_argument('--workers', type=int, default=4, help='prefetch threads')
+  parser.add_argument('--depth', type=int, default=16, help='frames read ahead')
+  parser.add_argument('--repeat', type=int, default=1)
+
+  args = parser.parse_args()
+  return args
+
+def main():
+  args = parse_config()
+  if args.output is not None:
+    summary = pack_directory(args.sources, args.output, args.ext, args.num_point_values)
+    print('Packed %d frames, %d points, %.1f MB into %s%s' % (summary['frames'], summary['points'], summary['bytes'] / (1024.0 * 1024.0),
+                                                           args.output, POINTS_SUFFIX))
+  # the sources as they were and the new pack, or the given packs / directories as they are
+  for path in args.sources + ([args.output] if args.output is not None else []):
+    frames = open_frames(path, args.ext, args.num_point_values)
+    result = benchmark(frames, args.workers, args.depth, args.repeat)
+    print('%-40s %7d frames  serial %9.1f fps  prefetch %9.1f fps' % (path, result['frames'], result['serial_fps'], result['prefetch_fps']))
+    frames.close()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,558 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import math
+import time
+import ctypes
+import ctypes.util
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+# one row per box, the fields of Bndbox in the order SaveBoxPred writes them
+BOX_FIELDS = ('x', 'y', 'z', 'w', 'l', 'h', 'rt', 'id', 'score')
+# ThresHold and MARGIN of postprocess.cpp, both float there
+THRESHOLD = np.float32(1e-8)
+MARGIN = np.float32(1e-2)
+# atan2f is within a few ulp of atan2: angles further apart than this sort the same with either
+ANGLE_TIE = 1e-5
+
+def sigmoid(x):
+  return 1.0 / (1.0 + np.exp(-np.asarray(x, dtype=np.float32)))
+
+def frame_candidates(cls_preds, box_preds, dir_cls_preds, params):
+  """
+  The anchors of one frame's dense NHWC heads that pass score_thresh, in
+  (y, x, anchor) order like the blocks and threads of postprocess_kernal.
+  Returns (loc_idxs, anchor_idxs, cls_ids, scores, box_deltas [n, 7], dir_labels).
+  """
+  A, N = params['num_anchors'], params['num_classes']
+  scores = sigmoid(cls_preds).reshape(-1, A, N)
+  # first max wins like the kernel's strict >
+  cls_ids = scores.argmax(axis=2)
+  best = np.take_along_axis(scores, cls_ids[:, :, None], axis=2)[:, :, 0]
+  loc_idxs, anchor_idxs = np.nonzero(best >= np.float32(params['score_thresh']))
+  box = box_preds.reshape(-1, A, params['num_box_values'])[loc_idxs, anchor_idxs]
+  dirs = dir_cls_preds.reshape(-1, A, params['num_dir_bins'])[loc_idxs, anchor_idxs]
+  # dir[0] > dir[1] ? 0 : 1, a tie goes to the last bin
+  dir_labels = dirs.shape[1] - 1 - dirs[:, ::-1].argmax(axis=1)
+  return loc_idxs, anchor_idxs, cls_ids[loc_idxs, anchor_idxs], best[loc_idxs, anchor_idxs], box, dir_labels
+
+def decode_boxes(loc_idxs, anchor_idxs, cls_ids, scores, deltas, dir_labels, params):
+  """
+  postprocess_kernal for all candidates at once, float32 like the kernel.
+  loc_idxs index the feature map as y * feature_x_size + x, anchor_idxs the
+  params.h anchors (class * 2 + rotation). Returns boxes [n, 9] (BOX_FIELDS).
+  """
+  f32 = np.float32
+  FX, FY = params['feature_x_size'], params['feature_y_size']
+  loc_idxs, anchor_idxs = np.asarray(loc_idxs, dtype=np.int64), np.asarray(anchor_idxs, dtype=np.int64)
+  col, row = (loc_idxs % FX).astype(f32), (loc_idxs // FX).astype(f32)
+  x_offset = f32(params['min_x_range']) + col * (f32(params['max_x_range']) - f32(params['min_x_range'])) / f32(FX - 1)
+  y_offset = f32(params['min_y_range']) + row * (f32(params['max_y_range']) - f32(params['min_y_range'])) / f32(FY - 1)
+  anchors = np.asarray(params['anchors'], dtype=f32).reshape(-1, 4)[anchor_idxs]
+  dxa, dya, dza, ra = anchors[:, 0], anchors[:, 1], anchors[:, 2], anchors[:, 3]
+  za = dza / f32(2) + np.asarray(params['anchor_bottom_heights'], dtype=f32)[anchor_idxs // 2]
+  e = np.asarray(deltas, dtype=f32).reshape(-1, 7)
+  diagonal = np.sqrt(dxa * dxa + dya * dya)
+
+  boxes = np.empty((len(loc_idxs), len(BOX_FIELDS)), dtype=f32)
+  boxes[:, 0] = e[:, 0] * diagonal + x_offset
+  boxes[:, 1] = e[:, 1] * diagonal + y_offset
+  boxes[:, 2] = e[:, 2] * dza + za
+  boxes[:, 3] = np.exp(e[:, 3]) * dxa
+  boxes[:, 4] = np.exp(e[:, 4]) * dya
+  boxes[:, 5] = np.exp(e[:, 5]) * dza
+  rt = e[:, 6] + ra
+
+  # the kernel divides and floors in double, everything else is float
+  period = f32(2 * math.pi / params['num_dir_bins'])
+  dir_offset = f32(params['dir_offset'])
+  # val is float32, cast it first: NumPy 1.x would divide and floor it by a float64 scalar in float32
+  v64 = (rt - dir_offset).astype(np.float64)
+  dir_rot = (v64 - np.floor(v64 / (np.float64(period) + 1e-8)) * np.float64(period)).astype(f32)
+  boxes[:, 6] = dir_rot + dir_offset + period * np.asarray(dir_labels).astype(f32)
+  boxes[:, 7] = np.asarray(cls_ids).astype(f32)
+  boxes[:, 8] = scores
+  return boxes
+
+def decode_frame(cls_preds, box_preds, dir_cls_preds, params):
+  """
+  Boxes [n, 9] (BOX_FIELDS) of one frame's dense heads, cls_preds
+  [FY, FX, A*N], box_preds [FY, FX, A*7], dir_cls_preds [FY, FX, A*2].
+  """
+  return decode_boxes(*frame_candidates(cls_preds, box_preds, dir_cls_preds, params), params=params)
+
+def decode_topk(outputs, params, frame=0):
+  # anchor_idxs of a --topk graph index the heads flattened as (y, x, anchor),
+  # slots past num_candidates are padding
+  num = int(outputs['num_candidates'][frame])
+  A = params['num_anchors']
+  idxs = outputs['anchor_idxs'][frame, :num].astype(np.int64)
+  return decode_boxes(idxs // A, idxs % A, outputs['labels'][frame, :num], outputs['scores'][frame, :num],
+                      outputs['box_deltas'][frame, :num], outputs['dir_bins'][frame, :num], params)
+
+def _load_libm():
+  try:
+    libm = ctypes.CDLL(ctypes.util.find_library('m') or 'libm.so.6')
+  except OSError:
+    return None
+  for name, nargs in (('cosf', 1), ('sinf', 1), ('atan2f', 2)):
+    fn = getattr(libm, name)
+    fn.restype, fn.argtypes = ctypes.c_float, [ctypes.c_float] * nargs
+  return libm
+
+_libm = _load_libm()
+_NUMPY_F64 = {'cosf': np.cos, 'sinf': np.sin, 'atan2f': np.arctan2}
+# glibc's cosf and sinf are within 0.56 ulp, so they only round differently from float64 when the
+# float64 value is closer than 0.06 ulp to a float32 rounding midpoint. atan2f has no bound this tight
+LIBM_WINDOW = {'cosf': 0.1, 'sinf': 0.1}
+
+def libm_f32(name, *args):
+  """
+  cosf, sinf or atan2f of the C math library elementwise, the functions
+  cos/sin/atan2 of floats resolve to in postprocess.cpp. They are not
+  correctly rounded: NumPy's float32 versions, or float64 rounded to
+  float32, differ from them in the last bit for a few percent of inputs.
+  The float64 result rounded to float32 is used where it cannot differ
+  (outside LIBM_WINDOW of a midpoint), libm is only called for the rest.
+  Without a loadable libm the rounded float64 result stands in everywhere.
+  """
+  args = np.broadcast_arrays(*[np.asarray(a, dtype=np.float32) for a in args])
+  exact = _NUMPY_F64[name](*[a.astype(np.float64) for a in args])
+  result = exact.astype(np.float32)
+  if _libm is None:
+    return result
+  if name in LIBM_WINDOW:
+    below = np.where(result.astype(np.float64) <= exact, result, np.nextafter(result, np.float32(-np.inf)))
+    below, above = below.astype(np.float64), np.nextafter(below, np.float32(np.inf)).astype(np.float64)
+    near = np.abs(exact - (below + above) / 2) <= LIBM_WINDOW[name] * (above - below)
+  else:
+    near = np.ones(result.shape, dtype=bool)
+  fn = getattr(_libm, name)
+  result[near] = [fn(*v) for v in zip(*[a[near].tolist() for a in args])]
+  return result
+
+def box_geometry(boxes):
+  """
+  Per box, in float32 with the statements of box_overlap: the rotated
+  corners [n, 5, 2] with the first corner repeated, cos/sin(-rt) for
+  check_box2d and the area w * l of nms_cpu. Computed once per box so every
+  overlap of a box sees the same values.
+  """
+  f32 = np.float32
+  boxes = np.asarray(boxes, dtype=f32)
+  x, y, w, l, rt = boxes[:, 0], boxes[:, 1], boxes[:, 3], boxes[:, 4], boxes[:, 6]
+  dx_half, dy_half = w / f32(2), l / f32(2)
+  x1, y1, x2, y2 = x - dx_half, y - dy_half, x + dx_half, y + dy_half
+  corners = np.stack([np.stack([x1, y1], 1), np.stack([x2, y1], 1), np.stack([x2, y2], 1), np.stack([x1, y2], 1)], 1)
+  cos, sin = libm_f32('cosf', rt)[:, None], libm_f32('sinf', rt)[:, None]
+  dx, dy = corners[:, :, 0] - x[:, None], corners[:, :, 1] - y[:, None]
+  rotated = np.stack([dx * cos + dy * (-sin) + x[:, None], dx * sin + dy * cos + y[:, None]], 2)
+  w64, l64 = w.astype(np.float64), l.astype(np.float64)
+  return {
+    'boxes': boxes,
+    'corners': np.concatenate([rotated, rotated[:, :1]], 1),
+    'cos_neg': libm_f32('cosf', -rt), 'sin_neg': libm_f32('sinf', -rt),
+    'areas': w * l,
+    # radius of the circle around the corners, widened by the check_box2d margin and
+    # generously for float32 rounding, only used to skip pairs that cannot overlap
+    'radius': np.sqrt((w64 / 2) ** 2 + (l64 / 2) ** 2) + 2 * float(MARGIN),
+  }
+
+# points are (x, y) tuples of float32, either side may hold arrays of the compared boxes
+
+def _cross(p1, p2, p0):
+  return (p1[0] - p0[0]) * (p2[1] - p0[1]) - (p2[0] - p0[0]) * (p1[1] - p0[1])
+
+def _check_box2d(box, cos_neg, sin_neg, p):
+  rot_x = (p[0] - box[0]) * cos_neg + (p[1] - box[1]) * (-sin_neg)
+  rot_y = (p[0] - box[0]) * sin_neg + (p[1] - box[1]) * cos_neg
+  return (np.abs(rot_x) < box[3] / np.float32(2) + MARGIN) & (np.abs(rot_y) < box[4] / np.float32(2) + MARGIN)
+
+def _intersection(p1, p0, q1, q0):
+  # (x, y, found) of the crossing of segments p0-p1 and q0-q1
+  found = ((np.minimum(p0[0], p1[0]) <= np.maximum(q0[0], q1[0])) & (np.minimum(q0[0], q1[0]) <= np.maximum(p0[0], p1[0])) &
+           (np.minimum(p0[1], p1[1]) <= np.maximum(q0[1], q1[1])) & (np.minimum(q0[1], q1[1]) <= np.maximum(p0[1], p1[1])))
+  s1, s2 = _cross(q0, p1, p0), _cross(p1, q1, p0)
+  s3, s4 = _cross(p0, q1, q0), _cross(q1, p1, q0)
+  found &= (s1 * s2 > 0) & (s3 * s4 > 0)
+  s5 = _cross(q1, p1, p0)
+  a0, b0, c0 = p0[1] - p1[1], p1[0] - p0[0], p0[0] * p1[1] - p1[0] * p0[1]
+  a1, b1, c1 = q0[1] - q1[1], q1[0] - q0[0], q0[0] * q1[1] - q1[0] * q0[1]
+  D = a0 * b1 - a1 * b0
+  apart = np.abs(s5 - s1) > THRESHOLD
+  x = np.where(apart, (s5 * q0[0] - s1 * q1[0]) / (s5 - s1), (b0 * c1 - b1 * c0) / D)
+  y = np.where(apart, (s5 * q0[1] - s1 * q1[1]) / (s5 - s1), (a1 * c0 - a0 * c1) / D)
+  return x, y, found
+
+def _angle_order(found, dx, dy):
+  """
+  The order the bubble sort of box_overlap leaves the points in: stable by
+  atan2f around the centroid, missing points last. atan2 in float64 gives
+  it unless two angles of a row are close enough for atan2f's rounding to
+  reorder or tie them, those rows are sorted by libm's atan2f itself.
+  """
+  angles = np.where(found, np.arctan2(dy.astype(np.float64), dx.astype(np.float64)), np.inf)
+  order = np.argsort(angles, axis=1, kind='stable')
+  close = np.diff(np.take_along_axis(angles, order, 1), axis=1) <= ANGLE_TIE
+  rows = np.flatnonzero(close.any(axis=1))
+  if len(rows):
+    angles = np.where(found[rows], libm_f32('atan2f', np.where(found[rows], dy[rows], 0), np.where(found[rows], dx[rows], 0)), np.inf)
+    order[rows] = np.argsort(angles, axis=1, kind='stable')
+  return order
+
+def box_overlaps(geometry, i, js):
+  """
+  BEV intersection areas of box i with each of boxes js, box_overlap of
+  postprocess.cpp: edge crossings plus the corners inside the other box,
+  sorted by angle around their centroid, area by a fan from the first point.
+  Every pair goes through the float32 statements of the C++ in the same
+  order, so an area does not depend on which other boxes are in js.
+  """
+  f32 = np.float32
+  a, b = geometry['corners'][i], geometry['corners'][js]
+  box_b = [column[:, None] for column in geometry['boxes'][js].T]
+  with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+    # edge k of a against edge m of b as [len(js), k, m], C++ loop order once flattened
+    p1, p0 = (a[1:, 0][None, :, None], a[1:, 1][None, :, None]), (a[:4, 0][None, :, None], a[:4, 1][None, :, None])
+    q1, q0 = (b[:, None, 1:, 0], b[:, None, 1:, 1]), (b[:, None, :4, 0], b[:, None, :4, 1])
+    cross_x, cross_y, crossed = [v.reshape(len(js), 16) for v in _intersection(p1, p0, q1, q0)]
+    # then per k the corner of b inside a and the corner of a inside b
+    b_in_a = _check_box2d(geometry['boxes'][i], geometry['cos_neg'][i], geometry['sin_neg'][i], (b[:, :4, 0], b[:, :4, 1]))
+    a_in_b = _check_box2d(box_b, geometry['cos_neg'][js][:, None], geometry['sin_neg'][js][:, None], (a[None, :4, 0], a[None, :4, 1]))
+    corner_x = np.stack([b[:, :4, 0], np.broadcast_to(a[None, :4, 0], (len(js), 4))], 2).reshape(len(js), 8)
+    corner_y = np.stack([b[:, :4, 1], np.broadcast_to(a[None, :4, 1], (len(js), 4))], 2).reshape(len(js), 8)
+    xs, ys = np.concatenate([cross_x, corner_x], 1), np.concatenate([cross_y, corner_y], 1)
+    found = np.concatenate([crossed, np.stack([b_in_a, a_in_b], 2).reshape(len(js), 8)], 1)
+    count = found.sum(axis=1)
+
+    # float32 cumsum adds point by point like poly_center and the area loop
+    center_x = np.cumsum(np.where(found, xs, f32(0)), axis=1)[:, -1] / count.astype(f32)
+    center_y = np.cumsum(np.where(found, ys, f32(0)), axis=1)[:, -1] / count.astype(f32)
+    order = _angle_order(found, xs - center_x[:, None], ys - center_y[:, None])
+    xs, ys = np.take_along_axis(xs, order, 1), np.take_along_axis(ys, order, 1)
+
+    ax, ay = xs[:, :-1] - xs[:, :1], ys[:, :-1] - ys[:, :1]
+    bx, by = xs[:, 1:] - xs[:, :1], ys[:, 1:] - ys[:, :1]
+    fan = np.arange(xs.shape[1] - 1)[None, :] < (count - 1)[:, None]
+    area = np.cumsum(np.where(fan, ax * by - ay * bx, f32(0)), axis=1)[:, -1]
+  return np.where(count > 0, np.abs(area) / f32(2), f32(0))
+
+def score_order(boxes):
+  # std::sort by descending score, equal scores keep their decode order
+  return np.argsort(-np.asarray(boxes)[:, 8], kind='stable')
+
+def _suppress(geometry, n, js, nms_thresh, suppressed):
+  # iou and the comparison in float32 like nms_cpu
+  overlaps = box_overlaps(geometry, n, js)
+  areas = geometry['areas']
+  with np.errstate(invalid='ignore'):
+    iou = overlaps / np.maximum(areas[n] + areas[js] - overlaps, THRESHOLD)
+  suppressed[js[iou >= np.float32(nms_thresh)]] = True
+  return len(js)
+
+def nms_cpu(boxes, nms_thresh, stats=None):
+  """
+  Greedy rotated-BEV NMS of postprocess.cpp over boxes [n, 9]: every box
+  is compared with every later unsuppressed box in score order, all
+  classes together. Returns the indices of the kept boxes, highest score
+  first. stats['pairs'] counts the overlaps computed.
+  """
+  boxes = np.asarray(boxes)
+  order = score_order(boxes)
+  # boxes by rank, so nms_bev_grid sees the very same geometry
+  geometry = box_geometry(boxes[order])
+  suppressed = np.zeros(len(order), dtype=bool)
+  kept, pairs = [], 0
+  for n in range(len(order)):
+    if suppressed[n]:
+      continue
+    kept.append(n)
+    js = np.arange(n + 1, len(order))
+    js = js[~suppressed[js]]
+    if len(js):
+      pairs += _suppress(geometry, n, js, nms_thresh, suppressed)
+  if stats is not None:
+    stats['pairs'] = stats.get('pairs', 0) + pairs
+  return order[np.array(kept, dtype=np.int64)]
+
+def bev_grid(geometry, cell_size=None, labels=None):
+  """
+  Uniform BEV grid over the corner circles of boxes given by rank. A box is
+  listed in every cell its circle's bounding square touches, with labels
+  only boxes of one label share a cell. Returns (cells, members, starts,
+  ends): the cell ids of each box as cells[box] and, per cell id, the boxes
+  members[starts[c]:ends[c]] in rank order.
+  """
+  x, y, r = geometry['boxes'][:, 0], geometry['boxes'][:, 1], geometry['radius']
+  # at 2 * the largest radius a box touches at most 2 x 2 cells
+  cell_size = cell_size or max(2 * float(r.max()), float(MARGIN))
+  left, bottom = float((x - r).min()), float((y - r).min())
+  ix0, ix1 = np.floor((x - r - left) / cell_size).astype(np.int64), np.floor((x + r - left) / cell_size).astype(np.int64)
+  iy0, iy1 = np.floor((y - r - bottom) / cell_size).astype(np.int64), np.floor((y + r - bottom) / cell_size).astype(np.int64)
+  NX, NY = int(ix1.max()) + 1, int(iy1.max()) + 1
+
+  # one entry per (box, cell) in box order
+  nx = ix1 - ix0 + 1
+  spans = nx * (iy1 - iy0 + 1)
+  box = np.repeat(np.arange(len(x)), spans)
+  offset = np.arange(len(box)) - np.repeat(np.cumsum(spans) - spans, spans)
+  keys = (np.repeat(iy0, spans) + offset // np.repeat(nx, spans)) * NX + np.repeat(ix0, spans) + offset % np.repeat(nx, spans)
+  if labels is not None:
+    keys += np.repeat(np.asarray(labels, dtype=np.int64), spans) * NX * NY
+
+  cell_keys, cell_ids = np.unique(keys, return_inverse=True)
+  sort = np.lexsort((box, cell_ids))
+  starts = np.searchsorted(cell_ids[sort], np.arange(len(cell_keys)), side='left')
+  ends = np.searchsorted(cell_ids[sort], np.arange(len(cell_keys)), side='right')
+  cells = np.split(cell_ids, np.cumsum(spans)[:-1])
+  return cells, box[sort], starts, ends
+
+def nms_bev_grid(boxes, nms_thresh, pre_max_size=None, per_class=False, cell_size=None, stats=None):
+  """
+  nms_cpu that only computes the overlap of boxes sharing a cell of a
+  uniform BEV grid. Boxes whose corner circles (widened by the check_box2d
+  margin) are apart get no edge crossing and no corner inside the other,
+  so box_overlap is 0 for them and they never suppress each other: the
+  kept set is exactly the one of nms_cpu. pre_max_size keeps only the
+  highest scoring boxes before NMS, per_class only suppresses within a
+  class; nms_cpu itself does neither.
+  """
+  boxes = np.asarray(boxes)
+  order = score_order(boxes)
+  if pre_max_size is not None:
+    order = order[:pre_max_size]
+  if len(order) == 0:
+    return order
+  if nms_thresh <= 0:
+    # an IoU of 0 already suppresses, every box is a neighbour of the first (of its class)
+    if not per_class:
+      return order[:1]
+    _, first = np.unique(boxes[order, 7], return_index=True)
+    return order[np.sort(first)]
+  geometry = box_geometry(boxes[order])
+  cells, members, starts, ends = bev_grid(geometry, cell_size, boxes[order, 7] if per_class else None)
+  x, y, radius = geometry['boxes'][:, 0], geometry['boxes'][:, 1], geometry['radius']
+
+  suppressed = np.zeros(len(order), dtype=bool)
+  kept, pairs = [], 0
+  for n in range(len(order)):
+    if suppressed[n]:
+      continue
+    kept.append(n)
+    # the later boxes of each cell, ranks are sorted inside a cell
+    later = [members[starts[c]:ends[c]] for c in cells[n]]
+    later = [cell[np.searchsorted(cell, n, side='right'):] for cell in later]
+    js = np.unique(np.concatenate(later)) if len(later) > 1 else later[0]
+    js = js[~suppressed[js]]
+    # same cell but corner circles apart, still no overlap
+    js = js[np.hypot(x[js] - x[n], y[js] - y[n]) <= radius[js] + radius[n]]
+    if len(js):
+      pairs += _suppress(geometry, n, js, nms_thresh, suppressed)
+  if stats is not None:
+    stats['pairs'] = stats.get('pairs', 0) + pairs
+  return order[np.array(kept, dtype=np.int64)]
+
+def format_boxes(boxes):
+  # one line per box like SaveBoxPred, floats as the default ostream precision
+  lines = []
+  for box in boxes:
+    values = ['%g' % v for v in box[:7]] + ['%d' % int(box[7]), '%g' % box[8]]
+    lines.append(' '.join(values) + ' \n')
+  return ''.join(lines)
+
+def save_box_pred(boxes, file_name):
+  with open(file_name, 'w') as f:
+    f.write(format_boxes(boxes))
+
+def synthetic_boxes(num, params, objects=None, seed=0):
+  """
+  num decoded candidates around a few objects like a detector gives them:
+  jittered centers, sizes and yaws from the params.h anchors of the
+  object's class, distinct scores above score_thresh. More candidates
+  pile up on the same scene, as a lower score_thresh would.
+  """
+  rng = np.random.RandomState(seed)
+  objects = objects or int(np.clip(num // 25, 1, 300))
+  center = rng.uniform([params['min_x_range'], params['min_y_range']], [params['max_x_range'], params['max_y_range']], (objects, 2))
+  label = rng.randint(0, params['num_classes'], objects)
+  yaw = rng.uniform(-np.pi, np.pi, objects)
+  anchors = np.asarray(params['anchors'], dtype=np.float32).reshape(-1, 4)
+
+  owner = rng.randint(0, objects, num)
+  boxes = np.zeros((num, len(BOX_FIELDS)), dtype=np.float32)
+  boxes[:, :2] = center[owner] + rng.randn(num, 2) * 0.3
+  boxes[:, 2] = rng.randn(num) * 0.1
+  boxes[:, 3:6] = anchors[label[owner] * 2, :3] * np.exp(rng.randn(num, 3) * 0.05)
+  boxes[:, 6] = yaw[owner] + rng.randn(num) * 0.1
+  boxes[:, 7] = label[owner]
+  # distinct scores, the unstable std::sort of nms_cpu orders ties its own way
+  boxes[:, 8] = params['score_thresh'] + (1.0 - params['score_thresh']) * (rng.permutation(num) + 1) / (num + 1)
+  return boxes
+
+# nms_cpu and what it calls in postprocess.cpp, up to the CUDA class after them
+CPP_SECTION = ('const float ThresHold', 'PostProcessCuda::PostProcessCuda')
+CPP_HARNESS = r'''
+#include <vector>
+#include <algorithm>
+#include <math.h>
+#include <stdio.h>
+
+struct float2 { float x, y; };
+%s
+%s
+// stdin: int n, float nms_thresh, float boxes [n, 9]; stdout: int row of each kept box
+int main() {
+  int n;
+  float nms_thresh;
+  if (fread(&n, sizeof(int), 1, stdin) != 1 || fread(&nms_thresh, sizeof(float), 1, stdin) != 1) return 1;
+  std::vector<float> values(n * 9);
+  if (n && fread(values.data(), sizeof(float), values.size(), stdin) != values.size()) return 1;
+  std::vector<Bndbox> boxes;
+  for (int i = 0; i < n; i++) {
+    const float *v = &values[i * 9];
+    // id carries the row, nms_cpu never reads it
+    boxes.emplace_back(v[0], v[1], v[2], v[3], v[4], v[5], v[6], i, v[8]);
+  }
+  std::vector<Bndbox> kept;
+  nms_cpu(boxes, nms_thresh, kept);
+  for (const Bndbox &box : kept) fwrite(&box.id, sizeof(int), 1, stdout);
+  return 0;
+}
+'''
+
+def build_cpp_nms(source, header, build_dir, compiler='c++'):
+  """
+  Compiles the nms_cpu of postprocess.cpp, cut out of source, with the -O2
+  of the release build into build_dir and returns the executable. Bndbox is
+  taken from header, the CUDA includes are left out. Raises
+  subprocess.CalledProcessError if the compiler fails.
+  """
+  with open(source) as f:
+    text = f.read()
+  section = text[text.index(CPP_SECTION[0]):text.index(CPP_SECTION[1])]
+  with open(header) as f:
+    text = f.read()
+  start = text.index('struct Bndbox {')
+  bndbox = text[start:text.index('\n};', start) + 3]
+  path = os.path.join(build_dir, 'nms_cpu.cpp')
+  with open(path, 'w') as f:
+    f.write(CPP_HARNESS % (bndbox, section))
+  executable = os.path.join(build_dir, 'nms_cpu')
+  subprocess.run([compiler, '-O2', '-o', executable, path], check=True, capture_output=True)
+  return executable
+
+def cpp_nms(executable, boxes, nms_thresh):
+  # indices of the boxes the compiled nms_cpu keeps, highest score first
+  boxes = np.ascontiguousarray(boxes, dtype=np.float32)
+  request = np.array([len(boxes)], dtype=np.int32).tobytes() + np.array([nms_thresh], dtype=np.float32).tobytes() + boxes.tobytes()
+  result = subprocess.run([executable], input=request, check=True, capture_output=True)
+  return np.frombuffer(result.stdout, dtype=np.int32).astype(np.int64)
+
+def time_call(fn, repeat):
+  start = time.time()
+  for _ in range(repeat):
+    result = fn()
+  return result, (time.time() - start) * 1000.0 / repeat
+
+def benchmark(params, sizes, reference_max, pre_max_size, repeat=3, seed=0, cpp=None):
+  """
+  nms_bev_grid against the all-pairs nms_cpu over synthetic candidates.
+  nms_cpu only runs up to reference_max candidates, there the kept sets
+  must be equal, and equal to the ones of the compiled C++ nms_cpu when cpp
+  is its executable (build_cpp_nms). Returns one row per size.
+  """
+  rows = []
+  for num in sizes:
+    boxes = synthetic_boxes(num, params, seed=seed)
+    grid_stats, sweep_stats = dict(), dict()
+    kept, grid_ms = time_call(lambda: nms_bev_grid(boxes, params['nms_thresh']), repeat)
+    nms_bev_grid(boxes, params['nms_thresh'], stats=grid_stats)
+    row = {'candidates': num, 'kept': len(kept), 'grid_ms': grid_ms, 'grid_pairs': grid_stats['pairs']}
+    # per-box corners and libm cos/sin, part of grid_ms
+    _, row['geometry_ms'] = time_call(lambda: box_geometry(boxes[score_order(boxes)]), repeat)
+    if pre_max_size is not None:
+      kept_topk, row['topk_ms'] = time_call(lambda: nms_bev_grid(boxes, params['nms_thresh'], pre_max_size), repeat)
+      row['topk_kept'] = len(kept_topk)
+    if num <= reference_max:
+      expected, row['sweep_ms'] = time_call(lambda: nms_cpu(boxes, params['nms_thresh'], sweep_stats), 1)
+      row['sweep_pairs'] = sweep_stats['pairs']
+      row['same'] = bool(np.array_equal(kept, expected))
+      assert row['same'], '%d candidates: nms_bev_grid kept %d boxes, nms_cpu %d' % (num, len(kept), len(expected))
+      if cpp is not None:
+        kept_cpp, row['cpp_ms'] = time_call(lambda: cpp_nms(cpp, boxes, params['nms_thresh']), 1)
+        row['cpp_same'] = bool(np.array_equal(expected, kept_cpp))
+        assert row['cpp_same'], '%d candidates: nms_cpu kept %d boxes, the C++ nms_cpu %d' % (num, len(expected), len(kept_cpp))
+    rows.append(row)
+  return rows
+
+def format_benchmark(rows):
+  lines = ['%10s %6s %10s %11s %10s %10s %10s %10s %10s %10s  %-9s %s' % ('candidates', 'kept', 'grid ms', 'geometry ms', 'grid pairs',
+                                                                          'topk ms', 'topk kept', 'sweep ms', 'sweep pairs', 'c++ ms',
+                                                                          'kept set', 'c++ kept set')]
+  fmt = lambda row, key, spec: spec % row[key] if key in row else '-'
+  same = lambda row, key: ('same' if row[key] else 'DIFFERENT') if key in row else '-'
+  for row in rows:
+    lines.append('%10d %6d %10.2f %11.2f %10d %10s %10s %10s %10s %10s  %-9s %s' % (
+        row['candidates'], row['kept'], row['grid_ms'], row['geometry_ms'], row['grid_pairs'], fmt(row, 'topk_ms', '%.2f'), fmt(row, 'topk_kept', '%d'),
+        fmt(row, 'sweep_ms', '%.2f'), fmt(row, 'sweep_pairs', '%d'), fmt(row, 'cpp_ms', '%.2f'), same(row, 'same'),
+        same(row, 'cpp_same')))
+  return '\n'.join(lines)
+
+def benchmark_decode(params, repeat=3, seed=0):
+  # random dense heads of one frame, logits shifted so a few percent pass score_thresh
+  rng = np.random.RandomState(seed)
+  FY, FX, A, N = params['feature_y_size'], params['feature_x_size'], params['num_anchors'], params['num_classes']
+  cls_preds = (rng.randn(FY, FX, A * N) - 5.0).astype(np.float32)
+  box_preds = (rng.randn(FY, FX, A * params['num_box_values']) * 0.1).astype(np.float32)
+  dir_cls_preds = rng.randn(FY, FX, A * params['num_dir_bins']).astype(np.float32)
+  boxes, ms = time_call(lambda: decode_frame(cls_preds, box_preds, dir_cls_preds, params), repeat)
+  return FY * FX * A, len(boxes), ms
+
+def parse_config():
+  parser = argparse.ArgumentParser(description='microbenchmark of the NumPy anchor decode and the grid-indexed rotated BEV NMS')
+  parser.add_argument('--params', type=str, default='../include/params.h', help='params.h written by the exporter')
+  parser.add_argument('--sizes', type=int, nargs='+', default=[100, 300, 1000, 3000, 10000, 50000], help='candidate counts')
+  parser.add_argument('--reference_max', type=int, default=3000, help='largest count also run through the all-pairs nms_cpu')
+  parser.add_argument('--pre_max_size', type=int, default=4096, help='pre-NMS top-K to time as well, 0 to skip')
+  parser.add_argument('--repeat', type=int, default=3, help='timed runs per size')
+  parser.add_argument('--cpp_source', type=str, default='../src/postprocess.cpp', help='nms_cpu to compile as the reference, empty to skip')
+  parser.add_argument('--cpp_header', type=str, default='../include/postprocess.h', help='header with Bndbox')
+  parser.add_argument('--cxx', type=str, default=os.environ.get('CXX', 'c++'), help='C++ compiler')
+
+  args = parser.parse_args()
+  return args
+
+def main():
+  args = parse_config()
+  from voxelizer import read_params_header
+  params = read_params_header(args.params)
+  anchors, candidates, ms = benchmark_decode(params, args.repeat)
+  print('decode: %d anchors -> %d candidates in %.2f ms' % (anchors, candidates, ms))
+  with tempfile.TemporaryDirectory() as build_dir:
+    cpp = None
+    if args.cpp_source:
+      try:
+        cpp = build_cpp_nms(args.cpp_source, args.cpp_header, build_dir, args.cxx)
+      except (OSError, subprocess.CalledProcessError) as e:
+        print('[WARN] no C++ reference, building nms_cpu of %s failed: %s' % (args.cpp_source, e))
+    rows = benchmark(params, args.sizes, args.reference_max, args.pre_max_size or None, args.repeat, cpp=cpp)
+  print(format_benchmark(rows))
+
+if __name__ == '__main__':
+  main()
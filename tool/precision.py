@@ -0,0 +1,177 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import numpy as np
+
+VARIANTS = ['fp16', 'int8w']
+
+# weights smaller than this stay in fp32 for int8w
+MIN_QUANT_ELEMENTS = 1024
+
+def convert_fp16(onnx_model):
+  """
+  FP16 weights and activations with fp32 graph inputs/outputs. PPScatterPlugin
+  stays fp32 with casts around it, so the plugin boundary and the voxel
+  inputs keep their types. Needs onnxconverter-common.
+  """
+  from onnxconverter_common import float16
+  return float16.convert_float_to_float16(onnx_model, keep_io_types=True, op_block_list=['PPScatterPlugin'])
+
+def quantize_weights_int8(onnx_model, min_elements=MIN_QUANT_ELEMENTS):
+  """
+  Weight-only INT8: every Conv/ConvTranspose/MatMul weight of at least
+  min_elements is stored as symmetric per-output-channel int8 and dequantized
+  by Cast -> Mul in the graph (opset 11 has no per-axis DequantizeLinear).
+  Activations stay fp32.
+  """
+  import onnx
+  import onnx_graphsurgeon as gs
+  graph = gs.import_onnx(onnx_model)
+  # output channel axis of the weight per op, MatMul weights are [in, out]
+  axes = {"Conv": 0, "ConvTranspose": 1, "MatMul": 1}
+  quantized = dict()
+  for node in graph.nodes:
+    if node.op not in axes or len(node.inputs) < 2:
+      continue
+    weight = node.inputs[1]
+    if not isinstance(weight, gs.Constant) or weight.values.dtype != np.float32 or weight.values.size < min_elements:
+      continue
+    if weight.name not in quantized:
+      values = weight.values
+      axis = axes[node.op]
+      reduce_axes = tuple(i for i in range(values.ndim) if i != axis)
+      scale = np.abs(values).max(axis=reduce_axes, keepdims=True) / 127.0
+      scale[scale == 0] = 1.0
+      q = np.clip(np.round(values / scale), -127, 127).astype(np.int8)
+
+      dequant = graph.layer(op="Cast", inputs=[gs.Constant(weight.name + "_int8", q)],
+                            outputs=[weight.name + "_int8_f"], attrs={"to": onnx.TensorProto.FLOAT})[0]
+      dequant = graph.layer(op="Mul", inputs=[dequant, gs.Constant(weight.name + "_scale", scale.astype(np.float32))],
+                            outputs=[weight.name + "_dequant"])[0]
+      dequant.dtype = np.float32
+      dequant.shape = values.shape
+      quantized[weight.name] = dequant
+    node.inputs[1] = quantized[weight.name]
+
+  graph.cleanup().toposort()
+  return gs.export_onnx(graph)
+
+def convert_variant(onnx_model, name):
+  if name == 'fp16':
+    return convert_fp16(onnx_model)
+  if name == 'int8w':
+    return quantize_weights_int8(onnx_model)
+  raise ValueError('Unknown precision variant %r, available: %s' % (name, VARIANTS))
+
+def sigmoid(x):
+  return 1.0 / (1.0 + np.exp(-x.astype(np.float64)))
+
+def _topk_pairs(reference, outputs):
+  """
+  Pairs the valid top-K slots of both runs by anchor, fp16 may reorder
+  near-tied scores and move candidates across score_thresh. Yields per
+  frame the reference and output slots of the shared anchors and the
+  count of missing and extra ones.
+  """
+  for b in range(reference['anchor_idxs'].shape[0]):
+    n_ref, n_out = int(reference['num_candidates'][b]), int(outputs['num_candidates'][b])
+    _, ref_slots, out_slots = np.intersect1d(reference['anchor_idxs'][b, :n_ref], outputs['anchor_idxs'][b, :n_out],
+                                             assume_unique=True, return_indices=True)
+    yield b, ref_slots, out_slots, n_ref - len(ref_slots), n_out - len(out_slots)
+
+def deviation(reference, outputs):
+  """
+  Score and box deviation of one run. Dense heads compare sigmoid(cls_preds)
+  and box_preds, top-K graphs compare scores and box_deltas of the anchors
+  both runs selected and count the missing and extra ones. A top-K run
+  sharing no anchor with a non-empty reference deviates infinitely.
+  """
+  if 'cls_preds' in reference:
+    score_ref, score_out = sigmoid(reference['cls_preds']), sigmoid(outputs['cls_preds'])
+    box_ref, box_out = reference['box_preds'], outputs['box_preds']
+    extra = dict()
+  else:
+    score_ref, score_out, box_ref, box_out = [], [], [], []
+    extra = {'missing': 0, 'extra': 0}
+    for b, ref_slots, out_slots, missing, added in _topk_pairs(reference, outputs):
+      score_ref.append(reference['scores'][b, ref_slots])
+      score_out.append(outputs['scores'][b, out_slots])
+      box_ref.append(reference['box_deltas'][b, ref_slots])
+      box_out.append(outputs['box_deltas'][b, out_slots])
+      extra['missing'] += missing
+      extra['extra'] += added
+    score_ref, score_out = np.concatenate(score_ref), np.concatenate(score_out)
+    box_ref, box_out = np.concatenate(box_ref), np.concatenate(box_out)
+    if not len(score_ref):
+      worst = 0.0 if not (extra['missing'] or extra['extra']) else float('inf')
+      return dict({'score_max': worst, 'score_mean': worst, 'box_max': worst, 'box_mean': worst}, **extra)
+  score = np.abs(score_ref.astype(np.float64) - score_out.astype(np.float64))
+  box = np.abs(box_ref.astype(np.float64) - box_out.astype(np.float64))
+  return dict({'score_max': float(score.max()), 'score_mean': float(score.mean()),
+               'box_max': float(box.max()), 'box_mean': float(box.mean())}, **extra)
+
+def gate_variants(reference_path, variant_paths, frames_inputs, score_tol, box_tol, create_session=None):
+  """
+  Runs the fp32 graph and every variant on ORT CPU over frames_inputs (see
+  onnx_parity.pack_frames) and accepts a variant when its worst score and
+  box deviation stay within the tolerances. create_session(path) defaults
+  to onnx_parity's, cpu_runner's also runs graphs with the PPScatterPlugin.
+  """
+  from onnx_parity import feeds_for
+  if create_session is None:
+    from onnx_parity import create_session
+
+  reference = create_session(reference_path)
+  names = [o.name for o in reference.get_outputs()]
+  sessions, errors = dict(), dict()
+  for name, path in variant_paths.items():
+    try:
+      sessions[name] = create_session(path)
+    except Exception as e:
+      # e.g. no CPU kernel for an fp16 op in this onnxruntime build
+      errors[name] = str(e)
+  runs = {name: [] for name in sessions}
+  for inputs in frames_inputs:
+    expected = dict(zip(names, reference.run(names, feeds_for(reference, inputs))))
+    for name, session in sessions.items():
+      outputs = dict(zip(names, session.run(names, feeds_for(session, inputs))))
+      runs[name].append(deviation(expected, outputs))
+
+  results = {name: {'frames': 0, 'error': error, 'accepted': False} for name, error in errors.items()}
+  for name, frames in runs.items():
+    worst = {key: max(frame[key] for frame in frames) for key in frames[0]} if frames else dict()
+    results[name] = {
+      'frames': len(frames),
+      'worst': worst,
+      'accepted': bool(frames) and worst['score_max'] <= score_tol and worst['box_max'] <= box_tol,
+    }
+  return results
+
+def write_report(output_dir, report_name, report):
+  with open(os.path.join(output_dir, report_name), 'w') as f:
+    json.dump(report, f, indent=2)
+
+def format_report(report):
+  lines = ['%-8s %12s %7s %12s %12s  %s' % ('variant', 'bytes', 'ratio', 'score_max', 'box_max', 'verdict')]
+  if report.get('proxy'):
+    lines.insert(0, 'PROXY gate: deviations measured on conversions of %s, not on the shipped variants' % report['gated_on'])
+  for name, variant in report['variants'].items():
+    worst = variant.get('worst', {})
+    lines.append('%-8s %12d %6.2fx %12.4e %12.4e  %s' % (
+        name, variant['size_bytes'], variant['size_ratio'], worst.get('score_max', float('nan')), worst.get('box_max', float('nan')),
+        'accepted' if variant['accepted'] else 'REJECTED'))
+  return '\n'.join(lines)
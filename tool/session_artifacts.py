@@ -0,0 +1,186 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import time
+import hashlib
+import argparse
+import platform
+import numpy as np
+
+from export_cache import file_digest
+from voxelizer import FEATURES_SIZE
+
+# ONNX Runtime session artifacts: the graph as ORT left it after its own
+# optimizations, saved once and loaded with optimizations off afterwards.
+# ENABLE_ALL may pick layouts and kernels for this CPU and build, so the
+# key carries the runtime version, the machine and the thread setup.
+ARTIFACT_FORMATS = {'ort': '.ort', 'onnx': '.onnx'}
+
+def artifact_key(model_path, intra_op_threads=0, inter_op_threads=0, providers=('CPUExecutionProvider',), fmt='ort'):
+  import onnxruntime as ort
+  return {
+    'model': os.path.basename(model_path),
+    'model_digest': file_digest(model_path),
+    'onnxruntime': ort.__version__,
+    'machine': platform.machine(),
+    'processor': platform.processor(),
+    'providers': list(providers),
+    'intra_op_threads': intra_op_threads,
+    'inter_op_threads': inter_op_threads,
+    'format': fmt,
+  }
+
+def artifact_paths(artifact_dir, key):
+  digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+  stem = os.path.join(artifact_dir, '%s.%s' % (os.path.splitext(key['model'])[0], digest))
+  return stem + ARTIFACT_FORMATS[key['format']], stem + '.json'
+
+def session_options(intra_op_threads=0, inter_op_threads=0):
+  import onnxruntime as ort
+  opts = ort.SessionOptions()
+  opts.intra_op_num_threads = intra_op_threads
+  opts.inter_op_num_threads = inter_op_threads
+  return opts
+
+def build_artifact(model_path, artifact_path, key, providers=('CPUExecutionProvider',)):
+  """
+  Optimizes model_path once with every ORT graph optimization and saves the
+  result to artifact_path, its key goes next to it. Returns the session.
+  """
+  import onnxruntime as ort
+  opts = session_options(key['intra_op_threads'], key['inter_op_threads'])
+  opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+  tmp_path = artifact_path + '.tmp.%d' % os.getpid()
+  opts.optimized_model_filepath = tmp_path
+  if key['format'] == 'ort':
+    opts.add_session_config_entry('session.save_model_format', 'ORT')
+  session = ort.InferenceSession(model_path, opts, providers=list(providers))
+  os.replace(tmp_path, artifact_path)
+
+  key_path = os.path.splitext(artifact_path)[0] + '.json'
+  with open(key_path + '.tmp', 'w') as f:
+    json.dump(key, f, indent=2)
+  os.replace(key_path + '.tmp', key_path)
+  return session
+
+def load_session(model_path, artifact_dir, intra_op_threads=0, inter_op_threads=0, providers=('CPUExecutionProvider',),
+                 fmt='ort', rebuild=False):
+  """
+  ORT session for model_path that skips graph optimization when a matching
+  artifact exists in artifact_dir. A missing, stale or unreadable artifact
+  is rebuilt and saved again. Returns (session, 'hit' or 'built').
+  """
+  import onnxruntime as ort
+  os.makedirs(artifact_dir, exist_ok=True)
+  key = artifact_key(model_path, intra_op_threads, inter_op_threads, providers, fmt)
+  artifact_path, key_path = artifact_paths(artifact_dir, key)
+
+  if not rebuild and os.path.exists(artifact_path) and os.path.exists(key_path):
+    with open(key_path) as f:
+      saved = json.load(f)
+    if saved == key:
+      opts = session_options(intra_op_threads, inter_op_threads)
+      opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+      try:
+        return ort.InferenceSession(artifact_path, opts, providers=list(providers)), 'hit'
+      except Exception as e:
+        print('[WARN] unreadable session artifact %s (%s), rebuilding' % (artifact_path, e))
+  return build_artifact(model_path, artifact_path, key, providers), 'built'
+
+def synthetic_inputs(bucket, fill=0.6, seed=0):
+  """
+  Final-graph inputs for one bucket of pointpillar_buckets.json: fill of
+  every frame's MAX_VOXELS pillars at distinct random cells, packed at the
+  front like the voxelizer does, with random features.
+  """
+  rng = np.random.RandomState(seed)
+  V, P = bucket['inputs']['voxels'][:2]
+  batch_size = bucket['batch_size']
+  grid_x, grid_y = bucket['params_constants']['grid_x_size'], bucket['params_constants']['grid_y_size']
+  per_frame = min(int(bucket['max_voxels'] * fill), grid_x * grid_y)
+  num = per_frame * batch_size
+
+  voxels = np.zeros((V, P, FEATURES_SIZE), dtype=np.float32)
+  voxel_idxs = np.zeros((V, 4), dtype=np.int32)
+  for frame in range(batch_size):
+    rows = slice(frame * per_frame, (frame + 1) * per_frame)
+    cells = rng.choice(grid_x * grid_y, per_frame, replace=False)
+    voxel_idxs[rows, 0] = frame
+    voxel_idxs[rows, 2] = cells // grid_x
+    voxel_idxs[rows, 3] = cells % grid_x
+  voxels[:num] = rng.randn(num, P, FEATURES_SIZE).astype(np.float32)
+  return {'voxels': voxels, 'voxel_idxs': voxel_idxs, 'voxel_num': np.array([num], dtype=np.int32)}
+
+def warmup(session, inputs, iterations=3):
+  # latencies in ms, the first one pays the allocations and first-call setup
+  feeds = {i.name: inputs[i.name] for i in session.get_inputs()}
+  latencies = []
+  for _ in range(iterations):
+    start = time.time()
+    session.run(None, feeds)
+    latencies.append((time.time() - start) * 1000.0)
+  return latencies
+
+def warm_buckets(manifest_path, artifact_dir=None, intra_op_threads=0, inter_op_threads=0, fmt='ort', iterations=3, rebuild=False):
+  """
+  Loads every bucket of a pointpillar_buckets.json through load_session and
+  warms it up on synthetic inputs. Returns ({max_voxels: session}, report).
+  """
+  model_dir = os.path.dirname(os.path.abspath(manifest_path))
+  artifact_dir = artifact_dir or os.path.join(model_dir, 'session_artifacts')
+  with open(manifest_path) as f:
+    manifest = json.load(f)
+
+  sessions, report = dict(), []
+  for bucket in manifest['buckets']:
+    if bucket.get('scatter', 'plugin') == 'plugin':
+      # PPScatterPlugin only runs in TensorRT
+      print('%-32s skipped, exported with --scatter plugin' % bucket['model'])
+      continue
+    start = time.time()
+    session, status = load_session(os.path.join(model_dir, bucket['model']), artifact_dir, intra_op_threads,
+                                   inter_op_threads, fmt=fmt, rebuild=rebuild)
+    load_ms = (time.time() - start) * 1000.0
+    latencies = warmup(session, synthetic_inputs(bucket), iterations)
+    sessions[bucket['max_voxels']] = session
+    report.append({'model': bucket['model'], 'max_voxels': bucket['max_voxels'], 'artifact': status,
+                   'load_ms': load_ms, 'warmup_ms': latencies})
+    print('%-32s %-5s load %8.1f ms  warmup %s ms' % (bucket['model'], status, load_ms,
+                                                      ' '.join('%.1f' % ms for ms in latencies)))
+  return sessions, report
+
+def parse_config():
+  parser = argparse.ArgumentParser(description='build / load pre-optimized ONNX Runtime sessions for the exported buckets')
+  parser.add_argument('manifest', type=str, help='pointpillar_buckets.json of an export')
+  parser.add_argument('--artifact_dir', type=str, default=None, help='defaults to session_artifacts next to the manifest')
+  parser.add_argument('--intra_op_threads', type=int, nargs='+', default=[0], help='one artifact set per thread count')
+  parser.add_argument('--inter_op_threads', type=int, default=0)
+  parser.add_argument('--format', type=str, default='ort', choices=list(ARTIFACT_FORMATS))
+  parser.add_argument('--warmup', type=int, default=3, help='synthetic runs per bucket')
+  parser.add_argument('--rebuild', action='store_true', default=False, help='ignore existing artifacts')
+
+  args = parser.parse_args()
+  return args
+
+def main():
+  args = parse_config()
+  for threads in args.intra_op_threads:
+    print('------ intra_op_threads=%d ------' % threads)
+    warm_buckets(args.manifest, args.artifact_dir, threads, args.inter_op_threads, args.format, args.warmup, args.rebuild)
+
+if __name__ == '__main__':
+  main()
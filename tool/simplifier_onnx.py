@@ -13,12 +13,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import onnx
 import numpy as np
 import onnx_graphsurgeon as gs
+from collections import OrderedDict
+from graph_rewriter import GraphIndex, FUSION_PASS_NAMES
 
 @gs.Graph.register()
-def replace_with_clip(self, inputs, outputs, voxel_array):
+def replace_with_clip(self, inputs, outputs, voxel_array, batch_size=1):
     for inp in inputs:
         inp.outputs.clear()
 
@@ -27,22 +30,165 @@ def replace_with_clip(self, inputs, outputs, voxel_array):
 
     op_attrs = dict()
     op_attrs["dense_shape"] = voxel_array
+    if batch_size != 1:
+      # frames are told apart by column 0 (frame_id) of voxel_idxs
+      op_attrs["batch_size"] = batch_size
 
     return self.layer(name="PPScatter_0", op="PPScatterPlugin", inputs=inputs, outputs=outputs, attrs=op_attrs)
 
-def loop_node(graph, current_node, loop_time=0):
-  for i in range(loop_time):
-    next_node = [node for node in graph.nodes if len(node.inputs) != 0 and len(current_node.outputs) != 0 and node.inputs[0] == current_node.outputs[0]][0]
-    current_node = next_node
-  return next_node
+@gs.Graph.register()
+def replace_with_scatter(self, inputs, outputs, voxel_array, num_pillars, num_features, batch_size=1):
+    for inp in inputs:
+        inp.outputs.clear()
+
+    for out in outputs:
+        out.inputs.clear()
 
-def simplify_postprocess(onnx_model, FEATURE_SIZE_X, FEATURE_SIZE_Y, NUMBER_OF_CLASSES):
+    return build_pillar_scatter(self, inputs[0], inputs[1], inputs[2], outputs[0], voxel_array, num_pillars, num_features, batch_size)
+
+def build_pillar_scatter(graph, pillar_features, voxel_idxs, voxel_num, spatial_features, dense_shape, num_pillars, num_features, batch_size=1):
+  """
+  PPScatterPlugin with standard ops (opset 11), for runtimes without the plugin.
+
+  pillar_features [V, C] (V = num_pillars, C = num_features), voxel_idxs [V, 4] as (frame_id, z, y, x) and voxel_num [1]
+  scatter into spatial_features [batch_size, C, NY, NX] with dense_shape = [NX, NY]
+  as passed to the plugin. Rows from voxel_num on are routed to one extra
+  trash column that is sliced off, so padding never overwrites a pillar.
+  """
+  NX, NY = int(dense_shape[0]), int(dense_shape[1])
+  CELLS = batch_size * NY * NX
+  V, C = int(num_pillars), int(num_features)
+  const = lambda name, values: gs.Constant(name=name, values=np.asarray(values))
+
+  coords = graph.layer(op="Cast", inputs=[voxel_idxs], outputs=["scatter_coords"], attrs={"to": onnx.TensorProto.INT64})[0]
+  column = lambda i, name: graph.layer(op="Gather", inputs=[coords, const("scatter_col%d" % i, np.array(i, dtype=np.int64))],
+                                       outputs=[name], attrs={"axis": 1})[0]
+  frame, y, x = column(0, "scatter_frame"), column(2, "scatter_y"), column(3, "scatter_x")
+  flat = graph.layer(op="Mul", inputs=[frame, const("scatter_frame_stride", np.array(NY * NX, dtype=np.int64))], outputs=["scatter_frame_off"])[0]
+  row = graph.layer(op="Mul", inputs=[y, const("scatter_row_stride", np.array(NX, dtype=np.int64))], outputs=["scatter_row_off"])[0]
+  flat = graph.layer(op="Add", inputs=[flat, row], outputs=["scatter_flat_yx"])[0]
+  flat = graph.layer(op="Add", inputs=[flat, x], outputs=["scatter_flat"])[0]
+
+  num = graph.layer(op="Cast", inputs=[voxel_num], outputs=["scatter_num"], attrs={"to": onnx.TensorProto.INT64})[0]
+  valid = graph.layer(op="Less", inputs=[const("scatter_rows", np.arange(V, dtype=np.int64)), num], outputs=["scatter_valid"])[0]
+  flat = graph.layer(op="Where", inputs=[valid, flat, const("scatter_trash", np.array(CELLS, dtype=np.int64))], outputs=["scatter_index"])[0]
+  flat = graph.layer(op="Unsqueeze", inputs=[flat], outputs=["scatter_index_row"], attrs={"axes": [0]})[0]
+  flat = graph.layer(op="Expand", inputs=[flat, const("scatter_index_shape", np.array([C, V], dtype=np.int64))], outputs=["scatter_index_cv"])[0]
+
+  # [C, V] updates into a [C, CELLS + 1] canvas allocated at runtime
+  updates = graph.layer(op="Transpose", inputs=[pillar_features], outputs=["scatter_updates"], attrs={"perm": [1, 0]})[0]
+  canvas = graph.layer(op="ConstantOfShape", inputs=[const("scatter_canvas_shape", np.array([C, CELLS + 1], dtype=np.int64))],
+                       outputs=["scatter_canvas"], attrs={"value": const("scatter_zero", np.zeros(1, dtype=np.float32))})[0]
+  canvas = graph.layer(op="ScatterElements", inputs=[canvas, flat, updates], outputs=["scatter_filled"], attrs={"axis": 1})[0]
+  canvas = graph.layer(op="Slice", inputs=[canvas, const("scatter_begin", np.array([0], dtype=np.int64)),
+                                           const("scatter_end", np.array([CELLS], dtype=np.int64)),
+                                           const("scatter_axes", np.array([1], dtype=np.int64))], outputs=["scatter_cells"])[0]
+
+  spatial_features.dtype = np.float32
+  spatial_features.shape = (batch_size, C, NY, NX)
+  if batch_size == 1:
+    return graph.layer(op="Reshape", inputs=[canvas, const("scatter_bev_shape", np.array([1, C, NY, NX], dtype=np.int64))], outputs=[spatial_features])
+  canvas = graph.layer(op="Reshape", inputs=[canvas, const("scatter_bev_shape", np.array([C, batch_size, NY, NX], dtype=np.int64))], outputs=["scatter_cbhw"])[0]
+  return graph.layer(op="Transpose", inputs=[canvas], outputs=[spatial_features], attrs={"perm": [1, 0, 2, 3]})
+
+def append_topk(graph, NUMBER_OF_CLASSES, SCORE_THRESH, TOPK, BATCH_SIZE=1):
+  """
+  Replaces the dense head outputs by a compact list of the TOPK best anchors.
+
+  Candidates are ordered like postprocess_kernal: candidate i is anchor i % num_anchors
+  at BEV location i // num_anchors. Anchors below their class' score threshold get
+  score -1 and sort behind the valid ones; num_candidates counts the valid ones.
+  """
+  cls_preds, box_preds, dir_cls_preds = graph.outputs
+  NUM_CANDIDATES = int(np.prod(cls_preds.shape[1:])) // NUMBER_OF_CLASSES
+  assert TOPK <= NUM_CANDIDATES, "TOPK %d exceeds the %d anchors of the head" % (TOPK, NUM_CANDIDATES)
+
+  thresh = np.broadcast_to(np.asarray(SCORE_THRESH, dtype=np.float32), (NUMBER_OF_CLASSES,)).copy()
+  const = lambda name, values: gs.Constant(name=name, values=np.asarray(values))
+
+  scores = gs.Variable(name="scores", dtype=np.float32, shape=(BATCH_SIZE, TOPK))
+  labels = gs.Variable(name="labels", dtype=np.int32, shape=(BATCH_SIZE, TOPK))
+  anchor_idxs = gs.Variable(name="anchor_idxs", dtype=np.int32, shape=(BATCH_SIZE, TOPK))
+  box_deltas = gs.Variable(name="box_deltas", dtype=np.float32, shape=(BATCH_SIZE, TOPK, 7))
+  dir_bins = gs.Variable(name="dir_bins", dtype=np.int32, shape=(BATCH_SIZE, TOPK))
+  num_candidates = gs.Variable(name="num_candidates", dtype=np.int32, shape=(BATCH_SIZE,))
+
+  # [B, FY, FX, A*C] -> [B, FY*FX*A, C]
+  cls = graph.layer(op="Reshape", inputs=[cls_preds, const("topk_cls_shape", np.array([BATCH_SIZE, -1, NUMBER_OF_CLASSES], dtype=np.int64))], outputs=["topk_cls"])[0]
+  box = graph.layer(op="Reshape", inputs=[box_preds, const("topk_box_shape", np.array([BATCH_SIZE, -1, 7], dtype=np.int64))], outputs=["topk_box"])[0]
+  dirs = graph.layer(op="Reshape", inputs=[dir_cls_preds, const("topk_dir_shape", np.array([BATCH_SIZE, -1, 2], dtype=np.int64))], outputs=["topk_dir"])[0]
+
+  # sigmoid is monotonic, so reduce the logits first and squash only the winner
+  logit = graph.layer(op="ReduceMax", inputs=[cls], outputs=["topk_logit"], attrs={"axes": [2], "keepdims": 0})[0]
+  label = graph.layer(op="ArgMax", inputs=[cls], outputs=["topk_label"], attrs={"axis": 2, "keepdims": 0})[0]
+  score = graph.layer(op="Sigmoid", inputs=[logit], outputs=["topk_score"])[0]
+
+  label_thresh = graph.layer(op="Gather", inputs=[const("topk_score_thresh", thresh), label], outputs=["topk_label_thresh"], attrs={"axis": 0})[0]
+  below = graph.layer(op="Less", inputs=[score, label_thresh], outputs=["topk_below"])[0]
+  keep = graph.layer(op="Not", inputs=[below], outputs=["topk_keep"])[0]
+  masked = graph.layer(op="Where", inputs=[keep, score, const("topk_invalid", np.array(-1, dtype=np.float32))], outputs=["topk_masked"])[0]
+
+  count = graph.layer(op="Cast", inputs=[keep], outputs=["topk_keep_f"], attrs={"to": onnx.TensorProto.FLOAT})[0]
+  count = graph.layer(op="ReduceSum", inputs=[count], outputs=["topk_count"], attrs={"axes": [1], "keepdims": 0})[0]
+  count = graph.layer(op="Min", inputs=[count, const("topk_k_f", np.array(TOPK, dtype=np.float32))], outputs=["topk_count_k"])[0]
+  graph.layer(op="Cast", inputs=[count], outputs=[num_candidates], attrs={"to": onnx.TensorProto.INT32})
+
+  top_scores, top_idxs = graph.layer(op="TopK", inputs=[masked, const("topk_k", np.array([TOPK], dtype=np.int64))],
+                                     outputs=["topk_values", "topk_indices"], attrs={"axis": 1, "largest": 1, "sorted": 1})
+  graph.layer(op="Identity", inputs=[top_scores], outputs=[scores])
+  graph.layer(op="Cast", inputs=[top_idxs], outputs=[anchor_idxs], attrs={"to": onnx.TensorProto.INT32})
+
+  top_label = graph.layer(op="GatherElements", inputs=[label, top_idxs], outputs=["topk_top_label"], attrs={"axis": 1})[0]
+  graph.layer(op="Cast", inputs=[top_label], outputs=[labels], attrs={"to": onnx.TensorProto.INT32})
+
+  box_idxs = graph.layer(op="Unsqueeze", inputs=[top_idxs], outputs=["topk_box_idxs"], attrs={"axes": [2]})[0]
+  box_idxs = graph.layer(op="Expand", inputs=[box_idxs, const("topk_box_idxs_shape", np.array([BATCH_SIZE, TOPK, 7], dtype=np.int64))], outputs=["topk_box_idxs_7"])[0]
+  graph.layer(op="GatherElements", inputs=[box, box_idxs], outputs=[box_deltas], attrs={"axis": 1})
+
+  # dir_label = dir[0] > dir[1] ? 0 : 1, ties go to bin 1 like the kernel
+  dir0, dir1 = graph.layer(op="Split", inputs=[dirs], outputs=["topk_dir0", "topk_dir1"], attrs={"axis": 2})
+  dir_bin = graph.layer(op="Greater", inputs=[dir0, dir1], outputs=["topk_dir_gt"])[0]
+  dir_bin = graph.layer(op="Not", inputs=[dir_bin], outputs=["topk_dir_le"])[0]
+  dir_bin = graph.layer(op="Squeeze", inputs=[dir_bin], outputs=["topk_dir_bin"], attrs={"axes": [2]})[0]
+  dir_bin = graph.layer(op="Cast", inputs=[dir_bin], outputs=["topk_dir_bin_i"], attrs={"to": onnx.TensorProto.INT64})[0]
+  top_dir = graph.layer(op="GatherElements", inputs=[dir_bin, top_idxs], outputs=["topk_top_dir"], attrs={"axis": 1})[0]
+  graph.layer(op="Cast", inputs=[top_dir], outputs=[dir_bins], attrs={"to": onnx.TensorProto.INT32})
+
+  graph.outputs = [scores, labels, anchor_idxs, box_deltas, dir_bins, num_candidates]
+  return graph
+
+def head_channels(NUMBER_OF_CLASSES, CLASS_IDXS):
+  """
+  Channels of the (cls, box, dir) heads that belong to the classes CLASS_IDXS.
+  Anchor a = class * 2 + rotation; cls channels are a * NUMBER_OF_CLASSES + class,
+  box channels a * 7 + k and dir channels a * 2 + bin.
+  """
+  anchors = [2 * k + r for k in CLASS_IDXS for r in range(2)]
+  return (
+    [a * NUMBER_OF_CLASSES + k for a in anchors for k in CLASS_IDXS],
+    [a * 7 + i for a in anchors for i in range(7)],
+    [a * 2 + i for a in anchors for i in range(2)],
+  )
+
+def prune_head(conv, channels):
+  weight = conv.inputs[1]
+  conv.inputs[1] = gs.Constant(weight.name + "_pruned", np.ascontiguousarray(weight.values[channels]))
+  if len(conv.inputs) > 2:
+    bias = conv.inputs[2]
+    conv.inputs[2] = gs.Constant(bias.name + "_pruned", np.ascontiguousarray(bias.values[channels]))
+
+def simplify_postprocess(onnx_model, FEATURE_SIZE_X, FEATURE_SIZE_Y, NUMBER_OF_CLASSES, BATCH_SIZE=1, SCORE_THRESH=None, TOPK=None, CLASS_IDXS=None):
   print("Use onnx_graphsurgeon to adjust postprocessing part in the onnx...")
   graph = gs.import_onnx(onnx_model)
 
-  cls_preds = gs.Variable(name="cls_preds", dtype=np.float32, shape=(1, int(FEATURE_SIZE_Y), int(FEATURE_SIZE_X), 2*NUMBER_OF_CLASSES*NUMBER_OF_CLASSES))
-  box_preds = gs.Variable(name="box_preds", dtype=np.float32, shape=(1, int(FEATURE_SIZE_Y), int(FEATURE_SIZE_X), 14*NUMBER_OF_CLASSES))
-  dir_cls_preds = gs.Variable(name="dir_cls_preds", dtype=np.float32, shape=(1, int(FEATURE_SIZE_Y), int(FEATURE_SIZE_X), 4*NUMBER_OF_CLASSES))
+  if CLASS_IDXS is not None:
+    # head convs are sliced below, from here on the graph only knows the kept classes
+    channels = head_channels(NUMBER_OF_CLASSES, CLASS_IDXS)
+    NUMBER_OF_CLASSES = len(CLASS_IDXS)
+
+  cls_preds = gs.Variable(name="cls_preds", dtype=np.float32, shape=(BATCH_SIZE, int(FEATURE_SIZE_Y), int(FEATURE_SIZE_X), 2*NUMBER_OF_CLASSES*NUMBER_OF_CLASSES))
+  box_preds = gs.Variable(name="box_preds", dtype=np.float32, shape=(BATCH_SIZE, int(FEATURE_SIZE_Y), int(FEATURE_SIZE_X), 14*NUMBER_OF_CLASSES))
+  dir_cls_preds = gs.Variable(name="dir_cls_preds", dtype=np.float32, shape=(BATCH_SIZE, int(FEATURE_SIZE_Y), int(FEATURE_SIZE_X), 4*NUMBER_OF_CLASSES))
 
   tmap = graph.tensors()
   new_inputs = [tmap["voxels"], tmap["voxel_idxs"], tmap["voxel_num"]]
@@ -55,25 +201,33 @@ def simplify_postprocess(onnx_model, FEATURE_SIZE_X, FEATURE_SIZE_Y, NUMBER_OF_C
   for out in graph.outputs:
     out.inputs.clear()
 
-  first_ConvTranspose_node = [node for node in graph.nodes if node.op == "ConvTranspose"][0]
-  concat_node = loop_node(graph, first_ConvTranspose_node, 3)
+  index = GraphIndex(graph)
+  # ConvTranspose -> BatchNorm -> Relu -> Concat of the first upsample branch
+  concat_node = index.match_first("ConvTranspose -> * -> * -> Concat", start=index.first("ConvTranspose"))[-1]
   assert concat_node.op == "Concat"
 
-  first_node_after_concat = [node for node in graph.nodes if len(node.inputs) != 0 and len(concat_node.outputs) != 0 and node.inputs[0] == concat_node.outputs[0]]
+  first_node_after_concat = index.next_nodes(concat_node)
+  # head input, the boundary between the backbone and head stages (see split_stages)
+  concat_node.outputs[0].name = "spatial_features_2d"
 
   for i in range(3):
-    transpose_node = loop_node(graph, first_node_after_concat[i], 1)
+    transpose_node = index.walk(first_node_after_concat[i], 1)
     assert transpose_node.op == "Transpose"
-    transpose_node.outputs = [new_outputs[i]]
+    if CLASS_IDXS is not None:
+      assert first_node_after_concat[i].op == "Conv"
+      prune_head(first_node_after_concat[i], channels[i])
+    index.set_outputs(transpose_node, [new_outputs[i]])
 
   graph.inputs = new_inputs
   graph.outputs = new_outputs
+  if TOPK is not None:
+    append_topk(graph, NUMBER_OF_CLASSES, SCORE_THRESH, TOPK, BATCH_SIZE)
   graph.cleanup().toposort()
   
   return gs.export_onnx(graph)
 
 
-def simplify_preprocess(onnx_model, VOXEL_SIZE_X, VOXEL_SIZE_Y, MAX_POINTS_PER_VOXEL):
+def simplify_preprocess(onnx_model, VOXEL_SIZE_X, VOXEL_SIZE_Y, MAX_POINTS_PER_VOXEL, BATCH_SIZE=1, SCATTER="plugin"):
   print("Use onnx_graphsurgeon to modify onnx...")
   graph = gs.import_onnx(onnx_model)
 
@@ -83,7 +237,7 @@ def simplify_preprocess(onnx_model, VOXEL_SIZE_X, VOXEL_SIZE_Y, MAX_POINTS_PER_V
   VOXEL_ARRAY = np.array([int(VOXEL_SIZE_X),int(VOXEL_SIZE_Y)])
 
   # voxels: [V, P, C']
-  # V is the maximum number of voxels per frame
+  # V is the maximum number of voxels per frame, times BATCH_SIZE for batched graphs
   # P is the maximum number of points per voxel
   # C' is the number of channels(features) per point in voxels.
   input_new = gs.Variable(name="voxels", dtype=np.float32, shape=(MAX_VOXELS, MAX_POINTS_PER_VOXEL, 10))
@@ -94,47 +248,290 @@ def simplify_preprocess(onnx_model, VOXEL_SIZE_X, VOXEL_SIZE_Y, MAX_POINTS_PER_V
   X = gs.Variable(name="voxel_idxs", dtype=np.int32, shape=(MAX_VOXELS, 4))
 
   # voxel_num: [1]
-  # Gives valid voxels number for each frame
+  # Gives valid voxels number for each frame, for batched graphs the total
+  # over all frames with the valid voxels packed at the front
   Y = gs.Variable(name="voxel_num", dtype=np.int32, shape=(1,))
 
-  first_node_after_pillarscatter = [node for node in graph.nodes if node.op == "Conv"][0]
+  index = GraphIndex(graph)
+  first_node_after_pillarscatter = index.first("Conv")
 
-  first_node_pillarvfe = [node for node in graph.nodes if node.op == "MatMul"][0]
-
-  next_node = current_node = first_node_pillarvfe
-  for i in range(6):
-    next_node = [node for node in graph.nodes if node.inputs[0] == current_node.outputs[0]][0]
-    if i == 5:              # ReduceMax
-      current_node.attrs['keepdims'] = [0]
-      break
-    current_node = next_node
-
-  last_node_pillarvfe = current_node
+  # MatMul -> BatchNorm -> Relu -> ... -> ReduceMax of the PFN layer
+  pillarvfe = index.match_first("MatMul -> ... -> ReduceMax", start=index.first("MatMul"))
+  first_node_pillarvfe = pillarvfe[0]
+  last_node_pillarvfe = pillarvfe[-1]
+  last_node_pillarvfe.attrs['keepdims'] = [0]
+  # PFN output, the boundary between the pfn and backbone stages (see split_stages)
+  pillar_features = last_node_pillarvfe.outputs[0]
+  pillar_features.name = "pillar_features"
+  pillar_features.dtype = np.float32
+  pillar_features.shape = (MAX_VOXELS, first_node_after_pillarscatter.inputs[1].values.shape[1])
 
   #merge some layers into one layer between inputs and outputs as below
   graph.inputs.append(Y)
   inputs = [last_node_pillarvfe.outputs[0], X, Y]
   outputs = [first_node_after_pillarscatter.inputs[0]]
-  graph.replace_with_clip(inputs, outputs, VOXEL_ARRAY)
+  if SCATTER == "plugin":
+    graph.replace_with_clip(inputs, outputs, VOXEL_ARRAY, BATCH_SIZE)
+  else:
+    # standard onnx ops, runs outside TensorRT
+    # the backbone's first Conv tells the number of scattered channels
+    NUM_FEATURES = first_node_after_pillarscatter.inputs[1].values.shape[1]
+    graph.replace_with_scatter(inputs, outputs, VOXEL_ARRAY, MAX_VOXELS, NUM_FEATURES, BATCH_SIZE)
+  index.sync()
 
   # Remove the now-dangling subgraph.
-  graph.cleanup().toposort()
+  index.cleanup()
 
   #just keep some layers between inputs and outputs as below
   graph.inputs = [first_node_pillarvfe.inputs[0] , X, Y]
-  graph.outputs = [tmap["cls_preds"], tmap["box_preds"], tmap["dir_cls_preds"]]
+  # keep whatever outputs simplify_postprocess produced (dense heads or top-k candidates)
+  graph.outputs = [tmap[out.name] for out in graph.outputs]
 
   graph.cleanup()
 
   #Rename the first tensor for the first layer 
   graph.inputs = [input_new, X, Y]
-  first_add = [node for node in graph.nodes if node.op == "MatMul"][0]
-  first_add.inputs[0] = input_new
+  index.reindex()
+  first_add = index.first("MatMul")
+  index.set_input(first_add, 0, input_new)
 
   graph.cleanup().toposort()
 
   return gs.export_onnx(graph)
 
+# name -> (pass, enabled by default), see fusion_pass()
+FUSION_PASSES = OrderedDict()
+
+def fusion_pass(name, default=True):
+  """
+  Registers fn(graph, index) -> number of rewrites as a fusion pass. Passes
+  run in registration order on the final graph; each one leaves the graph
+  cleaned up and the index in sync.
+  """
+  assert name in FUSION_PASS_NAMES, "Fusion pass %r missing from graph_rewriter.FUSION_PASS_NAMES" % name
+  def register(fn):
+    FUSION_PASSES[name] = (fn, default)
+    return fn
+  return register
+
+def default_fusion_passes():
+  return [name for name, (_, default) in FUSION_PASSES.items() if default]
+
+def fold_batchnorm(weight, bias, gamma, beta, mean, var, epsilon, channel_axis):
+  """
+  Weight and bias of a layer followed by a BatchNormalization over
+  channel_axis of the weight, computed in float64 and returned in the
+  weight's dtype. bias is None for layers without one. weight_swap.py
+  replays this to refold new checkpoints bit for bit.
+  """
+  gamma, beta, mean, var = [np.asarray(t).astype(np.float64) for t in (gamma, beta, mean, var)]
+  scale = gamma / np.sqrt(var + epsilon)
+  shape = [1] * weight.ndim
+  shape[channel_axis] = -1
+  new_bias = beta - mean * scale
+  if bias is not None:
+    new_bias = bias.astype(np.float64) * scale + new_bias
+  return (weight * scale.reshape(shape)).astype(weight.dtype), new_bias.astype(weight.dtype)
+
+def _batchnorm_params(bn):
+  # (gamma, beta, mean, var, epsilon) of a BatchNormalization with constant statistics
+  if len(bn.inputs) < 5 or not all(isinstance(t, gs.Constant) for t in bn.inputs[1:5]):
+    return None
+  return [t.values for t in bn.inputs[1:5]] + [bn.attrs.get("epsilon", 1e-5)]
+
+def _sole_consumer(index, node):
+  return len(node.outputs) == 1 and len(node.outputs[0].outputs) == 1 and node.outputs[0] not in index.graph.outputs
+
+def _fold_into_conv(index, op, channel_axis):
+  count = 0
+  for conv, bn in index.match("%s -> BatchNormalization" % op):
+    statistics = _batchnorm_params(bn)
+    weight = conv.inputs[1]
+    if statistics is None or not isinstance(weight, gs.Constant) or not _sole_consumer(index, conv):
+      continue
+    if conv.attrs.get("group", 1) != 1 and op == "ConvTranspose":
+      continue
+    old_bias = conv.inputs[2].values if len(conv.inputs) > 2 else None
+    new_weight, new_bias = fold_batchnorm(weight.values, old_bias, *statistics, channel_axis=channel_axis)
+
+    conv.inputs[1] = gs.Constant(weight.name + "_bn", new_weight)
+    bias = gs.Constant(bn.name + "_bias", new_bias)
+    if len(conv.inputs) > 2:
+      conv.inputs[2] = bias
+    else:
+      conv.inputs.append(bias)
+    outputs = list(bn.outputs)
+    bn.outputs.clear()
+    index.set_outputs(conv, outputs)
+    count += 1
+  return count
+
+@fusion_pass("fold_bn_matmul")
+def fold_bn_matmul(graph, index):
+  """
+  PFN: MatMul -> Transpose -> BatchNormalization -> Transpose, the BN acting
+  on the last axis of the MatMul output, becomes MatMul -> Add.
+  """
+  count = 0
+  for chain in index.match("MatMul -> Transpose -> BatchNormalization -> Transpose"):
+    matmul, transpose_in, bn, transpose_out = chain
+    statistics = _batchnorm_params(bn)
+    weight = matmul.inputs[1]
+    if statistics is None or not isinstance(weight, gs.Constant) or weight.values.ndim != 2:
+      continue
+    if list(transpose_in.attrs.get("perm", [])) != [0, 2, 1] or list(transpose_out.attrs.get("perm", [])) != [0, 2, 1]:
+      continue
+    if not all(_sole_consumer(index, node) for node in chain[:-1]):
+      continue
+    new_weight, new_bias = fold_batchnorm(weight.values, None, *statistics, channel_axis=1)
+    index.set_input(matmul, 1, gs.Constant(weight.name + "_bn", new_weight))
+    outputs = list(transpose_out.outputs)
+    transpose_out.outputs.clear()
+    index.add_node(gs.Node(op="Add", name=bn.name + "_bias",
+                           inputs=[matmul.outputs[0], gs.Constant(bn.name + "_bias", new_bias)], outputs=outputs))
+    count += 1
+  return count
+
+@fusion_pass("fold_bn_conv")
+def fold_bn_conv(graph, index):
+  # Conv weights are [O, I, kh, kw]
+  return _fold_into_conv(index, "Conv", 0)
+
+@fusion_pass("fold_bn_convtranspose")
+def fold_bn_convtranspose(graph, index):
+  """
+  ConvTranspose -> BatchNormalization -> Relu of the upsample branches becomes
+  ConvTranspose -> Relu, which TensorRT runs as a single deconvolution with
+  fused activation. ConvTranspose weights are [I, O, kh, kw].
+  """
+  return _fold_into_conv(index, "ConvTranspose", 1)
+
+@fusion_pass("drop_output_transpose", default=False)
+def drop_output_transpose(graph, index):
+  """
+  Makes the heads output their Conv results in NCHW instead of transposing to
+  NHWC. The outputs keep their names; postprocess_kernal expects NHWC, so the
+  consumer has to read the manifest's layout. Outputs of the top-K tail are
+  not head transposes and are left alone.
+  """
+  count = 0
+  for i, out in enumerate(list(graph.outputs)):
+    transpose = index.producer(out)
+    if transpose is None or transpose.op != "Transpose" or list(transpose.attrs.get("perm", [])) != [0, 2, 3, 1]:
+      continue
+    head = transpose.inputs[0]
+    if len(head.outputs) != 1:
+      continue
+    name = out.name
+    out.name = name + "_nhwc"
+    head.name = name
+    head.dtype = out.dtype
+    if out.shape is not None:
+      head.shape = [out.shape[d] for d in (0, 3, 1, 2)]
+    transpose.outputs.clear()
+    graph.outputs[i] = head
+    count += 1
+  return count
+
+def fuse_onnx(onnx_model, passes=None):
+  """
+  Runs the named fusion passes (default_fusion_passes() if None) and returns
+  the model and a per-pass report of rewrites and node counts. The report is
+  also stored in the model's metadata under "fusion_report".
+  """
+  if passes is None:
+    passes = default_fusion_passes()
+  unknown = [name for name in passes if name not in FUSION_PASSES]
+  assert not unknown, "Unknown fusion passes %s, available: %s" % (unknown, list(FUSION_PASSES))
+
+  graph = gs.import_onnx(onnx_model)
+  index = GraphIndex(graph)
+  report = OrderedDict()
+  for name, (fn, _) in FUSION_PASSES.items():
+    if name not in passes:
+      report[name] = {"enabled": False}
+      continue
+    nodes_before = len(graph.nodes)
+    rewrites = fn(graph, index)
+    index.cleanup()
+    report[name] = {"enabled": True, "rewrites": rewrites, "nodes_before": nodes_before, "nodes_after": len(graph.nodes)}
+    print("Fusion pass %-24s %3d rewrites, %4d -> %4d nodes" % (name, rewrites, nodes_before, len(graph.nodes)))
+
+  report["layout"] = "NCHW" if report["drop_output_transpose"].get("rewrites") else "NHWC"
+  fused = gs.export_onnx(graph)
+  onnx.helper.set_model_props(fused, {"fusion_report": json.dumps(report)})
+  return fused, report
+
+# stage -> (inputs, outputs) of the sub-graphs split_stages cuts the final graph into,
+# None stands for the graph outputs
+STAGES = OrderedDict([
+  ("pfn", (["voxels"], ["pillar_features"])),
+  ("backbone", (["pillar_features", "voxel_idxs", "voxel_num"], ["spatial_features_2d"])),
+  ("head", (["spatial_features_2d"], None)),
+])
+
+def split_stages(onnx_model, FEATURE_SIZE_X, FEATURE_SIZE_Y, BATCH_SIZE=1):
+  """
+  Cuts the final graph at the boundary tensors named by simplify_preprocess
+  (pillar_features [V, C]) and simplify_postprocess (spatial_features_2d
+  [B, C', FY, FX]) into the three chained STAGES, so an executor can run
+  frame N's backbone next to frame N+1's pillar encoding. Returns an
+  OrderedDict stage -> ModelProto.
+  """
+  graph = gs.import_onnx(onnx_model)
+  tmap = graph.tensors()
+  missing = [name for name in ("pillar_features", "spatial_features_2d") if name not in tmap]
+  assert not missing, "Graph has no boundary tensors %s, export it again to split it" % missing
+
+  spatial_features = tmap["spatial_features_2d"]
+  head_conv = next(node for node in spatial_features.outputs if node.op == "Conv")
+  spatial_features.dtype = np.float32
+  spatial_features.shape = (BATCH_SIZE, head_conv.inputs[1].values.shape[1], int(FEATURE_SIZE_Y), int(FEATURE_SIZE_X))
+
+  stages = OrderedDict()
+  for name, (inputs, outputs) in STAGES.items():
+    stage = graph.copy()
+    tensors = stage.tensors()
+    stage.inputs = [tensors[t] for t in inputs]
+    stage.outputs = [tensors[t.name] for t in graph.outputs] if outputs is None else [tensors[t] for t in outputs]
+    # whatever produced the stage inputs belongs to the stage before
+    for tensor in stage.inputs:
+      tensor.inputs.clear()
+    stage.cleanup().toposort()
+
+    unfed = set(t.name for node in stage.nodes for t in node.inputs
+                if isinstance(t, gs.Variable) and t.name and not t.inputs and t not in stage.inputs)
+    assert not unfed, "Stage %s needs %s beyond its inputs %s" % (name, sorted(unfed), inputs)
+    stages[name] = gs.export_onnx(stage)
+    print("Stage %-8s %4d nodes, %s -> %s" % (name, len(stage.nodes), [t.name for t in stage.inputs], [t.name for t in stage.outputs]))
+  return stages
+
+def describe_stages(stage_models):
+  """
+  Manifest of the split stages: inputs and outputs with their shapes, and
+  for every input whether it is a graph input or which stage produces it.
+  stage_models maps stage -> (file, ModelProto).
+  """
+  io = lambda values: OrderedDict((v.name, [d.dim_value for d in v.type.tensor_type.shape.dim]) for v in values)
+  producers = dict()
+  manifest = {"order": list(stage_models), "stages": OrderedDict()}
+  for name, (model_file, model) in stage_models.items():
+    inputs, outputs = io(model.graph.input), io(model.graph.output)
+    manifest["stages"][name] = {
+      "model": model_file,
+      "inputs": inputs,
+      "outputs": outputs,
+      "feeds": OrderedDict((t, producers.get(t, "graph")) for t in inputs),
+    }
+    producers.update((t, name) for t in outputs)
+  return manifest
+
+def fusion_report(onnx_model):
+  for prop in onnx_model.metadata_props:
+    if prop.key == "fusion_report":
+      return json.loads(prop.value, object_pairs_hook=OrderedDict)
+  return None
+
 if __name__ == '__main__':
     mode_file = "pointpillar-native-sim.onnx"
     simplify_preprocess(onnx.load(mode_file))
@@ -0,0 +1,244 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import re
+import glob
+import time
+import argparse
+import numpy as np
+
+# number of channels per point in the "voxels" input of the final graph
+FEATURES_SIZE = 10
+
+def generate_features(voxels, voxel_num_points, voxel_coords, params):
+  """
+  NumPy counterpart of generateFeatures_kernel (4 channels -> 10 channels).
+
+  voxels:           [M, P, 4] float32, (x, y, z, intensity) per point
+  voxel_num_points: [M] valid points per pillar
+  voxel_coords:     [M, 3] pillar index as (z, y, x)
+  params:           dict from exporter_paramters.collect_paramters
+
+  Returns [M, P, 10] float32 laid out as (x, y, z, i, x-mean, y-mean, z-mean,
+  x-center, y-center, z-center); padded points are all zero.
+  """
+  voxels = np.asarray(voxels, dtype=np.float32)
+  num_points = np.asarray(voxel_num_points).reshape(-1)
+  coords = np.asarray(voxel_coords)
+
+  valid = np.arange(voxels.shape[1])[None, :] < num_points[:, None]
+  xyz = voxels[:, :, :3]
+
+  mean = np.where(valid[:, :, None], xyz, 0).sum(axis=1, dtype=np.float32)
+  mean /= np.maximum(num_points, 1).astype(np.float32)[:, None]
+
+  voxel_size = np.array([params['pillar_x_size'], params['pillar_y_size'], params['pillar_z_size']], dtype=np.float32)
+  range_min = np.array([params['min_x_range'], params['min_y_range'], params['min_z_range']], dtype=np.float32)
+  # (z, y, x) -> (x, y, z)
+  center = voxel_size / 2 + coords[:, ::-1].astype(np.float32) * voxel_size + range_min
+
+  features = np.concatenate([voxels, xyz - mean[:, None, :], xyz - center[:, None, :]], axis=2)
+  features[~valid] = 0
+  return features.astype(np.float32, copy=False)
+
+def read_params_header(path):
+  """
+  The Params of a params.h written by exporter_paramters.export_paramters, as
+  the dict collect_paramters returns. Derived sizes are evaluated in float32
+  like the C++ initializers.
+  """
+  with open(path) as f:
+    text = f.read()
+  params = dict()
+  match = re.search(r'const int MAX_VOXELS = (\d+);', text)
+  params['MAX_VOXELS'] = int(match.group(1))
+  for kind, name, value in re.findall(r'const (int|float) (\w+) = ([-+0-9.eE]+);', text):
+    if name != 'MAX_VOXELS':
+      params[name] = int(value) if kind == 'int' else float(value)
+  for name, values in re.findall(r'const float (\w+)\s*\[[^\]]*\]\s*=\s*\{(.*?)\};', text, re.S):
+    params[name] = [float(v) for v in values.replace('\n', ' ').split(',') if v.strip()]
+  names = re.search(r'class_name\s*\[[^\]]*\]\s*=\s*\{(.*?)\};', text, re.S).group(1)
+  params['class_name'] = re.findall(r'"([^"]*)"', names)
+
+  f32 = np.float32
+  params.setdefault('batch_size', 1)
+  params['num_anchors'] = params['num_classes'] * 2
+  for axis in 'xyz':
+    extent = f32(params['max_%s_range' % axis]) - f32(params['min_%s_range' % axis])
+    params['grid_%s_size' % axis] = int(extent / f32(params['pillar_%s_size' % axis]))
+  params['feature_x_size'] = params['grid_x_size'] // 2
+  params['feature_y_size'] = params['grid_y_size'] // 2
+  return params
+
+def _pillar_cells(points, params):
+  # range filter and pillar index of generateVoxels_random_kernel, all in float32
+  f32 = np.float32
+  x, y, z = points[:, 0], points[:, 1], points[:, 2]
+  keep = ((x >= f32(params['min_x_range'])) & (x < f32(params['max_x_range'])) &
+          (y >= f32(params['min_y_range'])) & (y < f32(params['max_y_range'])) &
+          (z >= f32(params['min_z_range'])) & (z < f32(params['max_z_range'])))
+  ids = np.flatnonzero(keep)
+  ix = np.floor((x[ids] - f32(params['min_x_range'])) / f32(params['pillar_x_size'])).astype(np.int64)
+  iy = np.floor((y[ids] - f32(params['min_y_range'])) / f32(params['pillar_y_size'])).astype(np.int64)
+  # the kernel never clamps ix, a point rounding onto grid_x_size lands in the next row's first cell
+  cells = iy * params['grid_x_size'] + ix
+  inside = cells < params['grid_x_size'] * params['grid_y_size']
+  return ids[inside], cells[inside]
+
+def voxelize(points, params, MAX_VOXELS=None):
+  """
+  NumPy counterpart of generateVoxels_random_kernel + generateBaseFeatures_kernel
+  for one frame of [N, num_point_values] points, without a per-point loop.
+
+  The kernels assign pillar and point slots with atomics, so their order is
+  not fixed. Here it is the order a serial run of the kernels gives:
+  pillars by cell (row-major y, x), and in each pillar the first
+  max_num_points_per_pillar points in input order. Pillars past MAX_VOXELS
+  are dropped.
+
+  Returns voxels [M, P, 4], voxel_num_points [M], voxel_coords [M, 3] as
+  (z, y, x) and the number of dropped pillars.
+  """
+  MAX_VOXELS = params['MAX_VOXELS'] if MAX_VOXELS is None else MAX_VOXELS
+  P = params['max_num_points_per_pillar']
+  points = np.asarray(points, dtype=np.float32).reshape(-1, params.get('num_point_values', 4))[:, :4]
+
+  ids, cells = _pillar_cells(points, params)
+  # stable, so points keep their input order inside a pillar
+  order = np.argsort(cells, kind='stable')
+  ids, cells = ids[order], cells[order]
+  pillar_cells, starts, counts = np.unique(cells, return_index=True, return_counts=True)
+  pillar = np.repeat(np.arange(len(pillar_cells)), counts)
+  slot = np.arange(len(cells)) - np.repeat(starts, counts)
+
+  num = min(len(pillar_cells), MAX_VOXELS)
+  take = (slot < P) & (pillar < num)
+  voxels = np.zeros((num, P, 4), dtype=np.float32)
+  voxels[pillar[take], slot[take]] = points[ids[take]]
+
+  coords = np.zeros((num, 3), dtype=np.int32)
+  coords[:, 1] = pillar_cells[:num] // params['grid_x_size']
+  coords[:, 2] = pillar_cells[:num] % params['grid_x_size']
+  return voxels, np.minimum(counts[:num], P).astype(np.int32), coords, len(pillar_cells) - num
+
+def voxelize_frames(frames, params, MAX_VOXELS=None):
+  """
+  The final graph's inputs for one or more point clouds: features [N*V, P, 10]
+  (the "voxels" input), voxel_idxs [N*V, 4] as (frame_id, z, y, x) and
+  voxel_num [1], valid pillars of all frames packed at the front. Also
+  returns the 4-channel voxels and voxel_num_points like
+  onnx_parity.pack_frames, so onnx_parity.feeds_for accepts the result.
+  """
+  MAX_VOXELS = params['MAX_VOXELS'] if MAX_VOXELS is None else MAX_VOXELS
+  P = params['max_num_points_per_pillar']
+  V = len(frames) * MAX_VOXELS
+  inputs = {
+    'voxels': np.zeros((V, P, 4), dtype=np.float32),
+    'voxel_idxs': np.zeros((V, 4), dtype=np.int32),
+    'voxel_num_points': np.zeros((V,), dtype=np.int32),
+    'features': np.zeros((V, P, FEATURES_SIZE), dtype=np.float32),
+    'dropped_pillars': [],
+  }
+  count = 0
+  for frame_id, points in enumerate(frames):
+    voxels, num_points, coords, dropped = voxelize(points, params, MAX_VOXELS)
+    rows = slice(count, count + len(voxels))
+    inputs['voxels'][rows] = voxels
+    inputs['voxel_num_points'][rows] = num_points
+    inputs['voxel_idxs'][rows, 0] = frame_id
+    inputs['voxel_idxs'][rows, 1:] = coords
+    inputs['features'][rows] = generate_features(voxels, num_points, coords, params)
+    inputs['dropped_pillars'].append(dropped)
+    count += len(voxels)
+  inputs['voxel_num'] = np.array([count], dtype=np.int32)
+  return inputs
+
+def voxelize_reference(points, params, MAX_VOXELS=None):
+  """
+  Per-point loop, only to check voxelize. Range filter and cell index are
+  computed independently of _pillar_cells, one point at a time with the
+  float32 scalar statements of generateVoxels_random_kernel.
+  """
+  MAX_VOXELS = params['MAX_VOXELS'] if MAX_VOXELS is None else MAX_VOXELS
+  P = params['max_num_points_per_pillar']
+  points = np.asarray(points, dtype=np.float32).reshape(-1, params.get('num_point_values', 4))[:, :4]
+  f32 = np.float32
+  min_x, max_x = f32(params['min_x_range']), f32(params['max_x_range'])
+  min_y, max_y = f32(params['min_y_range']), f32(params['max_y_range'])
+  min_z, max_z = f32(params['min_z_range']), f32(params['max_z_range'])
+  size_x, size_y = f32(params['pillar_x_size']), f32(params['pillar_y_size'])
+  grid_x, grid_y = params['grid_x_size'], params['grid_y_size']
+  pillars = dict()
+  for i in range(len(points)):
+    x, y, z = points[i, 0], points[i, 1], points[i, 2]
+    if x < min_x or x >= max_x or y < min_y or y >= max_y or z < min_z or z >= max_z:
+      continue
+    voxel_idx = int(np.floor((x - min_x) / size_x))
+    voxel_idy = int(np.floor((y - min_y) / size_y))
+    cell = voxel_idy * grid_x + voxel_idx
+    # past the mask the kernel writes out of bounds, voxelize drops those points
+    if cell >= grid_x * grid_y:
+      continue
+    pillars.setdefault(cell, []).append(i)
+  cells = sorted(pillars)[:MAX_VOXELS]
+  voxels = np.zeros((len(cells), P, 4), dtype=np.float32)
+  num_points = np.zeros((len(cells),), dtype=np.int32)
+  coords = np.zeros((len(cells), 3), dtype=np.int32)
+  for k, cell in enumerate(cells):
+    kept = pillars[cell][:P]
+    voxels[k, :len(kept)] = points[kept]
+    num_points[k] = len(kept)
+    coords[k] = (0, cell // params['grid_x_size'], cell % params['grid_x_size'])
+  return voxels, num_points, coords, len(pillars) - len(cells)
+
+def parse_config():
+  parser = argparse.ArgumentParser(description='benchmark the NumPy pillar voxelizer on point cloud frames')
+  parser.add_argument('--params', type=str, default='../include/params.h', help='params.h written by the exporter')
+  parser.add_argument('--data_path', type=str, default='../data', help='directory of .bin point clouds')
+  parser.add_argument('--repeat', type=int, default=10, help='timed runs per frame')
+  parser.add_argument('--check', action='store_true', default=False, help='compare every frame with the per-point reference loop')
+
+  args = parser.parse_args()
+  return args
+
+def main():
+  args = parse_config()
+  params = read_params_header(args.params)
+  files = sorted(glob.glob(os.path.join(args.data_path, '*.bin')))
+  print('%-12s %9s %8s %8s %11s %11s' % ('frame', 'points', 'pillars', 'dropped', 'voxelize ms', 'features ms'))
+  totals = []
+  for path in files:
+    points = np.fromfile(path, dtype=np.float32)
+    start = time.time()
+    for _ in range(args.repeat):
+      voxels, num_points, coords, dropped = voxelize(points, params)
+    middle = time.time()
+    for _ in range(args.repeat):
+      generate_features(voxels, num_points, coords, params)
+    end = time.time()
+    voxelize_ms, features_ms = (middle - start) * 1000.0 / args.repeat, (end - middle) * 1000.0 / args.repeat
+    totals.append(voxelize_ms + features_ms)
+    print('%-12s %9d %8d %8d %11.2f %11.2f' % (os.path.basename(path), points.size // params.get('num_point_values', 4),
+                                              len(voxels), dropped, voxelize_ms, features_ms))
+    if args.check:
+      expected = voxelize_reference(points, params)
+      same = all(np.array_equal(a, b) for a, b in zip((voxels, num_points, coords), expected[:3])) and dropped == expected[3]
+      assert same, '%s: voxelize differs from the reference loop' % path
+  if totals:
+    print('mean %.2f ms per frame over %d frames%s' % (np.mean(totals), len(totals), ', matches the reference loop' if args.check else ''))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,293 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import glob
+import json
+import hashlib
+import numpy as np
+import onnx
+from onnx import numpy_helper
+from collections import defaultdict
+
+from simplifier_onnx import fold_batchnorm
+
+# A swap recipe tells where every weight initializer of an exported graph
+# comes from in the checkpoint's state_dict:
+#   copy  the parameter itself, optionally transposed (Linear -> MatMul) or
+#         restricted to some output rows (class-pruned heads)
+#   fold  a layer's weight or bias with its BatchNorm folded in, using the
+#         formula that reproduced the template's bits
+# Applying the recipes of a template graph to a checkpoint of the same
+# architecture gives the graph a full export of that checkpoint would give.
+LAYER_OPS = {"Conv": "Conv", "ConvTranspose": "ConvTranspose", "MatMul": "Linear"}
+FOLD_FORMULAS = ['np64', 'f32_div', 'f32_rsqrt']
+BN_PARAMS = ['weight', 'bias', 'running_mean', 'running_var']
+# float initializers this small that match no parameter are structural constants
+MIN_WEIGHT_ELEMENTS = 64
+# a fold that does not reproduce the template bits is only accepted this close
+MAX_FOLD_ERROR = 1e-4
+
+def expand_checkpoints(paths):
+  # files as given, directories contribute their *.pth in name order
+  ckpts = []
+  for path in paths:
+    ckpts.extend(sorted(glob.glob(os.path.join(path, '*.pth'))) if os.path.isdir(path) else [path])
+  stems = [os.path.splitext(os.path.basename(ckpt))[0] for ckpt in ckpts]
+  duplicates = sorted(set(stem for stem in stems if stems.count(stem) > 1))
+  if duplicates:
+    raise ValueError('Checkpoints %s share a file name, their outputs would collide' % duplicates)
+  return list(zip(stems, ckpts))
+
+def state_dict_arrays(state_dict):
+  return {name: value.detach().cpu().numpy() for name, value in state_dict.items()
+          if hasattr(value, 'is_floating_point') and value.is_floating_point()}
+
+def load_checkpoint(path):
+  import torch
+  checkpoint = torch.load(path, map_location='cpu')
+  return state_dict_arrays(checkpoint.get('model_state', checkpoint))
+
+def module_pairs(model):
+  """
+  Conv2d / ConvTranspose2d / Linear layers directly followed by a BatchNorm,
+  in module order, i.e. the layers an export folds.
+  """
+  import torch
+  kinds = [(torch.nn.ConvTranspose2d, 'ConvTranspose'), (torch.nn.Conv2d, 'Conv'), (torch.nn.Linear, 'Linear')]
+  leaves = [(name, module) for name, module in model.named_modules() if not list(module.children())]
+  pairs = []
+  for (name, module), (next_name, next_module) in zip(leaves, leaves[1:]):
+    kind = next((kind for cls, kind in kinds if isinstance(module, cls)), None)
+    if kind is not None and isinstance(next_module, torch.nn.modules.batchnorm._BatchNorm):
+      pairs.append({'layer': name, 'bn': next_name, 'kind': kind, 'eps': float(next_module.eps)})
+  return pairs
+
+def fold_formula(formula, weight, bias, gamma, beta, mean, var, epsilon, channel_axis):
+  """
+  np64 is the fusion pass of simplifier_onnx, f32_div / f32_rsqrt replay a
+  float32 fold as done by the torch exporter for Conv + BatchNorm.
+  """
+  if formula == 'np64':
+    return fold_batchnorm(weight, bias, gamma, beta, mean, var, epsilon, channel_axis)
+  f32 = np.float32
+  std = np.sqrt(var.astype(f32) + f32(epsilon))
+  scale = gamma / std if formula == 'f32_div' else gamma * (f32(1) / std)
+  shape = [1] * weight.ndim
+  shape[channel_axis] = -1
+  new_bias = beta - mean * scale
+  if bias is not None:
+    new_bias = new_bias + bias * scale
+  return (weight * scale.reshape(shape)).astype(weight.dtype), new_bias.astype(weight.dtype)
+
+def evaluate(recipe, state_dict):
+  # the initializer value the recipe gives for state_dict
+  if recipe['source'] == 'copy':
+    value = state_dict[recipe['param']]
+  else:
+    layer, bn = recipe['layer'], recipe['bn']
+    weight = state_dict[layer + '.weight']
+    if recipe['kind'] == 'Linear':
+      weight = weight.T
+    statistics = [state_dict[bn + '.' + name] for name in BN_PARAMS]
+    folded = fold_formula(recipe['formula'], weight, state_dict.get(layer + '.bias'), *statistics,
+                          epsilon=recipe['eps'], channel_axis=recipe['axis'])
+    value = folded[0 if recipe['part'] == 'weight' else 1]
+  if recipe.get('transpose'):
+    value = value.T
+  if recipe.get('rows') is not None:
+    value = value[recipe['rows']]
+  return np.ascontiguousarray(value)
+
+def _digest(array):
+  array = np.ascontiguousarray(array)
+  return hashlib.sha1(str((array.dtype.str, array.shape)).encode('utf-8') + array.tobytes()).hexdigest()
+
+class _StateIndex(object):
+  # digests of every parameter, its transpose and the rows of its weights
+  def __init__(self, state_dict):
+    self.state_dict = state_dict
+    self.copies = defaultdict(list)
+    self.rows = dict()
+    for name, value in state_dict.items():
+      self.copies[_digest(value)].append((name, False))
+      if value.ndim == 2:
+        self.copies[_digest(value.T)].append((name, True))
+      if value.ndim >= 2 and value.size >= MIN_WEIGHT_ELEMENTS:
+        for row in range(value.shape[0]):
+          self.rows.setdefault(_digest(value[row]), (name, row))
+
+  def match(self, target, prefer=None):
+    candidates = self.copies.get(_digest(target), [])
+    if prefer is not None and any(name == prefer for name, _ in candidates):
+      candidates = [c for c in candidates if c[0] == prefer]
+    if len(set(name for name, _ in candidates)) > 1:
+      raise ValueError('Initializer matches several parameters %s' % sorted(set(name for name, _ in candidates)))
+    if candidates:
+      return {'source': 'copy', 'param': candidates[0][0], 'transpose': candidates[0][1]}
+    if target.ndim < 2:
+      return None
+    found = [self.rows.get(_digest(row)) for row in target]
+    if None in found or len(set(name for name, _ in found)) != 1:
+      return None
+    return {'source': 'copy', 'param': found[0][0], 'transpose': False, 'rows': [row for _, row in found]}
+
+def _fold_axis(kind):
+  # output channel axis of the weight as it appears in the graph
+  return {'Conv': 0, 'ConvTranspose': 1, 'Linear': 1}[kind]
+
+def _match_fold(target, kind, pairs, state_dict):
+  best = None
+  for pair in pairs:
+    if pair['kind'] != kind:
+      continue
+    weight = state_dict[pair['layer'] + '.weight']
+    if (weight.T if kind == 'Linear' else weight).shape != target.shape:
+      continue
+    for formula in FOLD_FORMULAS:
+      recipe = dict(pair, source='fold', part='weight', axis=_fold_axis(kind), formula=formula)
+      error = float(np.abs(evaluate(recipe, state_dict).astype(np.float64) - target).max())
+      if best is None or error < best[0]:
+        best = (error, recipe)
+      if error == 0:
+        return recipe
+  if best is not None and best[0] <= MAX_FOLD_ERROR * max(float(np.abs(target).max()), 1.0):
+    return best[1]
+  return None
+
+def _bias_input(node, consumers, initializers):
+  # the bias of a layer: its own third input or, for MatMul, the Add right after it
+  if node.op_type != "MatMul":
+    return node.input[2] if len(node.input) > 2 and node.input[2] in initializers else None
+  users = consumers[node.output[0]]
+  if len(users) == 1 and users[0][0].op_type == "Add":
+    other = [name for name in users[0][0].input if name != node.output[0]]
+    if other and other[0] in initializers:
+      return other[0]
+  return None
+
+def derive_recipes(model_path, state_dict, pairs):
+  """
+  Derives the swap recipes of the exported graph at model_path from the
+  state_dict it was exported from (see state_dict_arrays) and the folded
+  layer pairs (see module_pairs). Every recipe is replayed on that state_dict
+  and compared with the template bits, 'exact' records the outcome.
+  """
+  model = onnx.load(model_path)
+  initializers = {t.name: numpy_helper.to_array(t) for t in model.graph.initializer}
+  consumers = defaultdict(list)
+  for node in model.graph.node:
+    for i, name in enumerate(node.input):
+      consumers[name].append((node, i))
+  index = _StateIndex(state_dict)
+  bn_modules = sorted(name[:-len('.running_var')] for name in state_dict if name.endswith('.running_var'))
+
+  recipes = dict()
+  for node in model.graph.node:
+    if node.op_type == "BatchNormalization" and all(name in initializers for name in node.input[1:5]):
+      # an unfolded BatchNorm, its four inputs come from one module
+      targets = [initializers[name] for name in node.input[1:5]]
+      module = next((m for m in bn_modules if all(np.array_equal(state_dict.get(m + '.' + p), t) for p, t in zip(BN_PARAMS, targets))), None)
+      if module is not None:
+        for name, param in zip(node.input[1:5], BN_PARAMS):
+          recipes[name] = {'source': 'copy', 'param': module + '.' + param, 'transpose': False}
+      continue
+    if node.op_type not in LAYER_OPS or len(node.input) < 2 or node.input[1] not in initializers:
+      continue
+
+    weight_name = node.input[1]
+    target = initializers[weight_name]
+    recipe = index.match(target) or _match_fold(target, LAYER_OPS[node.op_type], pairs, state_dict)
+    if recipe is None:
+      raise ValueError('No parameter of the checkpoint gives initializer %s of %s %s' % (weight_name, node.op_type, node.name))
+    recipes[weight_name] = recipe
+
+    bias_name = _bias_input(node, consumers, initializers)
+    if bias_name is None:
+      continue
+    if recipe['source'] == 'fold':
+      recipes[bias_name] = dict(recipe, part='bias')
+    else:
+      sibling = recipe['param'].rsplit('.', 1)[0] + '.bias'
+      bias = dict(recipe, param=sibling, transpose=False)
+      if sibling not in state_dict or not np.array_equal(evaluate(bias, state_dict), initializers[bias_name]):
+        bias = index.match(initializers[bias_name], prefer=sibling)
+      if bias is None:
+        raise ValueError('No parameter of the checkpoint gives bias %s of %s' % (bias_name, node.name))
+      recipes[bias_name] = bias
+
+  layer_inputs = set(name for node in model.graph.node if node.op_type in LAYER_OPS or node.op_type == "BatchNormalization"
+                     for name in node.input[1:])
+  unmatched = [name for name, value in initializers.items() if name not in recipes and value.dtype.kind == 'f'
+               and (name in layer_inputs or value.size >= MIN_WEIGHT_ELEMENTS)]
+  if unmatched:
+    raise ValueError('Initializers %s match no parameter of the checkpoint' % unmatched)
+
+  params = dict()
+  for name, recipe in recipes.items():
+    value = evaluate(recipe, state_dict)
+    error = float(np.abs(value.astype(np.float64) - initializers[name]).max()) if value.size else 0.0
+    recipe.update(initializer=name, exact=value.tobytes() == initializers[name].astype(value.dtype).tobytes(), max_error=error)
+    if recipe['source'] == 'copy':
+      used = [recipe['param']]
+    else:
+      used = [recipe['layer'] + '.weight'] + [recipe['bn'] + '.' + p for p in BN_PARAMS]
+      used += [recipe['layer'] + '.bias'] if recipe['layer'] + '.bias' in state_dict else []
+    params.update({p: list(state_dict[p].shape) for p in used})
+
+  ordered = [recipes[t.name] for t in model.graph.initializer if t.name in recipes]
+  return {
+    'template': os.path.basename(model_path),
+    'recipes': ordered,
+    'params': params,
+    'exact': all(recipe['exact'] for recipe in ordered),
+    'max_error': max([recipe['max_error'] for recipe in ordered] + [0.0]),
+  }
+
+def save_recipes(swap, path):
+  with open(path, 'w') as f:
+    json.dump(swap, f, indent=2)
+
+def load_recipes(path):
+  with open(path) as f:
+    return json.load(f)
+
+def check_architecture(swap, state_dict, name='checkpoint'):
+  missing = [p for p in swap['params'] if p not in state_dict]
+  if missing:
+    raise ValueError('%s lacks parameters %s of the template' % (name, missing))
+  changed = ['%s %s != %s' % (p, list(state_dict[p].shape), shape) for p, shape in swap['params'].items()
+             if list(state_dict[p].shape) != shape]
+  if changed:
+    raise ValueError('%s does not match the template architecture: %s' % (name, ', '.join(changed)))
+
+def apply_recipes(template_path, swap, state_dict, output_path):
+  """
+  Writes the template graph with every recipe initializer recomputed from
+  state_dict. The graph itself, its metadata and the structural constants
+  are the template's.
+  """
+  check_architecture(swap, state_dict)
+  model = onnx.load(template_path)
+  recipes = {recipe['initializer']: recipe for recipe in swap['recipes']}
+  for tensor in model.graph.initializer:
+    recipe = recipes.get(tensor.name)
+    if recipe is None:
+      continue
+    value = evaluate(recipe, state_dict).astype(onnx.helper.tensor_dtype_to_np_dtype(tensor.data_type))
+    assert value.shape == tuple(tensor.dims), 'shape of %s changed' % tensor.name
+    tensor.CopyFrom(numpy_helper.from_array(value, tensor.name))
+  onnx.save(model, output_path)
+  return output_path